@@ -0,0 +1,311 @@
+import argparse
+import subprocess
+import tempfile
+import datetime
+import socket
+import shutil
+import base64
+import json
+import csv
+import sys
+import os
+from time import sleep, perf_counter
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK = os.path.join(REPO, "benchmark", "mockpapi.py")
+# The tools always connect on port 8080
+PORT = 8080
+# Dataset sizes of each scale
+SCALES = {
+    "small": {"snapshots": 1000, "entries": 100000, "quotas": 10000, "nodes": 8, "openfiles": 1000},
+    "full": {"snapshots": 10000, "entries": 1000000, "quotas": 100000, "nodes": 64, "openfiles": 1000},
+}
+RESULTFIELDS = [
+    "date",
+    "scale",
+    "case",
+    "items",
+    "unit",
+    "seconds",
+    "items_per_second",
+    "peak_rss_mb",
+    "exit_code",
+    "latency",
+]
+
+
+def getcases(sizes):
+    """This function lists the benchmark cases for the dataset sizes, each
+    with the script, its arguments, what is typed at its prompts and how many
+    items it works through"""
+    nodes = sizes["nodes"]
+    return [
+        {
+            "case": "quotareport",
+            "script": "quotareport.py",
+            "args": ["127.0.0.1", "G", "-l", "1000", "-k", "n"],
+            "stdin": "",
+            "items": sizes["quotas"],
+            "unit": "quotas",
+        },
+        {
+            "case": "quotareport top 100",
+            "script": "quotareport.py",
+            "args": ["127.0.0.1", "G", "-l", "1000", "-k", "n", "-n", "100", "-b", "percent"],
+            "stdin": "",
+            "items": sizes["quotas"],
+            "unit": "quotas",
+        },
+        {
+            "case": "isi_changelist list snapshots",
+            "script": "isi_changelist.py",
+            "args": ["127.0.0.1"],
+            "stdin": "1\nn\n8\n",
+            "items": sizes["snapshots"],
+            "unit": "snapshots",
+        },
+        {
+            "case": "isi_changelist export csv",
+            "script": "isi_changelist.py",
+            "args": ["127.0.0.1"],
+            "stdin": "6\n1_2\n8\n",
+            "items": sizes["entries"],
+            "unit": "entries",
+        },
+        {
+            "case": "isi_changelist export parquet",
+            "script": "isi_changelist.py",
+            "args": ["127.0.0.1", "-f", "parquet"],
+            "stdin": "6\n1_2\n8\n",
+            "items": sizes["entries"],
+            "unit": "entries",
+        },
+        {
+            "case": "isi_changelist rollup",
+            "script": "isi_changelist.py",
+            "args": ["127.0.0.1"],
+            "stdin": "7\n1_2\n8\n",
+            "items": sizes["entries"],
+            "unit": "entries",
+        },
+        {
+            "case": "isi_locksmith scan " + str(nodes) + " nodes",
+            "script": "isi_locksmith.py",
+            "args": ["report"],
+            "stdin": "127.0.0.1-" + str(nodes) + "\n1\nn\n",
+            "items": nodes * sizes["openfiles"],
+            "unit": "open files",
+        },
+        {
+            "case": "snaplock bulk",
+            "script": "snaplock.py",
+            "args": [
+                "127.0.0.1",
+                ",".join(str(i) for i in range(1, sizes["snapshots"] + 1)),
+                "-w",
+                "16",
+            ],
+            "stdin": "",
+            "items": sizes["snapshots"],
+            "unit": "locks",
+        },
+    ]
+
+
+def preparework(workdir):
+    """This function writes creds.json and a self signed certificate for the
+    mock cluster into the work directory, returns the certificate and key"""
+    with open(os.path.join(workdir, "creds.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {"username": "admin", "password": base64.b64encode(b"mock").decode("utf-8")}, f
+        )
+    openssl = shutil.which("openssl")
+    if openssl is None:
+        print("\nThe benchmark needs openssl to create a certificate for the mock cluster.\n")
+        sys.exit()
+    cert = os.path.join(workdir, "cert.pem")
+    key = os.path.join(workdir, "key.pem")
+    subprocess.run(
+        [openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def startmock(workdir, sizes, latency, cert, key):
+    """This function starts the mock PAPI server and waits until it accepts
+    connections, returns the process"""
+    try:
+        socket.create_connection(("127.0.0.1", PORT), timeout=1).close()
+        print("\nPort " + str(PORT) + " is already in use. Stop whatever is using it first.\n")
+        sys.exit()
+    except OSError:
+        pass
+    log = open(os.path.join(workdir, "mockpapi.log"), "w", encoding="utf-8")
+    mock = subprocess.Popen(
+        [sys.executable, MOCK, "--port", str(PORT), "--cert", cert, "--key", key,
+         "--snapshots", str(sizes["snapshots"]), "--entries", str(sizes["entries"]),
+         "--quotas", str(sizes["quotas"]), "--openfiles", str(sizes["openfiles"]),
+         "--latency", str(latency), "--jobseconds", "0"],
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", PORT), timeout=1).close()
+            return mock
+        except OSError:
+            if mock.poll() is not None:
+                break
+            sleep(0.1)
+    mock.kill()
+    print("\nThe mock PAPI server did not start, see " + log.name + "\n")
+    sys.exit(1)
+
+
+def runcase(case, workdir):
+    """This function runs one case in the work directory, returns its wall
+    time in seconds, peak resident memory in MB and exit code"""
+    env = dict(os.environ)
+    # Never pick up a running daemon, every case pays for its own session
+    env["ISI_TOOLS_SOCKET"] = os.path.join(workdir, "no_daemon.sock")
+    logname = case["case"].replace(" ", "_") + ".out"
+    with open(os.path.join(workdir, logname), "w", encoding="utf-8") as log:
+        start = perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(REPO, case["script"])] + case["args"],
+            cwd=workdir,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        proc.stdin.write(case["stdin"].encode("utf-8"))
+        proc.stdin.close()
+        # wait4 reaps the child and returns its own resource usage
+        _, status, usage = os.wait4(proc.pid, 0)
+        seconds = perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return seconds, usage.ru_maxrss / 1024, proc.returncode
+
+
+def main():
+    """This function is the main function that runs the benchmark"""
+    parser = argparse.ArgumentParser(
+        description="Time isi_tools entry points against a local mock PAPI server"
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        choices=list(SCALES),
+        default="small",
+        help="Dataset sizes: small (default) or full (10k snapshots, 1M ChangeList "
+        + "entries, 100k quotas, 64 nodes)",
+    )
+    for size in SCALES["full"]:
+        parser.add_argument("--" + size, type=int, help="Override the number of " + size)
+    parser.add_argument(
+        "-l",
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds of latency the mock adds to every request (default 0)",
+    )
+    parser.add_argument(
+        "-c",
+        "--case",
+        action="append",
+        help="Only run cases whose name contains this, may be repeated",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep",
+        action="store_true",
+        help="Keep the work directory with the tool outputs",
+    )
+    args = parser.parse_args()
+    if sys.platform != "linux":
+        print("\nThe mock cluster needs every 127.0.0.x address, which only Linux routes.\n")
+        sys.exit()
+
+    sizes = dict(SCALES[args.scale])
+    for size in sizes:
+        if getattr(args, size) is not None:
+            sizes[size] = getattr(args, size)
+    if sizes["nodes"] > 254:
+        print("\nThe mock cluster has at most 254 nodes.\n")
+        sys.exit()
+    cases = [
+        case
+        for case in getcases(sizes)
+        if not args.case or any(name in case["case"] for name in args.case)
+    ]
+
+    workdir = tempfile.mkdtemp(prefix="isi_tools_benchmark_")
+    cert, key = preparework(workdir)
+    mock = startmock(workdir, sizes, args.latency, cert, key)
+    print(
+        "\nBenchmarking at "
+        + ", ".join(str(sizes[size]) + " " + size for size in sizes)
+        + " with "
+        + str(args.latency)
+        + "s latency in "
+        + workdir
+        + "\n"
+    )
+    results = []
+    try:
+        for case in cases:
+            print("Running " + case["case"] + "...", end=" ", flush=True)
+            seconds, peak, code = runcase(case, workdir)
+            print("done" if code == 0 else "failed with exit code " + str(code))
+            results.append(
+                {
+                    "date": str(datetime.datetime.now().replace(microsecond=0)),
+                    "scale": args.scale,
+                    "case": case["case"],
+                    "items": case["items"],
+                    "unit": case["unit"],
+                    "seconds": round(seconds, 2),
+                    "items_per_second": round(case["items"] / seconds),
+                    "peak_rss_mb": round(peak, 1),
+                    "exit_code": code,
+                    "latency": args.latency,
+                }
+            )
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    rows = [
+        [r["case"], str(r["items"]) + " " + r["unit"], "%.2f" % r["seconds"],
+         str(r["items_per_second"]) + "/s", "%.1f" % r["peak_rss_mb"], str(r["exit_code"])]
+        for r in results
+    ]
+    header = ["case", "items", "seconds", "throughput", "peak RSS (MB)", "exit"]
+    widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+    print()
+    for row in [header] + rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+    csvpath = "benchmark_results_" + str(datetime.date.today()) + ".csv"
+    exists = os.path.isfile(csvpath)
+    with open(csvpath, "a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULTFIELDS)
+        if not exists:
+            writer.writeheader()
+        writer.writerows(results)
+    print("\nResults appended to " + os.getcwd() + "/" + csvpath + "\n")
+    if args.keep:
+        print("Tool outputs kept in " + workdir + "\n")
+    elif not args.keep:
+        shutil.rmtree(workdir)
+    if any(r["exit_code"] != 0 for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
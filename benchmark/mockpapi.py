@@ -0,0 +1,310 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from time import sleep, time
+import argparse
+import threading
+import json
+import ssl
+import re
+
+
+def newstate(snapshots, entries, quotas, openfiles, latency, jobseconds):
+    """This function creates the state of the mock cluster. Changelist
+    entries, quotas and open files are generated from their index when
+    requested, so large datasets cost no memory."""
+    return {
+        "lock": threading.Lock(),
+        "snapshots": [
+            {
+                "id": i,
+                "name": "snap" + str(i),
+                "path": "/ifs/data/project" + str(i % 100),
+                "size": i * 4096,
+                "has_locks": False,
+                "created": 1700000000 + i * 60,
+            }
+            for i in range(1, snapshots + 1)
+        ],
+        "locks": {},
+        "jobs": {},
+        "closed": set(),
+        "entries": entries,
+        "quotas": quotas,
+        "openfiles": openfiles,
+        "latency": latency,
+        "jobseconds": jobseconds,
+    }
+
+
+def changelistentry(i):
+    """This function generates changelist entry i"""
+    return {
+        "id": i,
+        "path": "/ifs/data/project"
+        + str(i % 100)
+        + "/dir"
+        + str(i % 1000)
+        + "/sub"
+        + str(i % 7)
+        + "/file"
+        + str(i)
+        + ".dat",
+        "size": (i % 10000) * 512,
+        "physical_size": (i % 10000) * 1024,
+        "change_types": ["ENTRY_ADDED"] if i % 3 else ["ENTRY_MODIFIED"],
+    }
+
+
+def quota(i):
+    """This function generates quota i"""
+    fslogical = (i % 5000 + 1) * 1024**3 // 10
+    return {
+        "id": "quota" + str(i),
+        "path": "/ifs/home/user" + str(i),
+        "type": "directory",
+        "description": "",
+        "thresholds_on": "fslogicalsize",
+        "usage": {
+            "fsphysical": fslogical * 2,
+            "fslogical": fslogical,
+            "applogical": fslogical,
+        },
+        "thresholds": {"hard": (i % 5000 + 1) * 1024**3 // 5 if i % 4 else None},
+    }
+
+
+def openfile(node, i):
+    """This function generates open file i of a node. One file in a hundred
+    is a report, so searches for 'report' match a small share."""
+    name = ("report" if i % 100 == 0 else "doc") + str(i) + ".xlsx"
+    return {
+        "id": i + 1,
+        "file": "C:\\ifs\\home\\user" + str(i % 500) + "\\node" + node + "\\" + name,
+        "user": "user" + str(i % 500),
+        "locks": 1,
+        "permissions": ["read", "write"],
+    }
+
+
+def page(count, generate, key, query):
+    """This function returns one page of count generated items, continuing
+    from the resume token when one is passed"""
+    if "resume" in query:
+        offset, limit = map(int, query["resume"][0].split(":"))
+    else:
+        offset = 0
+        limit = int(query.get("limit", [count or 1])[0])
+    end = min(offset + limit, count)
+    return {
+        key: [generate(i) for i in range(offset, end)],
+        "total": count,
+        "resume": str(end) + ":" + str(limit) if end < count else None,
+    }
+
+
+class PapiHandler(BaseHTTPRequestHandler):
+    """This handler answers the PAPI endpoints used by isi_tools"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, cookies=()):
+        content = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for cookie in cookies:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def readbody(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def route(self, method):
+        state = self.server.state
+        body = self.readbody() if method == "POST" else {}
+        if state["latency"]:
+            sleep(state["latency"])
+        parts = urlsplit(self.path)
+        path = parts.path
+        query = parse_qs(parts.query)
+        authorized = "isisessid=" in (self.headers.get("Cookie") or "")
+        if path == "/session/1/session":
+            if method == "POST":
+                return self.reply(
+                    201,
+                    {"timeout_absolute": 14400, "timeout_inactive": 900},
+                    ["isisessid=mock; Path=/", "isicsrf=mock; Path=/"],
+                )
+            if method == "DELETE":
+                return self.reply(204)
+            return self.reply(200 if authorized else 401, {"username": "admin"})
+        if not authorized:
+            return self.reply(401, {"errors": [{"message": "Authorization required"}]})
+
+        if path == "/platform/1/snapshot/snapshots":
+            if method == "POST":
+                with state["lock"]:
+                    snapid = state["snapshots"][-1]["id"] + 1 if state["snapshots"] else 1
+                    state["snapshots"].append(
+                        {
+                            "id": snapid,
+                            "name": body.get("name", "snap" + str(snapid)),
+                            "path": body["path"],
+                            "size": 0,
+                            "has_locks": False,
+                            "created": int(time()),
+                        }
+                    )
+                return self.reply(201, {"id": snapid})
+            snapshots = state["snapshots"]
+            descending = query.get("dir") == ["DESC"]
+            if "resume" in query:
+                descending = query["resume"][0].endswith(":DESC")
+                query = {"resume": [query["resume"][0].rsplit(":", 1)[0]]}
+            if descending:
+                snapshots = snapshots[::-1]
+            result = page(len(snapshots), snapshots.__getitem__, "snapshots", query)
+            if result["resume"] is not None:
+                result["resume"] += ":DESC" if descending else ":ASC"
+            return self.reply(200, result)
+
+        match = re.fullmatch(r"/platform/12/snapshot/snapshots/([^/]+)/locks(?:/(\d+))?", path)
+        if match:
+            with state["lock"]:
+                locks = state["locks"].setdefault(match.group(1), [])
+                if method == "GET":
+                    return self.reply(200, {"locks": list(locks), "total": len(locks)})
+                if method == "POST":
+                    lockid = len(locks) + 1
+                    locks.append(
+                        {
+                            "id": lockid,
+                            "comment": body.get("comment"),
+                            "expires": body.get("expires"),
+                            "count": 1,
+                        }
+                    )
+                    return self.reply(201, {"id": lockid})
+                if match.group(2):
+                    locks[:] = [lock for lock in locks if lock["id"] != int(match.group(2))]
+                else:
+                    locks.clear()
+            return self.reply(204)
+
+        if path == "/platform/7/job/jobs" and method == "POST":
+            with state["lock"]:
+                jobid = len(state["jobs"]) + 1
+                state["jobs"][jobid] = time()
+            return self.reply(201, {"id": jobid})
+        match = re.fullmatch(r"/platform/7/job/jobs/(\d+)", path)
+        if match:
+            started = state["jobs"].get(int(match.group(1)))
+            if started is None:
+                return self.reply(404, {"errors": [{"message": "Job not found"}]})
+            done = time() - started >= state["jobseconds"]
+            job = {
+                "id": int(match.group(1)),
+                "state": "succeeded" if done else "running",
+                "current_phase": 2 if done else 1,
+                "total_phases": 2,
+                "progress": "Processed " + str(state["entries"]) + " entries" if done else None,
+            }
+            return self.reply(200, {"jobs": [job]})
+
+        if path == "/platform/3/snapshot/changelists":
+            changelists = [
+                {"id": "1_2", "job_id": 1, "root_path": "/ifs", "num_entries": state["entries"]}
+            ]
+            return self.reply(200, {"changelists": changelists, "total": 1})
+        match = re.fullmatch(r"/platform/10/snapshot/changelists/([^/]+)/entries", path)
+        if match:
+            result = page(state["entries"], changelistentry, "entries", query)
+            return self.reply(200, result)
+        if re.fullmatch(r"/platform/1/snapshot/changelists/[^/]+", path) and method == "DELETE":
+            return self.reply(204)
+
+        if path == "/platform/15/quota/quotas":
+            return self.reply(200, page(state["quotas"], quota, "quotas", query))
+
+        node = self.connection.getsockname()[0].rsplit(".", 1)[-1]
+        if path == "/platform/1/protocols/smb/openfiles":
+            result = page(
+                state["openfiles"], lambda i: openfile(node, i), "openfiles", query
+            )
+            return self.reply(200, result)
+        if re.fullmatch(r"/platform/1/protocols/smb/openfiles/\d+", path) and method == "DELETE":
+            with state["lock"]:
+                state["closed"].add((node, path))
+            return self.reply(204)
+
+        return self.reply(404, {"errors": [{"message": "Path not found: " + path}]})
+
+
+def serve(host, port, state, cert=None, key=None):
+    """This function starts the mock cluster in a background thread, serving
+    https when a certificate is given, returns the server"""
+    server = ThreadingHTTPServer((host, port), PapiHandler)
+    server.daemon_threads = True
+    server.state = state
+    if cert is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    """This function is the main function that runs the mock PAPI server"""
+    parser = argparse.ArgumentParser(
+        description="Serve a mock PowerScale PAPI for isi_tools benchmarks. Bound to "
+        + "0.0.0.0, every 127.0.0.x address acts as a separate node."
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="Address to bind (default 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to bind (default 8080)")
+    parser.add_argument("--cert", help="PEM certificate, serves https when given")
+    parser.add_argument("--key", help="PEM private key of the certificate")
+    parser.add_argument("--snapshots", type=int, default=1000, help="Snapshots (default 1000)")
+    parser.add_argument(
+        "--entries", type=int, default=100000, help="Entries of ChangeList 1_2 (default 100000)"
+    )
+    parser.add_argument("--quotas", type=int, default=10000, help="Quotas (default 10000)")
+    parser.add_argument(
+        "--openfiles", type=int, default=1000, help="Open files per node (default 1000)"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every request (default 0)"
+    )
+    parser.add_argument(
+        "--jobseconds", type=float, default=2.0, help="Seconds a job runs (default 2)"
+    )
+    args = parser.parse_args()
+    state = newstate(
+        args.snapshots, args.entries, args.quotas, args.openfiles, args.latency, args.jobseconds
+    )
+    server = serve(args.host, args.port, state, args.cert, args.key)
+    scheme = "https://" if args.cert else "http://"
+    print("Mock PAPI listening on " + scheme + args.host + ":" + str(args.port), flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
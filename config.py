@@ -1,6 +1,7 @@
 from getpass import getpass
 import base64
 import sys
+import os
 import json
 import ipaddress
 import requests
@@ -88,6 +89,9 @@ def configureenvironment():
 
     print("\nValidating credentials against provided address...")
     api_session = getsession(user, p, uri)
+    # Sessions cached for the previous credentials are no longer wanted
+    if os.path.isfile("session_cache.json"):
+        os.remove("session_cache.json")
     if api_session.cookies:
         print("\nEnvironment configured w/ valid credentials. Enjoy!\n")
         sys.exit()
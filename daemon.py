@@ -0,0 +1,604 @@
+from time import perf_counter
+from getpass import getpass
+from urllib.parse import urlsplit
+import argparse
+from collections import deque
+import logging
+import logging.handlers
+import fcntl
+import queue
+import atexit
+import base64
+import os
+import sys
+import signal
+import socket
+import socketserver
+import datetime
+import threading
+import json
+import math
+import urllib3
+import requests
+
+# Unix socket the daemon listens on and the other isi_tools look for
+DAEMONSOCKET = os.environ.get("ISI_TOOLS_SOCKET", "isi_tools.sock")
+# Upper bounds in seconds of the PAPI request latency histogram buckets
+LATENCYBUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Per endpoint request metrics, keyed by method and endpoint
+METRICS = {}
+METRICSLOCK = threading.Lock()
+CACHELOCK = threading.Lock()
+
+
+def readsessioncache():
+    """This function reads the session cache shared by all isi_tools, returns
+    a dict of cached sessions keyed by cluster uri"""
+    cache = "session_cache.json"
+    if os.path.isfile(cache):
+        try:
+            with open(cache, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    return {}
+
+
+def writesessioncache(sessions):
+    """This function atomically writes the session cache, readable only by
+    the current user"""
+    cache = "session_cache.json"
+    tmpcache = cache + "." + str(os.getpid()) + "." + str(threading.get_ident())
+    fd = os.open(tmpcache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(sessions, f, indent=4)
+    os.replace(tmpcache, cache)
+
+
+def getcachedsession(uri):
+    """This function reuses a cached session for uri if it has not expired and
+    the cluster still accepts it, returns session or None"""
+    entry = readsessioncache().get(uri)
+    now = datetime.datetime.now().timestamp()
+    if entry is None or entry["expires"] <= now:
+        return None
+    api_session = requests.Session()
+    api_session.cookies.set("isisessid", entry["isisessid"])
+    api_session.cookies.set("isicsrf", entry["isicsrf"])
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = entry["isicsrf"]
+    start = perf_counter()
+    response = api_session.get(uri + "/session/1/session", verify=False, timeout=60)
+    recordrequest(
+        "GET",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code != 200:
+        logging.info("Cached API session of " + entry["username"] + " at " + uri + " rejected")
+        return None
+    logging.info("Cached API session reused by " + entry["username"] + " at " + uri)
+    entry["expires"] = min(now + entry["timeout_inactive"], entry["expires_absolute"])
+    with CACHELOCK:
+        sessions = readsessioncache()
+        sessions[uri] = entry
+        writesessioncache(sessions)
+    return api_session, entry["username"]
+
+
+def cachesession(uri, api_session, user, response):
+    """This function stores the isisessid/isicsrf cookies of a new session with
+    their expiry so later runs can reuse them"""
+    timeouts = json.loads(response.content.decode(encoding="UTF-8") or "{}")
+    now = datetime.datetime.now().timestamp()
+    inactive = timeouts.get("timeout_inactive", 900)
+    absolute = now + timeouts.get("timeout_absolute", 14400)
+    with CACHELOCK:
+        sessions = readsessioncache()
+        sessions[uri] = {
+            "username": user,
+            "isisessid": api_session.cookies.get("isisessid"),
+            "isicsrf": api_session.cookies.get("isicsrf"),
+            "timeout_inactive": inactive,
+            "expires_absolute": absolute,
+            "expires": min(now + inactive, absolute),
+        }
+        writesessioncache(sessions)
+
+
+def getcreds():
+    """This function reads credentials from creds.json or prompts for them,
+    returns user and password"""
+    creds = "creds.json"
+    if os.path.isfile(creds):
+        with open(creds, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            user = data["username"]
+            p = base64.b64decode(data["password"]).decode("utf-8")
+    elif os.path.isfile(creds) is False:
+        user = input("Please provide your user name? \n")
+        print("\nPlease provide the password for your user account...\n")
+        p = getpass()
+    return user, p
+
+
+def login(uri, user, p):
+    """This function creates an API session, returns the session or None"""
+    headers = {"Content-Type": "application/json"}
+    data = json.dumps({"username": user, "password": p, "services": ["platform"]})
+    api_session = requests.Session()
+    start = perf_counter()
+    response = api_session.post(
+        uri + "/session/1/session", data=data, headers=headers, verify=False, timeout=60
+    )
+    recordrequest(
+        "POST",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code == 200 or response.status_code == 201:
+        logging.info("API session created successfully by " + user + " at " + uri)
+    elif response.status_code != 200 or response.status_code != 201:
+        logging.info("Creation of API session by " + user + " at " + uri + " unsuccessful")
+        return None
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = api_session.cookies.get("isicsrf")
+    cachesession(uri, api_session, user, response)
+    return api_session
+
+
+def getwarmsession(server, uri, stale=None):
+    """This function returns the daemon's warm session to a cluster, creating
+    it from the session cache or a login on first use. Passing the session
+    the cluster just rejected as stale replaces it. The login holds only
+    that cluster's lock, so a slow or unreachable cluster does not stall
+    clients of the others. Returns session or None."""
+    with server.sessionlock:
+        api_session = server.sessions.get(uri)
+        if api_session is not None and api_session is not stale:
+            return api_session
+        urilock = server.urilocks.setdefault(uri, threading.Lock())
+    with urilock:
+        # Another client may have logged in while this one waited
+        with server.sessionlock:
+            api_session = server.sessions.get(uri)
+        if api_session is not None and api_session is not stale:
+            return api_session
+        api_session = None
+        if stale is None:
+            api_session = getcachedsession(uri)
+        if api_session is None:
+            user, p = server.creds
+            session = login(uri, user, p)
+            if session is None:
+                return None
+            api_session = (session, user)
+        # One pooled connection per client request in flight
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=server.workers)
+        api_session[0].mount("https://", adapter)
+        with server.sessionlock:
+            server.sessions[uri] = api_session
+        return api_session
+
+
+def endpointname(resourceurl):
+    """This function reduces a resource URL to its endpoint by replacing each
+    part after the API version that holds a digit, such as a snapshot,
+    lock or ChangeList ID, with {id}"""
+    parts = resourceurl.split("?")[0].strip("/").split("/")
+    return "/" + "/".join(
+        "{id}" if index > 1 and any(c.isdigit() for c in part) else part
+        for index, part in enumerate(parts)
+    )
+
+
+def recordrequest(method, resourceurl, status, nbytes, elapsed):
+    """This function adds one API request to the per endpoint metrics. status
+    is None when no response came back, elapsed is in seconds."""
+    key = (method, endpointname(resourceurl))
+    with METRICSLOCK:
+        if key not in METRICS:
+            METRICS[key] = {
+                "count": 0,
+                "errors": 0,
+                "bytes": 0,
+                "seconds": 0.0,
+                "buckets": [0] * len(LATENCYBUCKETS),
+                "latencies": deque(maxlen=10000),
+                "statuses": {},
+            }
+        entry = METRICS[key]
+        entry["count"] += 1
+        entry["bytes"] += nbytes
+        entry["seconds"] += elapsed
+        entry["latencies"].append(elapsed)
+        for index, bound in enumerate(LATENCYBUCKETS):
+            if elapsed <= bound:
+                entry["buckets"][index] += 1
+        if status is None or status >= 400:
+            entry["errors"] += 1
+        status = str(status) if status is not None else "none"
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def percentile(values, fraction):
+    """This function returns the nearest rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def metricsummary():
+    """This function summarizes the metrics of every endpoint, returns a list
+    of rows slowest p95 first"""
+    rows = []
+    with METRICSLOCK:
+        for (method, endpoint), entry in METRICS.items():
+            latencies = sorted(entry["latencies"])
+            rows.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "error_rate": round(entry["errors"] / entry["count"], 3),
+                    "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+                    "bytes": entry["bytes"],
+                }
+            )
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+
+def printmetrics():
+    """This function prints the per endpoint API request summary"""
+    rows = metricsummary()
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [columns] + [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    print("\nAPI requests by endpoint:\n")
+    for cell in cells:
+        print(" ".join(cell[i].rjust(widths[i]) for i in range(len(columns))))
+    print()
+
+
+def writemetrics(metricspath):
+    """This function atomically writes the metrics as a Prometheus textfile,
+    for the node_exporter textfile collector to pick up"""
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    families = {
+        "requests_total": ("counter", "PAPI requests by response status."),
+        "request_duration_seconds": ("histogram", "PAPI request latency."),
+        "request_latency_seconds": ("summary", "PAPI request latency quantiles."),
+        "response_bytes_total": ("counter", "PAPI response payload bytes."),
+        "request_errors_total": ("counter", "PAPI requests that failed or got a 4xx/5xx."),
+    }
+    samples = {family: [] for family in families}
+
+    def sample(family, suffix, labels, value):
+        samples[family].append(
+            "isi_tools_papi_" + family + suffix + "{" + labels + "} " + str(value)
+        )
+
+    with METRICSLOCK:
+        for (method, endpoint), entry in sorted(METRICS.items()):
+            labels = 'tool="' + tool + '",method="' + method + '",endpoint="' + endpoint + '"'
+            for status, count in sorted(entry["statuses"].items()):
+                sample("requests_total", "", labels + ',status="' + status + '"', count)
+            duration = "request_duration_seconds"
+            for bound, count in zip(LATENCYBUCKETS, entry["buckets"]):
+                sample(duration, "_bucket", labels + ',le="' + str(bound) + '"', count)
+            sample(duration, "_bucket", labels + ',le="+Inf"', entry["count"])
+            sample(duration, "_sum", labels, round(entry["seconds"], 6))
+            sample(duration, "_count", labels, entry["count"])
+            latencies = sorted(entry["latencies"])
+            for fraction in [0.5, 0.95, 0.99]:
+                quantile = round(percentile(latencies, fraction), 6)
+                sample(
+                    "request_latency_seconds",
+                    "",
+                    labels + ',quantile="' + str(fraction) + '"',
+                    quantile,
+                )
+            sample("request_latency_seconds", "_sum", labels, round(entry["seconds"], 6))
+            sample("request_latency_seconds", "_count", labels, entry["count"])
+            sample("response_bytes_total", "", labels, entry["bytes"])
+            sample("request_errors_total", "", labels, entry["errors"])
+    lines = []
+    for family, (kind, description) in families.items():
+        lines.append("# HELP isi_tools_papi_" + family + " " + description)
+        lines.append("# TYPE isi_tools_papi_" + family + " " + kind)
+        lines.extend(samples[family])
+    tmppath = metricspath + "." + str(os.getpid())
+    with open(tmppath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmppath, metricspath)
+
+
+def reportmetrics(metricspath, summary):
+    """This function prints and writes the metrics at the end of a run"""
+    if summary:
+        printmetrics()
+    if metricspath:
+        writemetrics(metricspath)
+
+
+def proxyrequest(server, header, body):
+    """This function sends one client request to the cluster over the warm
+    session, logging in again once if the cluster has expired it. Returns
+    the reply header and body."""
+    url = header["url"]
+    parts = urlsplit(url)
+    uri = parts.scheme + "://" + parts.netloc
+    if parts.scheme != "https":
+        return {"status": 400, "reason": "Only https cluster URIs are served"}, b""
+    try:
+        api_session = getwarmsession(server, uri)
+    except requests.exceptions.RequestException as err:
+        return {"error": "connection", "message": str(err)}, b""
+    if api_session is None:
+        return {"status": 401, "reason": "Session to " + uri + " not established"}, b""
+    if header["method"] == "SESSION":
+        return {"status": 200, "reason": "OK", "user": api_session[1]}, b""
+    if not parts.path.startswith("/platform/"):
+        return {"status": 403, "reason": "Only /platform/ requests are served"}, b""
+    headers = {}
+    if header.get("content_type"):
+        headers["Content-Type"] = header["content_type"]
+    timeout = header.get("timeout")
+    if isinstance(timeout, list):
+        timeout = tuple(timeout)
+    start = perf_counter()
+    for attempt in range(2):
+        try:
+            response = api_session[0].request(
+                header["method"],
+                url,
+                data=body or None,
+                headers=headers,
+                timeout=timeout,
+                verify=False,
+            )
+        except requests.exceptions.Timeout as err:
+            recordrequest(header["method"], parts.path, None, 0, perf_counter() - start)
+            return {"error": "timeout", "message": str(err)}, b""
+        except requests.exceptions.RequestException as err:
+            recordrequest(header["method"], parts.path, None, 0, perf_counter() - start)
+            return {"error": "connection", "message": str(err)}, b""
+        if response.status_code != 401 or attempt == 1:
+            break
+        # When the login again fails, the cluster's 401 goes back to the client
+        try:
+            fresh = getwarmsession(server, uri, stale=api_session)
+        except requests.exceptions.RequestException as err:
+            logging.info("Logging in again to " + uri + " failed: " + str(err))
+            fresh = None
+        if fresh is None:
+            break
+        api_session = fresh
+    recordrequest(
+        header["method"],
+        parts.path,
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    logging.info(
+        "%s request by %s at %s proxied",
+        header["method"],
+        api_session[1],
+        url,
+        extra={
+            "method": header["method"],
+            "endpoint": parts.path,
+            "status": response.status_code,
+            "bytes": len(response.content),
+            "elapsed_ms": round((perf_counter() - start) * 1000, 1),
+        },
+    )
+    reply = {
+        "status": response.status_code,
+        "reason": response.reason,
+        "content_type": response.headers.get("Content-Type"),
+    }
+    return reply, response.content
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """This handler serves the requests of one client connection. Each request
+    is a JSON header line with the body length, followed by the body."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            header = json.loads(line)
+            body = self.rfile.read(header.get("length", 0))
+            try:
+                reply, content = proxyrequest(self.server, header, body)
+            except Exception as err:
+                # The client still gets a reply and falls back to its own session
+                logging.exception("Proxying the request failed")
+                reply, content = {"error": "connection", "message": str(err)}, b""
+            reply["length"] = len(content)
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n" + content)
+            self.wfile.flush()
+
+
+def daemonrunning(socketpath):
+    """This function checks whether a daemon already answers on socketpath"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketpath)
+        return True
+    except OSError:
+        return False
+    finally:
+        client.close()
+
+
+class JsonFormatter(logging.Formatter):
+    """This formatter writes each log record as a JSON line, with the method,
+    endpoint, status, bytes and elapsed_ms of PAPI requests when present"""
+
+    fields = ["method", "endpoint", "status", "bytes", "elapsed_ms"]
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class LockedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """This handler rotates a log shared by several processes. Every record is
+    written under an flock on <log>.lock, so only one process rolls the log
+    over, and a process that finds the log was rolled over by another one
+    reopens it before writing."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = open(self.baseFilename + ".lock", "a")
+
+    def reopenifrotated(self):
+        """This function reopens the log when it is no longer the file this
+        handler has open"""
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or not os.path.samestat(current, opened):
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            self.reopenifrotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lockfile.close()
+
+
+def setuplogging():
+    """This function queues log records to a background thread that writes
+    them to isi_tools.log as JSON lines, rotating it at 10 MB and keeping
+    five old logs, so logging never blocks a request"""
+    logqueue = queue.Queue()
+    handler = LockedRotatingFileHandler(
+        "isi_tools.log", maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(logqueue, handler)
+    listener.start()
+    # Write out whatever is still queued when the tool exits
+    atexit.register(listener.stop)
+    queuehandler = logging.handlers.QueueHandler(logqueue)
+    queuehandler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(handlers=[queuehandler], level=logging.INFO)
+    return listener
+
+
+def writemetricsevery(metricspath, interval, stop):
+    """This function rewrites the Prometheus textfile every interval seconds
+    until stop is set"""
+    while not stop.wait(interval):
+        writemetrics(metricspath)
+
+
+def main():
+    """This function is the main function that runs the isi_tools daemon"""
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    parser = argparse.ArgumentParser(
+        description="Hold warm cluster sessions for the other isi_tools over a local socket"
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        default=DAEMONSOCKET,
+        help="Unix socket to listen on (default $ISI_TOOLS_SOCKET or isi_tools.sock). "
+        + "The other tools use the same default",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=32,
+        help="Connections kept open to each cluster (default 32)",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Rewrite per endpoint API request counts, latency, sizes and errors to "
+        + "this Prometheus textfile every minute and at exit",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print per endpoint API request counts, latency percentiles, sizes and "
+        + "error rates when the daemon stops",
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        print("\nWorkers must be 1 or greater.\n")
+        sys.exit()
+
+    setuplogging()
+    atexit.register(reportmetrics, args.metrics, args.summary)
+
+    if os.path.exists(args.socket):
+        if daemonrunning(args.socket):
+            print("\nA daemon is already listening on " + args.socket + ".\n")
+            sys.exit()
+        os.remove(args.socket)
+
+    # Sessions are reused by anyone who can reach the socket, so only the
+    # current user may
+    umask = os.umask(0o177)
+    server = socketserver.ThreadingUnixStreamServer(args.socket, DaemonHandler)
+    os.umask(umask)
+    server.daemon_threads = True
+    server.creds = getcreds()
+    server.workers = args.workers
+    server.sessions = {}
+    # sessionlock guards the two dicts, urilocks serialize logins per cluster
+    server.sessionlock = threading.Lock()
+    server.urilocks = {}
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    if args.metrics:
+        stop = threading.Event()
+        atexit.register(stop.set)
+        threading.Thread(
+            target=writemetricsevery, args=(args.metrics, 60, stop), daemon=True
+        ).start()
+    print("\nListening on " + os.path.abspath(args.socket) + ". Press Ctrl+C to stop.\n")
+    logging.info("Daemon listening on " + os.path.abspath(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        logging.info("Daemon on " + os.path.abspath(args.socket) + " stopped")
+
+
+if __name__ == "__main__":
+    main()
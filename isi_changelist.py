@@ -1,16 +1,45 @@
-from time import sleep
+from time import sleep, perf_counter
 import argparse
+from collections import OrderedDict, deque
 import logging
+import logging.handlers
+import fcntl
+import queue
+import atexit
 import base64
 from getpass import getpass
 import os
+import io
+import socket
 import ipaddress
 import sys
 import datetime
+import threading
+import csv
 import json
+import math
+import sqlite3
 import urllib3
 import requests
-import pandas as pd
+
+# Unix socket of daemon.py, which holds warm cluster sessions when running
+DAEMONSOCKET = os.environ.get("ISI_TOOLS_SOCKET", "isi_tools.sock")
+# Upper bounds in seconds of the PAPI request latency histogram buckets
+LATENCYBUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Per endpoint request metrics, keyed by method and endpoint
+METRICS = {}
+METRICSLOCK = threading.Lock()
+# Seconds a GET response stays in the response cache, by endpoint. Endpoints
+# not listed here, such as job status and ChangeList entries, are not cached.
+CACHETTLS = {
+    "/platform/1/snapshot/snapshots": 60,
+    "/platform/3/snapshot/changelists": 30,
+}
+# Most responses kept before the least recently used is evicted
+CACHESIZE = 128
+# Cached GET responses, keyed by cluster, resource URL and query, oldest first
+RESPONSECACHE = OrderedDict()
+RESPONSECACHELOCK = threading.Lock()
 
 
 def validateinput(ip):
@@ -36,8 +65,175 @@ Welcome to
     )
 
 
+def readsessioncache():
+    """This function reads the session cache shared by all isi_tools, returns
+    a dict of cached sessions keyed by cluster uri"""
+    cache = "session_cache.json"
+    if os.path.isfile(cache):
+        try:
+            with open(cache, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    return {}
+
+
+def writesessioncache(sessions):
+    """This function atomically writes the session cache, readable only by
+    the current user"""
+    cache = "session_cache.json"
+    tmpcache = cache + "." + str(os.getpid())
+    fd = os.open(tmpcache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(sessions, f, indent=4)
+    os.replace(tmpcache, cache)
+
+
+def getcachedsession(uri):
+    """This function reuses a cached session for uri if it has not expired and
+    the cluster still accepts it, returns session or None"""
+    entry = readsessioncache().get(uri)
+    now = datetime.datetime.now().timestamp()
+    if entry is None or entry["expires"] <= now:
+        return None
+    api_session = requests.Session()
+    api_session.cookies.set("isisessid", entry["isisessid"])
+    api_session.cookies.set("isicsrf", entry["isicsrf"])
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = entry["isicsrf"]
+    start = perf_counter()
+    response = api_session.get(uri + "/session/1/session", verify=False)
+    recordrequest(
+        "GET",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code != 200:
+        logging.info("Cached API session of " + entry["username"] + " at " + uri + " rejected")
+        return None
+    logging.info("Cached API session reused by " + entry["username"] + " at " + uri)
+    print("\nReusing session to " + uri + ".\n")
+    entry["expires"] = min(now + entry["timeout_inactive"], entry["expires_absolute"])
+    sessions = readsessioncache()
+    sessions[uri] = entry
+    writesessioncache(sessions)
+    return api_session, entry["username"]
+
+
+def cachesession(uri, api_session, user, response):
+    """This function stores the isisessid/isicsrf cookies of a new session with
+    their expiry so later runs can reuse them"""
+    timeouts = json.loads(response.content.decode(encoding="UTF-8") or "{}")
+    now = datetime.datetime.now().timestamp()
+    inactive = timeouts.get("timeout_inactive", 900)
+    absolute = now + timeouts.get("timeout_absolute", 14400)
+    sessions = readsessioncache()
+    sessions[uri] = {
+        "username": user,
+        "isisessid": api_session.cookies.get("isisessid"),
+        "isicsrf": api_session.cookies.get("isicsrf"),
+        "timeout_inactive": inactive,
+        "expires_absolute": absolute,
+        "expires": min(now + inactive, absolute),
+    }
+    writesessioncache(sessions)
+
+
+def daemoncall(socketpath, header, body=b"", timeout=None):
+    """This function sends one request to daemon.py over its Unix socket,
+    returns the reply header and body"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socketpath)
+        header = dict(header, length=len(body))
+        client.sendall(json.dumps(header).encode("utf-8") + b"\n" + body)
+        with client.makefile("rb") as f:
+            try:
+                reply = json.loads(f.readline())
+                length = reply["length"]
+            except (ValueError, KeyError) as err:
+                raise requests.exceptions.ConnectionError(
+                    "daemon.py sent no valid reply: " + str(err)
+                )
+            return reply, f.read(length)
+    finally:
+        client.close()
+
+
+class DaemonAdapter(requests.adapters.BaseAdapter):
+    """This adapter hands the requests of a session to daemon.py, which sends
+    them to the cluster over its own warm session"""
+
+    def __init__(self, socketpath):
+        super().__init__()
+        self.socketpath = socketpath
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        header = {
+            "method": request.method,
+            "url": request.url,
+            "content_type": request.headers.get("Content-Type"),
+            "timeout": timeout,
+        }
+        if isinstance(timeout, tuple):
+            timeout = None if None in timeout else sum(timeout)
+        try:
+            reply, content = daemoncall(self.socketpath, header, body, timeout)
+        except socket.timeout as err:
+            raise requests.exceptions.Timeout(err, request=request)
+        except OSError as err:
+            raise requests.exceptions.ConnectionError(err, request=request)
+        if reply.get("error") == "timeout":
+            raise requests.exceptions.Timeout(reply["message"], request=request)
+        elif reply.get("error") is not None:
+            raise requests.exceptions.ConnectionError(reply["message"], request=request)
+        response = requests.models.Response()
+        response.status_code = reply["status"]
+        response.reason = reply["reason"]
+        if reply.get("content_type"):
+            response.headers["Content-Type"] = reply["content_type"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def getdaemonsession(uri, timeout=60):
+    """This function returns a session whose requests go through daemon.py
+    when it is running, otherwise None"""
+    if not os.path.exists(DAEMONSOCKET):
+        return None
+    try:
+        reply, _ = daemoncall(DAEMONSOCKET, {"method": "SESSION", "url": uri}, b"", timeout)
+    except (OSError, ValueError):
+        return None
+    if reply.get("status") != 200:
+        return None
+    api_session = requests.Session()
+    api_session.mount("https://", DaemonAdapter(DAEMONSOCKET))
+    print("\nUsing the daemon session to " + uri + ".\n")
+    return api_session, reply["user"]
+
+
 def getsession(uri):
     """This function gets a session and sets headers, returns session"""
+    api_session = getdaemonsession(uri)
+    if api_session is not None:
+        return api_session
+    cached = getcachedsession(uri)
+    if cached is not None:
+        return cached
+
     creds = "creds.json"
     if os.path.isfile(creds):
         with open(creds, "r", encoding="utf-8") as f:
@@ -53,9 +249,17 @@ def getsession(uri):
     headers = {"Content-Type": "application/json"}
     data = json.dumps({"username": user, "password": p, "services": ["platform"]})
     api_session = requests.Session()
+    start = perf_counter()
     response = api_session.post(
         uri + "/session/1/session", data=data, headers=headers, verify=False
     )
+    recordrequest(
+        "POST",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
     if response.status_code == 200 or response.status_code == 201:
         print("Session to " + uri + " established.\n")
         logging.info("API session created successfully by " + user + " at " + uri)
@@ -69,40 +273,482 @@ def getsession(uri):
         sys.exit()
     api_session.headers["referer"] = uri
     api_session.headers["X-CSRF-Token"] = api_session.cookies.get("isicsrf")
+    cachesession(uri, api_session, user, response)
     return api_session, user
 
 
+def endpointname(resourceurl):
+    """This function reduces a resource URL to its endpoint by replacing each
+    part after the API version that holds a digit, such as a snapshot,
+    lock or ChangeList ID, with {id}"""
+    parts = resourceurl.split("?")[0].strip("/").split("/")
+    return "/" + "/".join(
+        "{id}" if index > 1 and any(c.isdigit() for c in part) else part
+        for index, part in enumerate(parts)
+    )
+
+
+def recordrequest(method, resourceurl, status, nbytes, elapsed):
+    """This function adds one API request to the per endpoint metrics. status
+    is None when no response came back, elapsed is in seconds."""
+    key = (method, endpointname(resourceurl))
+    with METRICSLOCK:
+        if key not in METRICS:
+            METRICS[key] = {
+                "count": 0,
+                "errors": 0,
+                "bytes": 0,
+                "seconds": 0.0,
+                "buckets": [0] * len(LATENCYBUCKETS),
+                "latencies": deque(maxlen=10000),
+                "statuses": {},
+            }
+        entry = METRICS[key]
+        entry["count"] += 1
+        entry["bytes"] += nbytes
+        entry["seconds"] += elapsed
+        entry["latencies"].append(elapsed)
+        for index, bound in enumerate(LATENCYBUCKETS):
+            if elapsed <= bound:
+                entry["buckets"][index] += 1
+        if status is None or status >= 400:
+            entry["errors"] += 1
+        status = str(status) if status is not None else "none"
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def percentile(values, fraction):
+    """This function returns the nearest rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def metricsummary():
+    """This function summarizes the metrics of every endpoint, returns a list
+    of rows slowest p95 first"""
+    rows = []
+    with METRICSLOCK:
+        for (method, endpoint), entry in METRICS.items():
+            latencies = sorted(entry["latencies"])
+            rows.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "error_rate": round(entry["errors"] / entry["count"], 3),
+                    "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+                    "bytes": entry["bytes"],
+                }
+            )
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+
+def printmetrics():
+    """This function prints the per endpoint API request summary"""
+    rows = metricsummary()
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [columns] + [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    print("\nAPI requests by endpoint:\n")
+    for cell in cells:
+        print(" ".join(cell[i].rjust(widths[i]) for i in range(len(columns))))
+    print()
+
+
+def writemetrics(metricspath):
+    """This function atomically writes the metrics as a Prometheus textfile,
+    for the node_exporter textfile collector to pick up"""
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    families = {
+        "requests_total": ("counter", "PAPI requests by response status."),
+        "request_duration_seconds": ("histogram", "PAPI request latency."),
+        "request_latency_seconds": ("summary", "PAPI request latency quantiles."),
+        "response_bytes_total": ("counter", "PAPI response payload bytes."),
+        "request_errors_total": ("counter", "PAPI requests that failed or got a 4xx/5xx."),
+    }
+    samples = {family: [] for family in families}
+
+    def sample(family, suffix, labels, value):
+        samples[family].append(
+            "isi_tools_papi_" + family + suffix + "{" + labels + "} " + str(value)
+        )
+
+    with METRICSLOCK:
+        for (method, endpoint), entry in sorted(METRICS.items()):
+            labels = 'tool="' + tool + '",method="' + method + '",endpoint="' + endpoint + '"'
+            for status, count in sorted(entry["statuses"].items()):
+                sample("requests_total", "", labels + ',status="' + status + '"', count)
+            duration = "request_duration_seconds"
+            for bound, count in zip(LATENCYBUCKETS, entry["buckets"]):
+                sample(duration, "_bucket", labels + ',le="' + str(bound) + '"', count)
+            sample(duration, "_bucket", labels + ',le="+Inf"', entry["count"])
+            sample(duration, "_sum", labels, round(entry["seconds"], 6))
+            sample(duration, "_count", labels, entry["count"])
+            latencies = sorted(entry["latencies"])
+            for fraction in [0.5, 0.95, 0.99]:
+                quantile = round(percentile(latencies, fraction), 6)
+                sample(
+                    "request_latency_seconds",
+                    "",
+                    labels + ',quantile="' + str(fraction) + '"',
+                    quantile,
+                )
+            sample("request_latency_seconds", "_sum", labels, round(entry["seconds"], 6))
+            sample("request_latency_seconds", "_count", labels, entry["count"])
+            sample("response_bytes_total", "", labels, entry["bytes"])
+            sample("request_errors_total", "", labels, entry["errors"])
+    lines = []
+    for family, (kind, description) in families.items():
+        lines.append("# HELP isi_tools_papi_" + family + " " + description)
+        lines.append("# TYPE isi_tools_papi_" + family + " " + kind)
+        lines.extend(samples[family])
+    tmppath = metricspath + "." + str(os.getpid())
+    with open(tmppath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmppath, metricspath)
+
+
+def reportmetrics(metricspath, summary):
+    """This function prints and writes the metrics at the end of a run"""
+    if summary:
+        printmetrics()
+    if metricspath:
+        writemetrics(metricspath)
+
+
+def getcachedresponse(key):
+    """This function returns the cached response for key if it has not
+    expired, marking it as most recently used, or None"""
+    with RESPONSECACHELOCK:
+        entry = RESPONSECACHE.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= perf_counter():
+            del RESPONSECACHE[key]
+            return None
+        RESPONSECACHE.move_to_end(key)
+        return entry[1]
+
+
+def cacheresponse(key, response, ttl):
+    """This function keeps a response for ttl seconds, evicting the least
+    recently used responses beyond CACHESIZE"""
+    with RESPONSECACHELOCK:
+        RESPONSECACHE[key] = (perf_counter() + ttl, response)
+        RESPONSECACHE.move_to_end(key)
+        while len(RESPONSECACHE) > CACHESIZE:
+            RESPONSECACHE.popitem(last=False)
+
+
+def clearresponsecache(uri):
+    """This function drops every cached response from uri. Any write, such as
+    a lock change, ChangeList delete or new job, can change what the cached
+    endpoints return, so the menus never show a state older than our own
+    changes."""
+    with RESPONSECACHELOCK:
+        for key in [key for key in RESPONSECACHE if key[0] == uri]:
+            del RESPONSECACHE[key]
+
+
+def papirequest(api_session, method, uri, resourceurl, retries=3, **kwargs):
+    """This function sends a PAPI request over the session, which carries the
+    CSRF headers, retries transient failures and logs the outcome, returns
+    the response"""
+    # Only retry a POST when the cluster refused it before doing any work
+    if method == "POST":
+        retrycodes = [429, 503]
+    else:
+        retrycodes = [429, 500, 502, 503, 504]
+    cachekey = None
+    if method == "GET" and endpointname(resourceurl) in CACHETTLS:
+        cachekey = (uri, resourceurl, json.dumps(kwargs.get("params"), sort_keys=True))
+        cached = getcachedresponse(cachekey)
+        if cached is not None:
+            return cached
+    elif method != "GET":
+        clearresponsecache(uri)
+    fields = {"method": method, "endpoint": resourceurl}
+    for attempt in range(retries + 1):
+        # Every attempt is timed and recorded on its own, so backoff sleeps are
+        # not counted as latency and retried failures are counted as errors
+        start = perf_counter()
+        try:
+            response = api_session[0].request(
+                method, uri + resourceurl, verify=False, **kwargs
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            elapsed = perf_counter() - start
+            recordrequest(method, resourceurl, None, 0, elapsed)
+            if method == "POST" or attempt == retries:
+                fields["elapsed_ms"] = round(elapsed * 1000, 1)
+                logging.info(
+                    "%s request by %s at %s unsuccessful",
+                    method,
+                    api_session[1],
+                    uri + resourceurl,
+                    extra=fields,
+                )
+                raise
+            sleep(2**attempt)
+            continue
+        elapsed = perf_counter() - start
+        recordrequest(
+            method, resourceurl, response.status_code, len(response.content), elapsed
+        )
+        if response.status_code in retrycodes and attempt < retries:
+            sleep(2**attempt)
+            continue
+        break
+    fields["status"] = response.status_code
+    fields["bytes"] = len(response.content)
+    fields["elapsed_ms"] = round(elapsed * 1000, 1)
+    if response.status_code in [200, 201, 204]:
+        outcome = "successful"
+    elif response.status_code not in [200, 201, 204]:
+        outcome = "unsuccessful"
+    logging.info(
+        "%s request by %s at %s " + outcome,
+        method,
+        api_session[1],
+        uri + resourceurl,
+        extra=fields,
+    )
+    if cachekey is not None and response.status_code == 200:
+        cacheresponse(cachekey, response, CACHETTLS[endpointname(resourceurl)])
+    return response
+
+
+def getpages(api_session, uri, resourceurl, key, limit, **kwargs):
+    """This function yields the items of a PAPI collection one page at a
+    time, following the resume token until the cluster reports no more
+    pages. It prints an error and raises HTTPError if a page cannot be
+    fetched, so callers never mistake a truncated listing for a full one."""
+    params = dict(kwargs, limit=limit)
+    while params:
+        result = papirequest(api_session, "GET", uri, resourceurl, params=params)
+        if result.status_code == 200 or result.status_code == 201:
+            result = json.loads(result.content.decode(encoding="UTF-8"))
+            yield result[key]
+            if result.get("resume"):
+                params = {"resume": result["resume"]}
+            else:
+                params = None
+        elif result.status_code != 200 or result.status_code != 201:
+            print(
+                "\nIssue encountered with retrieving "
+                + key
+                + " at "
+                + uri
+                + resourceurl
+                + " Please try again.\n"
+            )
+            raise requests.exceptions.HTTPError(
+                "Retrieving " + key + " at " + uri + resourceurl + " failed",
+                response=result,
+            )
+
+
+def abandonexport(path, count, written, err):
+    """This function stops an export cut short by a failed page or a lost
+    connection. A file it had written is renamed to .partial so it cannot be
+    mistaken for a complete export, then the caller returns to the menu."""
+    logging.info("Export to " + path + " incomplete: " + str(err))
+    if isinstance(err, requests.exceptions.ConnectionError):
+        print("\nThe connection to the cluster failed: " + str(err))
+    if written and os.path.isfile(path):
+        os.replace(path, path + ".partial")
+        print(
+            "\nStopped after "
+            + str(count)
+            + " entries. The incomplete file was moved to "
+            + os.getcwd()
+            + "/"
+            + path
+            + ".partial\n"
+        )
+    elif not written or not os.path.isfile(path):
+        print("\nStopped after " + str(count) + " entries, nothing was written.\n")
+
+
 def displaymenu():
     """This function displays the ChangeList Tool menu options"""
     print("What would you like to do?")
     userinput = input(
         "[1] List Snapshots          [2] Create ChangeList Job\n"
         + "[3] List ChangeLists        [4] Display a ChangeList\n"
-        + "[5] Delete a ChangeList "
-        + "    [6] Quit Program\n\n"
+        + "[5] Delete a ChangeList     [6] Export a ChangeList\n"
+        + "[7] Roll up a ChangeList     [8] Quit Program\n\n"
     )
     return userinput
 
 
-def getsnapshots(api_session, uri):
-    """This function lists all Snapshots,then prompts to write to csv,
-    then prints the dataframe"""
+def openinventory():
+    """This function opens the local snapshot inventory shared by all
+    isi_tools, creating it and its indexes if needed, returns connection"""
+    conn = sqlite3.connect("snapshot_inventory.db")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            cluster TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            name TEXT,
+            path TEXT,
+            size INTEGER,
+            has_locks INTEGER,
+            created INTEGER,
+            expires INTEGER,
+            PRIMARY KEY (cluster, id)
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_name ON snapshots (cluster, name);
+        CREATE INDEX IF NOT EXISTS snapshots_path ON snapshots (cluster, path);
+        CREATE INDEX IF NOT EXISTS snapshots_has_locks ON snapshots (cluster, has_locks);
+        CREATE TABLE IF NOT EXISTS inventory (
+            cluster TEXT PRIMARY KEY,
+            reconciled REAL
+        );
+        """
+    )
+    return conn
+
+
+def refreshinventory(api_session, uri, reconcileafter=3600):
+    """This function brings the local snapshot inventory of uri up to date.
+    Normally only snapshots newer than the highest known ID are fetched,
+    newest first. When the inventory is empty or was last reconciled more
+    than reconcileafter seconds ago, the full list is fetched instead so
+    deleted snapshots are dropped and sizes and locks are refreshed.
+    Returns the number of snapshots fetched, or None on failure."""
     resourceurl = "/platform/1/snapshot/snapshots"
-    snapresult = api_session[0].get(uri + resourceurl, verify=False)
-    if snapresult.status_code == 200 or snapresult.status_code == 201:
-        logging.info("GET request by " + api_session[1] + " at " + uri + resourceurl + " successful")
-        snapresult = json.loads(snapresult.content.decode(encoding="UTF-8"))
-    elif snapresult.status_code != 200 or snapresult.status_code != 201:
-        print(
-            "\nIssue encountered with retrieving snapshots at "
-            + uri
-            + " Please try again.\n"
-        )
-        logging.info("GET request by " + api_session[1] + " at " + uri + resourceurl + " unsuccessful")
+    conn = openinventory()
+    try:
+        maxid = conn.execute(
+            "SELECT MAX(id) FROM snapshots WHERE cluster = ?", (uri,)
+        ).fetchone()[0]
+        reconciled = conn.execute(
+            "SELECT reconciled FROM inventory WHERE cluster = ?", (uri,)
+        ).fetchone()
+        now = datetime.datetime.now().timestamp()
+        full = reconciled is None or now - reconciled[0] >= reconcileafter
+        if full:
+            params = {"limit": 1000}
+        else:
+            params = {"limit": 1000, "sort": "id", "dir": "DESC"}
+        fetched = 0
+        seen = []
+        while params:
+            result = papirequest(api_session, "GET", uri, resourceurl, params=params)
+            if result.status_code != 200 and result.status_code != 201:
+                print(
+                    "\nIssue encountered with retrieving snapshots at "
+                    + uri
+                    + " Please try again.\n"
+                )
+                return None
+            result = json.loads(result.content.decode(encoding="UTF-8"))
+            snapshots = result["snapshots"]
+            if not full and maxid is not None:
+                snapshots = [snap for snap in snapshots if snap["id"] > maxid]
+            conn.executemany(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        uri,
+                        snap["id"],
+                        snap.get("name"),
+                        snap.get("path"),
+                        snap.get("size"),
+                        int(bool(snap.get("has_locks"))),
+                        snap.get("created"),
+                        snap.get("expires"),
+                    )
+                    for snap in snapshots
+                ],
+            )
+            fetched += len(snapshots)
+            seen.extend((snap["id"],) for snap in snapshots)
+            if result.get("resume") and len(snapshots) == len(result["snapshots"]):
+                params = {"resume": result["resume"]}
+            else:
+                params = None
+        if full:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (id INTEGER PRIMARY KEY)")
+            conn.execute("DELETE FROM seen")
+            conn.executemany("INSERT INTO seen VALUES (?)", seen)
+            conn.execute(
+                "DELETE FROM snapshots WHERE cluster = ? AND id NOT IN (SELECT id FROM seen)",
+                (uri,),
+            )
+            conn.execute("INSERT OR REPLACE INTO inventory VALUES (?, ?)", (uri, now))
+        conn.commit()
+        logging.info("Snapshot inventory of " + uri + " refreshed with " + str(fetched) + " snapshots")
+        return fetched
+    finally:
+        conn.close()
+
+
+def querysnapshots(uri, snapid=None, name=None, path=None, haslocks=None):
+    """This function looks up snapshots of uri in the local inventory. name
+    and path accept glob patterns (e.g. /ifs/data/*). Returns a list of
+    snapshots ordered by ID."""
+    clauses = ["cluster = ?"]
+    params = [uri]
+    if snapid is not None:
+        clauses.append("id = ?")
+        params.append(snapid)
+    if name is not None:
+        clauses.append("name GLOB ?")
+        params.append(name)
+    if path is not None:
+        clauses.append("path GLOB ?")
+        params.append(path)
+    if haslocks is not None:
+        clauses.append("has_locks = ?")
+        params.append(int(haslocks))
+    conn = openinventory()
+    try:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            "SELECT id, name, path, size, has_locks, created, expires FROM snapshots"
+            " WHERE " + " AND ".join(clauses) + " ORDER BY id",
+            params,
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(row, has_locks=bool(row["has_locks"])) for row in rows]
+
+
+def tablestring(rows, columns):
+    """This function formats a list of dicts as a right aligned plain text
+    table, so short list views do not need to import pandas"""
+    cells = [columns] + [[str(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    return "\n".join(
+        " ".join(cell[i].rjust(widths[i]) for i in range(len(columns)))
+        for cell in cells
+    )
+
+
+def writecsv(csvpath, rows, columns):
+    """This function writes a list of dicts to a csv file with a header row"""
+    with open(csvpath, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def getsnapshots(api_session, uri):
+    """This function lists all Snapshots from the local inventory after an
+    incremental refresh, then prompts to write to csv, then prints the
+    table"""
+    if refreshinventory(api_session, uri) is None:
         return 0
-    pd.set_option("display.max_rows", None)
-    df = pd.DataFrame(snapresult["snapshots"], columns=["id", "name", "path", "size"])
-    if df.empty:
+    snapshots = querysnapshots(uri)
+    columns = ["id", "name", "path", "size"]
+    if not snapshots:
         print("There are no snapshots!")
         return 0
     else:
@@ -114,12 +760,12 @@ def getsnapshots(api_session, uri):
         todaysdate = str(datetime.date.today())
         if csvinquiry == "y":
             csvpath = "snapshot_list_results_" + todaysdate + ".csv"
-            df.to_csv(csvpath, encoding="utf-8", index=False)
+            writecsv(csvpath, snapshots, columns)
             print("\n\nList of Snapshots:")
-            return print(df.to_string(index=False))
+            return print(tablestring(snapshots, columns))
         elif csvinquiry == "n":
             print("\n\nList of Snapshots:")
-            return print(df.to_string(index=False))
+            return print(tablestring(snapshots, columns))
         else:
             print(
                 "\nYou have entered a value other than (y) or (n) as a"
@@ -128,7 +774,90 @@ def getsnapshots(api_session, uri):
         return 0
 
 
-def createchangelist(api_session, uri):
+def waitforjob(api_session, uri, job_id, maxwait=None, maxfailures=5):
+    """This function polls a job until it reaches a terminal state, checking
+    quickly at first and then backing off up to 30 seconds between checks.
+    It prints phase and progress as they change and only gives up after
+    maxwait seconds if provided. A failed status check is treated like a
+    job still running, unless the job is not found or maxfailures checks
+    in a row fail. Returns the final state of the job, or None."""
+    failedstates = ["failed", "cancelled_user", "cancelled_system", "unknown"]
+    jobstatusurl = "/platform/7/job/jobs/" + job_id
+    started = datetime.datetime.now().timestamp()
+    delay = 0.5
+    lastreport = None
+    state = None
+    failures = 0
+    print("\nQuerying status of job ID " + job_id + "\n")
+    while True:
+        try:
+            result = papirequest(api_session, "GET", uri, jobstatusurl)
+            error = None
+        except requests.exceptions.RequestException as err:
+            result = None
+            error = str(err)
+        if result is not None and result.status_code == 404:
+            print("\nJob " + job_id + " was not found.\n")
+            return None
+        if result is not None and (result.status_code == 200 or result.status_code == 201):
+            failures = 0
+            job = result.json()["jobs"][0]
+            state = job["state"]
+            if state == "succeeded":
+                print("\nJob " + job_id + " has completed.\n")
+                return state
+            if state in failedstates:
+                print("\nJob " + job_id + " ended in state " + state + ".\n")
+                return state
+            report = (
+                "Job "
+                + job_id
+                + " is "
+                + state
+                + ", phase "
+                + str(job.get("current_phase", "?"))
+                + " of "
+                + str(job.get("total_phases", "?"))
+            )
+            if job.get("progress"):
+                report += ": " + job["progress"]
+            if report != lastreport:
+                print(report)
+                lastreport = report
+        elif result is None or (result.status_code != 200 and result.status_code != 201):
+            failures += 1
+            if error is None:
+                error = "status " + str(result.status_code)
+            logging.info(
+                "Status check of job " + job_id + " at " + uri + " failed (" + error + ")"
+            )
+            if failures >= maxfailures:
+                print(
+                    "\n Querying job status failed "
+                    + str(failures)
+                    + " times in a row. Please check job "
+                    + job_id
+                    + " status manually.\n"
+                )
+                return None
+            print("Querying job status failed, trying again...")
+        elapsed = datetime.datetime.now().timestamp() - started
+        if maxwait is not None and elapsed >= maxwait:
+            print("\nJob " + job_id + " is taking longer than usual.\n")
+            print(
+                "\nPlease check job "
+                + job_id
+                + " status manually at "
+                + str(uri)
+                + jobstatusurl
+                + ".\n"
+            )
+            return state
+        sleep(delay)
+        delay = min(delay * 2, 30)
+
+
+def createchangelist(api_session, uri, maxwait=None):
     """This function creates a ChangeList job, provides Job ID
     then queries status and notifies the user of completion"""
     oldsnapid = input("\nWhat is the ID of the older snapshot?  ")
@@ -147,49 +876,13 @@ def createchangelist(api_session, uri):
         "allow_dup": 4 == 1,
     }
     resourceurl = "/platform/7/job/jobs"
-    result = api_session[0].post(uri + resourceurl, verify=False, json=json_str)
+    result = papirequest(api_session, "POST", uri, resourceurl, json=json_str)
     if result.status_code == 200 or result.status_code == 201:
-        logging.info("POST request by " + api_session[1] + " at "+ uri + resourceurl + " successful")
         result = result.json()
         job_id = str(result.get("id"))
         print("\nJob ID is " + job_id + "\n")
-        sent_status = 0
-        count = 0
-        while sent_status != 1:
-            print("\nQuerying status of job ID " + job_id + "\n")
-            jobstatusurl = "/platform/7/job/jobs/" + job_id
-            result = api_session[0].get(uri + jobstatusurl, verify=False)
-            if result.status_code == 200 or result.status_code == 201:
-                logging.info("GET request by " + api_session[1] + " at "+ uri + jobstatusurl + " successful")
-                result = result.json()
-                if result["jobs"][0]["state"] == "succeeded":
-                    sent_status = 1
-                    print("\nJob " + job_id + " has completed.\n")
-                else:
-                    if count == 10:
-                        print("\nJob " + job_id + " is taking longer than usual.\n")
-                        print(
-                            "\nPlease check job "
-                            + job_id
-                            + " status manually at "
-                            + str(uri)
-                            + jobstatusurl
-                            + ".\n"
-                        )
-                        break
-                    else:
-                        print(
-                            "\nJob "
-                            + job_id
-                            + " is still running. Will query again in 10 seconds...\n"
-                        )
-                        count += 1
-                        sleep(10)
-            elif result.status_code != 200 or result.status_code != 201:
-                logging.info("GET request by " + api_session[1] + " at " + uri + jobstatusurl + " unsuccessful")
-                print("\n Querying job status failed.")
+        return waitforjob(api_session, uri, job_id, maxwait)
     elif result.status_code != 200 or result.status_code != 201:
-        logging.info("POST request by " + api_session[1] + " at " + uri + resourceurl + " unsuccessful")
         print("\nJob Creation Failed. Try again")
         return
 
@@ -197,24 +890,21 @@ def createchangelist(api_session, uri):
 def listchangelists(api_session, uri):
     """This function list all ChangeLists"""
     resourceurl = "/platform/3/snapshot/changelists"
-    result = api_session[0].get(uri + resourceurl, verify=False)
+    result = papirequest(api_session, "GET", uri, resourceurl)
     if result.status_code == 200 or result.status_code == 201:
-        logging.info("GET request by " + api_session[1] + " at "+ uri + resourceurl + " successful")
         result = result.json()
         print("List of ChangeLists:\n")
-        pd.set_option("display.max_rows", None)
-        df = pd.DataFrame(
-            result["changelists"], columns=["id", "job_id", "root_path", "num_entries"]
-        )
-        if df.empty:
+        changelists = result["changelists"]
+        if not changelists:
             print("There are no changelists!\n\n")
             return 0
         else:
-            print(df.to_string(index=False))
+            print(
+                tablestring(changelists, ["id", "job_id", "root_path", "num_entries"])
+            )
             print("\n")
             return
     elif result.status_code != 200 or result.status_code != 201:
-        logging.info("GET request at by " + api_session[1] + " at " + uri + resourceurl + " successful")
         print("\nGetting list of Changelists failed.")
         return
 
@@ -222,6 +912,8 @@ def listchangelists(api_session, uri):
 def getchangelist(api_session, uri):
     """This function gets the ChangeList ID the user specifies,
     then prompts to write output to csv, then prints the dataframe."""
+    import pandas as pd
+
     changelistid = input("\nWhat ChangeList would you like to see? [Enter ID]:  ")
     csvinquiry = input(
         "\nWould you also like a csv file of ChangeList ID: "
@@ -231,9 +923,8 @@ def getchangelist(api_session, uri):
         + " ? (y/n): \n"
     )
     resourceurl = "/platform/10/snapshot/changelists/" + changelistid + "/entries"
-    result = api_session[0].get(uri + resourceurl, verify=False)
+    result = papirequest(api_session, "GET", uri, resourceurl)
     if result.status_code == 200 or result.status_code == 201:
-        logging.info("GET request at by " + api_session[1] + " at " + uri + resourceurl + " successful")
         result = result.json()
         entries = result["entries"]
         pd.set_option("display.max_rows", None)
@@ -254,40 +945,317 @@ def getchangelist(api_session, uri):
             )
         return
     elif result.status_code != 200 or result.status_code != 201:
-        logging.info("GET request at by " + api_session[1] + " at " + uri + resourceurl + " unsuccessful")
         print("Getting Changelist ID" + changelistid + " failed!")
         return
 
 
+def exportchangelist(api_session, uri, limit=1000):
+    """This function streams a ChangeList to csv one page at a time, so memory
+    use stays flat no matter how many entries the ChangeList has."""
+    import pandas as pd
+
+    changelistid = input("\nWhat ChangeList would you like to export? [Enter ID]:  ")
+    resourceurl = "/platform/10/snapshot/changelists/" + changelistid + "/entries"
+    csvpath = "changelist_id_" + changelistid + "_results.csv"
+    print("\nExporting ChangeList ID " + changelistid + " to " + os.getcwd() + "/" + csvpath + "\n")
+    count = 0
+    try:
+        for entries in getpages(api_session, uri, resourceurl, "entries", limit):
+            df = pd.DataFrame(
+                entries, columns=["path", "size", "physical_size", "change_types"]
+            )
+            df.to_csv(
+                csvpath,
+                encoding="utf-8",
+                index=False,
+                mode="w" if count == 0 else "a",
+                header=count == 0,
+            )
+            count += len(df)
+            print(str(count) + " entries written...", end="\r", flush=True)
+    except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as err:
+        abandonexport(csvpath, count, count > 0, err)
+        return None
+    print("\n\n" + str(count) + " entries of ChangeList ID " + changelistid + " exported.")
+    return count
+
+
+def rollupchangelist(api_session, uri, depth=2, limit=1000):
+    """This function totals entries, size and physical_size of a ChangeList by
+    directory prefix and change type. Each page is grouped as it arrives and
+    merged into the running totals, so the entries are never all in memory."""
+    import pandas as pd
+
+    changelistid = input("\nWhat ChangeList would you like to roll up? [Enter ID]:  ")
+    resourceurl = "/platform/10/snapshot/changelists/" + changelistid + "/entries"
+    csvpath = "changelist_id_" + changelistid + "_rollup_depth_" + str(depth) + ".csv"
+    totals = None
+    count = 0
+    try:
+        for entries in getpages(api_session, uri, resourceurl, "entries", limit):
+            df = pd.DataFrame(
+                entries, columns=["path", "size", "physical_size", "change_types"]
+            )
+            # The parent directory, cut down to depth components below /
+            parents = df["path"].str.rsplit("/", n=1).str[0]
+            components = parents.str.split("/", n=depth + 1).str[: depth + 1]
+            df["directory"] = components.str.join("/")
+            df["directory"] = df["directory"].mask(df["directory"] == "", "/")
+            df["change_types"] = df["change_types"].str.join(",").fillna("")
+            page = df.groupby(["directory", "change_types"]).agg(
+                entries=("path", "size"),
+                size=("size", "sum"),
+                physical_size=("physical_size", "sum"),
+            )
+            if totals is None:
+                totals = page
+            elif totals is not None:
+                totals = page.add(totals, fill_value=0).astype("int64")
+            count += len(df)
+            print(str(count) + " entries rolled up...", end="\r", flush=True)
+    except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as err:
+        abandonexport(csvpath, count, False, err)
+        return None
+    if totals is None:
+        print("\nNo entries found for ChangeList ID " + changelistid + ".\n")
+        return None
+    totals = totals.sort_values("size", ascending=False).reset_index()
+    bydirectory = (
+        totals.groupby("directory")[["entries", "size", "physical_size"]]
+        .sum()
+        .sort_values("size", ascending=False)
+        .reset_index()
+    )
+    pd.set_option("display.max_rows", None)
+    print("\n\nChanges by directory at depth " + str(depth) + ":\n")
+    print(bydirectory.to_string(index=False))
+    print("\n\nChanges by directory and change type:\n")
+    print(totals.to_string(index=False))
+    totals.to_csv(csvpath, encoding="utf-8", index=False)
+    print(
+        "\n"
+        + str(count)
+        + " entries of ChangeList ID "
+        + changelistid
+        + " rolled up to "
+        + os.getcwd()
+        + "/"
+        + csvpath
+    )
+    return totals
+
+
+def exportchangelistparquet(api_session, uri, limit=1000, rowgroup=100000):
+    """This function streams a ChangeList to a Parquet file in row groups of
+    rowgroup entries. Each path is split into a dictionary encoded directory
+    column and a name column, sizes are stored as int64 and every column is
+    zstd compressed. Needs pyarrow."""
+    import pandas as pd
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("\nParquet export needs pyarrow. Run 'pip install pyarrow' and try again.\n")
+        return None
+    changelistid = input("\nWhat ChangeList would you like to export? [Enter ID]:  ")
+    resourceurl = "/platform/10/snapshot/changelists/" + changelistid + "/entries"
+    parquetpath = "changelist_id_" + changelistid + "_results.parquet"
+    print(
+        "\nExporting ChangeList ID "
+        + changelistid
+        + " to "
+        + os.getcwd()
+        + "/"
+        + parquetpath
+        + "\n"
+    )
+    schema = pa.schema(
+        [
+            ("directory", pa.dictionary(pa.int32(), pa.string())),
+            ("name", pa.string()),
+            ("size", pa.int64()),
+            ("physical_size", pa.int64()),
+            ("change_types", pa.list_(pa.string())),
+        ]
+    )
+    writer = pq.ParquetWriter(parquetpath, schema, compression="zstd")
+    pending = []
+    count = 0
+
+    def writerowgroup():
+        frame = pd.concat(pending, ignore_index=True)
+        pending.clear()
+        table = pa.table(
+            {
+                "directory": pa.array(frame["directory"], pa.string()).dictionary_encode(),
+                "name": pa.array(frame["name"], pa.string()),
+                "size": pa.array(frame["size"], pa.int64()),
+                "physical_size": pa.array(frame["physical_size"], pa.int64()),
+                "change_types": pa.array(frame["change_types"], pa.list_(pa.string())),
+            },
+            schema=schema,
+        )
+        writer.write_table(table, row_group_size=len(frame))
+
+    try:
+        for entries in getpages(api_session, uri, resourceurl, "entries", limit):
+            df = pd.DataFrame(
+                entries, columns=["path", "size", "physical_size", "change_types"]
+            )
+            parts = df["path"].str.rsplit("/", n=1)
+            df["directory"] = parts.str[0]
+            df["name"] = parts.str[-1]
+            pending.append(df)
+            count += len(df)
+            if sum(len(frame) for frame in pending) >= rowgroup:
+                writerowgroup()
+            print(str(count) + " entries written...", end="\r", flush=True)
+        if pending:
+            writerowgroup()
+    except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as err:
+        writer.close()
+        abandonexport(parquetpath, count, True, err)
+        return None
+    finally:
+        writer.close()
+    print("\n\n" + str(count) + " entries of ChangeList ID " + changelistid + " exported.")
+    return count
+
+
 def deletechangelist(api_session, uri):
     """This function deletes a ChangeList ID specified by the user."""
     changelistid = input("What ChangeList ID would you like to delete?\n")
     resourceurl = "/platform/1/snapshot/changelists/" + changelistid
-    result = api_session[0].delete(uri + resourceurl, verify=False)
+    result = papirequest(api_session, "DELETE", uri, resourceurl)
     if result.status_code == 204:
         print("\nChangelist successfully deleted.")
-        logging.info("DELETE request by " + api_session[1] + " at " + uri + resourceurl + " successful")
     elif result.status_code != 204:
-        logging.info("DELETE request by " + api_session[1] + " at " + uri + resourceurl + " unsuccessful")
         print("\nOops! Something went wrong. Try again!\n")
         print("\nResult status code is: " + str(result.status_code))
     return result
 
 
+class JsonFormatter(logging.Formatter):
+    """This formatter writes each log record as a JSON line, with the method,
+    endpoint, status, bytes and elapsed_ms of PAPI requests when present"""
+
+    fields = ["method", "endpoint", "status", "bytes", "elapsed_ms"]
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class LockedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """This handler rotates a log shared by several processes. Every record is
+    written under an flock on <log>.lock, so only one process rolls the log
+    over, and a process that finds the log was rolled over by another one
+    reopens it before writing."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = open(self.baseFilename + ".lock", "a")
+
+    def reopenifrotated(self):
+        """This function reopens the log when it is no longer the file this
+        handler has open"""
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or not os.path.samestat(current, opened):
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            self.reopenifrotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lockfile.close()
+
+
+def setuplogging():
+    """This function queues log records to a background thread that writes
+    them to isi_tools.log as JSON lines, rotating it at 10 MB and keeping
+    five old logs, so logging never blocks a request"""
+    logqueue = queue.Queue()
+    handler = LockedRotatingFileHandler(
+        "isi_tools.log", maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(logqueue, handler)
+    listener.start()
+    # Write out whatever is still queued when the tool exits
+    atexit.register(listener.stop)
+    queuehandler = logging.handlers.QueueHandler(logqueue)
+    queuehandler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(handlers=[queuehandler], level=logging.INFO)
+    return listener
+
+
 def main():
     """This function is the main function that runs the Changelist Tool"""
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     parser = argparse.ArgumentParser(description="Menu driven changelist tool")
     parser.add_argument("ip", help="Enter a valid IP address")
+    parser.add_argument(
+        "-m",
+        "--maxwait",
+        type=int,
+        help="Stop waiting on a ChangeList job after this many seconds "
+        + "(default: wait until the job finishes)",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="File format of ChangeList exports (default csv). parquet needs pyarrow",
+    )
+    parser.add_argument(
+        "-d",
+        "--depth",
+        type=int,
+        default=2,
+        help="Number of directory levels below / to roll a ChangeList up to (default 2)",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write per endpoint API request counts, latency, sizes and errors to "
+        + "this Prometheus textfile (e.g. /var/lib/node_exporter/isi_tools.prom)",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print per endpoint API request counts, latency percentiles, sizes and "
+        + "error rates at the end of the run",
+    )
     args = parser.parse_args()
     ip = args.ip
+    if args.depth < 1:
+        print("\nDepth must be 1 or greater.\n")
+        sys.exit()
 
 
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        filename="isi_tools.log",
-        level=logging.INFO
-    )
+    setuplogging()
+    atexit.register(reportmetrics, args.metrics, args.summary)
 
 
     validateinput(ip)
@@ -306,7 +1274,7 @@ def main():
             getsnapshots(api_session, uri)
             print("\n\n")
         elif choice == "2":
-            createchangelist(api_session, uri)
+            createchangelist(api_session, uri, args.maxwait)
             print("\n\n")
         elif choice == "3":
             print("\n\n")
@@ -317,10 +1285,19 @@ def main():
         elif choice == "5":
             deletechangelist(api_session, uri)
             print("\n\n")
+        elif choice == "6" and args.format == "parquet":
+            exportchangelistparquet(api_session, uri)
+            print("\n\n")
         elif choice == "6":
+            exportchangelist(api_session, uri)
+            print("\n\n")
+        elif choice == "7":
+            rollupchangelist(api_session, uri, args.depth)
+            print("\n\n")
+        elif choice == "8":
             sentinel = 1
             break
-        elif choice < "1" or choice > "6":
+        elif choice < "1" or choice > "8":
             print("\nERROR: Input is not a valid option. Please re-enter!\n")
 
 
@@ -1,13 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import sleep, perf_counter
 from getpass import getpass
 import argparse
+from collections import deque
 import logging
+import logging.handlers
+import fcntl
+import queue
+import atexit
 import base64
 import os
+import io
+import socket
 import sys
+import datetime
+import threading
+import fnmatch
+import re
 import json
+import math
 import urllib3
 import requests
-import pandas as pd
+
+# Unix socket of daemon.py, which holds warm cluster sessions when running
+DAEMONSOCKET = os.environ.get("ISI_TOOLS_SOCKET", "isi_tools.sock")
+# Upper bounds in seconds of the PAPI request latency histogram buckets
+LATENCYBUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Per endpoint request metrics, keyed by method and endpoint
+METRICS = {}
+METRICSLOCK = threading.Lock()
+CACHELOCK = threading.Lock()
 
 
 def printbanner():
@@ -23,8 +45,97 @@ Welcome to
     )
 
 
-def getsession(uri):
-    """This function gets a session and sets headers, returns session"""
+def readsessioncache():
+    """This function reads the session cache shared by all isi_tools, returns
+    a dict of cached sessions keyed by cluster uri"""
+    cache = "session_cache.json"
+    if os.path.isfile(cache):
+        try:
+            with open(cache, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    return {}
+
+
+def writesessioncache(sessions):
+    """This function atomically writes the session cache, readable only by
+    the current user"""
+    cache = "session_cache.json"
+    tmpcache = cache + "." + str(os.getpid()) + "." + str(threading.get_ident())
+    fd = os.open(tmpcache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(sessions, f, indent=4)
+    os.replace(tmpcache, cache)
+
+
+def resumesession(uri, entry, timeout=None):
+    """This function builds a session from the isisessid/isicsrf cookies of an
+    existing session, returns the session if uri accepts them or None"""
+    api_session = requests.Session()
+    api_session.cookies.set("isisessid", entry["isisessid"])
+    api_session.cookies.set("isicsrf", entry["isicsrf"])
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = entry["isicsrf"]
+    start = perf_counter()
+    response = api_session.get(
+        uri + "/session/1/session", verify=False, timeout=timeout
+    )
+    recordrequest(
+        "GET",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code != 200:
+        logging.info("Existing API session of " + entry["username"] + " at " + uri + " rejected")
+        return None
+    logging.info("Existing API session reused by " + entry["username"] + " at " + uri)
+    return api_session
+
+
+def getcachedsession(uri, timeout=None):
+    """This function reuses a cached session for uri if it has not expired and
+    the cluster still accepts it, returns session or None"""
+    entry = readsessioncache().get(uri)
+    now = datetime.datetime.now().timestamp()
+    if entry is None or entry["expires"] <= now:
+        return None
+    api_session = resumesession(uri, entry, timeout)
+    if api_session is None:
+        return None
+    entry["expires"] = min(now + entry["timeout_inactive"], entry["expires_absolute"])
+    with CACHELOCK:
+        sessions = readsessioncache()
+        sessions[uri] = entry
+        writesessioncache(sessions)
+    return api_session, entry["username"]
+
+
+def cachesession(uri, api_session, user, response):
+    """This function stores the isisessid/isicsrf cookies of a new session with
+    their expiry so later runs can reuse them"""
+    timeouts = json.loads(response.content.decode(encoding="UTF-8") or "{}")
+    now = datetime.datetime.now().timestamp()
+    inactive = timeouts.get("timeout_inactive", 900)
+    absolute = now + timeouts.get("timeout_absolute", 14400)
+    with CACHELOCK:
+        sessions = readsessioncache()
+        sessions[uri] = {
+            "username": user,
+            "isisessid": api_session.cookies.get("isisessid"),
+            "isicsrf": api_session.cookies.get("isicsrf"),
+            "timeout_inactive": inactive,
+            "expires_absolute": absolute,
+            "expires": min(now + inactive, absolute),
+        }
+        writesessioncache(sessions)
+
+
+def getcreds():
+    """This function reads credentials from creds.json or prompts for them,
+    returns user and password"""
     creds = "creds.json"
     if os.path.isfile(creds):
         with open(creds, "r", encoding="utf-8") as f:
@@ -35,28 +146,424 @@ def getsession(uri):
         user = input("Please provide your user name? \n")
         print("\nPlease provide the password for your user account...\n")
         p = getpass()
+    return user, p
 
-    print("\n\nAttempting session to " + uri + " ...\n")
+
+def login(uri, user, p, timeout=None):
+    """This function creates an API session, returns the session or None"""
     headers = {"Content-Type": "application/json"}
     data = json.dumps({"username": user, "password": p, "services": ["platform"]})
     api_session = requests.Session()
+    start = perf_counter()
     response = api_session.post(
-        uri + "/session/1/session", data=data, headers=headers, verify=False
+        uri + "/session/1/session",
+        data=data,
+        headers=headers,
+        verify=False,
+        timeout=timeout,
+    )
+    recordrequest(
+        "POST",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
     )
     if response.status_code == 200 or response.status_code == 201:
-        print("Session to " + uri + " established.\n")
         logging.info("API session created successfully by " + user + " at " + uri)
     elif response.status_code != 200 or response.status_code != 201:
+        logging.info("Creation of API session by " + user + " at " + uri + " unsuccessful")
+        return None
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = api_session.cookies.get("isicsrf")
+    cachesession(uri, api_session, user, response)
+    return api_session
+
+
+def daemoncall(socketpath, header, body=b"", timeout=None):
+    """This function sends one request to daemon.py over its Unix socket,
+    returns the reply header and body"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socketpath)
+        header = dict(header, length=len(body))
+        client.sendall(json.dumps(header).encode("utf-8") + b"\n" + body)
+        with client.makefile("rb") as f:
+            try:
+                reply = json.loads(f.readline())
+                length = reply["length"]
+            except (ValueError, KeyError) as err:
+                raise requests.exceptions.ConnectionError(
+                    "daemon.py sent no valid reply: " + str(err)
+                )
+            return reply, f.read(length)
+    finally:
+        client.close()
+
+
+class DaemonAdapter(requests.adapters.BaseAdapter):
+    """This adapter hands the requests of a session to daemon.py, which sends
+    them to the cluster over its own warm session"""
+
+    def __init__(self, socketpath):
+        super().__init__()
+        self.socketpath = socketpath
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        header = {
+            "method": request.method,
+            "url": request.url,
+            "content_type": request.headers.get("Content-Type"),
+            "timeout": timeout,
+        }
+        if isinstance(timeout, tuple):
+            timeout = None if None in timeout else sum(timeout)
+        try:
+            reply, content = daemoncall(self.socketpath, header, body, timeout)
+        except socket.timeout as err:
+            raise requests.exceptions.Timeout(err, request=request)
+        except OSError as err:
+            raise requests.exceptions.ConnectionError(err, request=request)
+        if reply.get("error") == "timeout":
+            raise requests.exceptions.Timeout(reply["message"], request=request)
+        elif reply.get("error") is not None:
+            raise requests.exceptions.ConnectionError(reply["message"], request=request)
+        response = requests.models.Response()
+        response.status_code = reply["status"]
+        response.reason = reply["reason"]
+        if reply.get("content_type"):
+            response.headers["Content-Type"] = reply["content_type"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def getdaemonsession(uri, timeout=60):
+    """This function returns a session whose requests go through daemon.py
+    when it is running, otherwise None"""
+    if not os.path.exists(DAEMONSOCKET):
+        return None
+    try:
+        reply, _ = daemoncall(DAEMONSOCKET, {"method": "SESSION", "url": uri}, b"", timeout)
+    except (OSError, ValueError):
+        return None
+    if reply.get("status") != 200:
+        return None
+    api_session = requests.Session()
+    api_session.mount("https://", DaemonAdapter(DAEMONSOCKET))
+    print("\nUsing the daemon session to " + uri + ".\n")
+    return api_session, reply["user"]
+
+
+def newsessionmanager():
+    """This function creates a session manager for one cluster. It holds the
+    credentials (read at most once), the cookies of the first session
+    established on the cluster and one warm session per node."""
+    return {"lock": threading.Lock(), "creds": None, "cluster": None, "nodes": {}}
+
+
+def getnodesession(manager, uri, timeout=None):
+    """This function returns the warm session for a node, creating it on first
+    use by reusing the cluster session cookies, then the session cache, and
+    only then logging in. Returns session or None."""
+    with manager["lock"]:
+        if uri in manager["nodes"]:
+            return manager["nodes"][uri]
+        cluster = manager["cluster"]
+    api_session = getdaemonsession(uri, timeout)
+    if api_session is not None:
+        with manager["lock"]:
+            manager["nodes"][uri] = api_session
+        return api_session
+    if cluster is not None:
+        session = resumesession(uri, cluster, timeout)
+        if session is not None:
+            api_session = (session, cluster["username"])
+    if api_session is None:
+        api_session = getcachedsession(uri, timeout)
+    if api_session is None:
+        with manager["lock"]:
+            if manager["creds"] is None:
+                manager["creds"] = getcreds()
+            user, p = manager["creds"]
+        session = login(uri, user, p, timeout)
+        if session is None:
+            return None
+        api_session = (session, user)
+    with manager["lock"]:
+        manager["nodes"][uri] = api_session
+        if manager["cluster"] is None:
+            manager["cluster"] = {
+                "username": api_session[1],
+                "isisessid": api_session[0].cookies.get("isisessid"),
+                "isicsrf": api_session[0].cookies.get("isicsrf"),
+            }
+    return api_session
+
+
+def dropnodesession(manager, uri):
+    """This function forgets the warm session of a node that the cluster no
+    longer accepts, along with the cluster cookies if the node shared them,
+    so the next use of the node logs in again"""
+    with manager["lock"]:
+        api_session = manager["nodes"].pop(uri, None)
+        cluster = manager["cluster"]
+        if (
+            api_session is not None
+            and cluster is not None
+            and api_session[0].cookies.get("isisessid") == cluster["isisessid"]
+        ):
+            manager["cluster"] = None
+
+
+def trysession(uri, manager):
+    """This function gets a session for a node from the session manager,
+    returns session or None after reporting that it failed, so callers
+    decide whether to carry on"""
+    print("\n\nAttempting session to " + uri + " ...\n")
+    try:
+        api_session = getnodesession(manager, uri)
+    except requests.exceptions.RequestException as err:
+        logging.info("Creation of API session at " + uri + " unsuccessful: " + str(err))
+        api_session = None
+    if api_session is not None:
+        print("Session to " + uri + " established.\n")
+    elif api_session is None:
         print(
             "\nSession to "
             + uri
             + " not established. Please check your password, user name, or IP and try again.\n"
         )
-        logging.info("Creation of API session by " + user + " at " + uri + " unsuccessful")
-        sys.exit()
-    api_session.headers["referer"] = uri
-    api_session.headers["X-CSRF-Token"] = api_session.cookies.get("isicsrf")
-    return api_session, user
+    return api_session
+
+
+def endpointname(resourceurl):
+    """This function reduces a resource URL to its endpoint by replacing each
+    part after the API version that holds a digit, such as a snapshot,
+    lock or ChangeList ID, with {id}"""
+    parts = resourceurl.split("?")[0].strip("/").split("/")
+    return "/" + "/".join(
+        "{id}" if index > 1 and any(c.isdigit() for c in part) else part
+        for index, part in enumerate(parts)
+    )
+
+
+def recordrequest(method, resourceurl, status, nbytes, elapsed):
+    """This function adds one API request to the per endpoint metrics. status
+    is None when no response came back, elapsed is in seconds."""
+    key = (method, endpointname(resourceurl))
+    with METRICSLOCK:
+        if key not in METRICS:
+            METRICS[key] = {
+                "count": 0,
+                "errors": 0,
+                "bytes": 0,
+                "seconds": 0.0,
+                "buckets": [0] * len(LATENCYBUCKETS),
+                "latencies": deque(maxlen=10000),
+                "statuses": {},
+            }
+        entry = METRICS[key]
+        entry["count"] += 1
+        entry["bytes"] += nbytes
+        entry["seconds"] += elapsed
+        entry["latencies"].append(elapsed)
+        for index, bound in enumerate(LATENCYBUCKETS):
+            if elapsed <= bound:
+                entry["buckets"][index] += 1
+        if status is None or status >= 400:
+            entry["errors"] += 1
+        status = str(status) if status is not None else "none"
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def percentile(values, fraction):
+    """This function returns the nearest rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def metricsummary():
+    """This function summarizes the metrics of every endpoint, returns a list
+    of rows slowest p95 first"""
+    rows = []
+    with METRICSLOCK:
+        for (method, endpoint), entry in METRICS.items():
+            latencies = sorted(entry["latencies"])
+            rows.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "error_rate": round(entry["errors"] / entry["count"], 3),
+                    "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+                    "bytes": entry["bytes"],
+                }
+            )
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+
+def printmetrics():
+    """This function prints the per endpoint API request summary"""
+    rows = metricsummary()
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [columns] + [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    print("\nAPI requests by endpoint:\n")
+    for cell in cells:
+        print(" ".join(cell[i].rjust(widths[i]) for i in range(len(columns))))
+    print()
+
+
+def writemetrics(metricspath):
+    """This function atomically writes the metrics as a Prometheus textfile,
+    for the node_exporter textfile collector to pick up"""
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    families = {
+        "requests_total": ("counter", "PAPI requests by response status."),
+        "request_duration_seconds": ("histogram", "PAPI request latency."),
+        "request_latency_seconds": ("summary", "PAPI request latency quantiles."),
+        "response_bytes_total": ("counter", "PAPI response payload bytes."),
+        "request_errors_total": ("counter", "PAPI requests that failed or got a 4xx/5xx."),
+    }
+    samples = {family: [] for family in families}
+
+    def sample(family, suffix, labels, value):
+        samples[family].append(
+            "isi_tools_papi_" + family + suffix + "{" + labels + "} " + str(value)
+        )
+
+    with METRICSLOCK:
+        for (method, endpoint), entry in sorted(METRICS.items()):
+            labels = 'tool="' + tool + '",method="' + method + '",endpoint="' + endpoint + '"'
+            for status, count in sorted(entry["statuses"].items()):
+                sample("requests_total", "", labels + ',status="' + status + '"', count)
+            duration = "request_duration_seconds"
+            for bound, count in zip(LATENCYBUCKETS, entry["buckets"]):
+                sample(duration, "_bucket", labels + ',le="' + str(bound) + '"', count)
+            sample(duration, "_bucket", labels + ',le="+Inf"', entry["count"])
+            sample(duration, "_sum", labels, round(entry["seconds"], 6))
+            sample(duration, "_count", labels, entry["count"])
+            latencies = sorted(entry["latencies"])
+            for fraction in [0.5, 0.95, 0.99]:
+                quantile = round(percentile(latencies, fraction), 6)
+                sample(
+                    "request_latency_seconds",
+                    "",
+                    labels + ',quantile="' + str(fraction) + '"',
+                    quantile,
+                )
+            sample("request_latency_seconds", "_sum", labels, round(entry["seconds"], 6))
+            sample("request_latency_seconds", "_count", labels, entry["count"])
+            sample("response_bytes_total", "", labels, entry["bytes"])
+            sample("request_errors_total", "", labels, entry["errors"])
+    lines = []
+    for family, (kind, description) in families.items():
+        lines.append("# HELP isi_tools_papi_" + family + " " + description)
+        lines.append("# TYPE isi_tools_papi_" + family + " " + kind)
+        lines.extend(samples[family])
+    tmppath = metricspath + "." + str(os.getpid())
+    with open(tmppath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmppath, metricspath)
+
+
+def reportmetrics(metricspath, summary):
+    """This function prints and writes the metrics at the end of a run"""
+    if summary:
+        printmetrics()
+    if metricspath:
+        writemetrics(metricspath)
+
+
+def papirequest(api_session, method, uri, resourceurl, retries=3, **kwargs):
+    """This function sends a PAPI request over the session, which carries the
+    CSRF headers, retries transient failures and logs the outcome, returns
+    the response"""
+    # Only retry a POST when the cluster refused it before doing any work
+    if method == "POST":
+        retrycodes = [429, 503]
+    else:
+        retrycodes = [429, 500, 502, 503, 504]
+    fields = {"method": method, "endpoint": resourceurl}
+    for attempt in range(retries + 1):
+        # Every attempt is timed and recorded on its own, so backoff sleeps are
+        # not counted as latency and retried failures are counted as errors
+        start = perf_counter()
+        try:
+            response = api_session[0].request(
+                method, uri + resourceurl, verify=False, **kwargs
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            elapsed = perf_counter() - start
+            recordrequest(method, resourceurl, None, 0, elapsed)
+            if method == "POST" or attempt == retries:
+                fields["elapsed_ms"] = round(elapsed * 1000, 1)
+                logging.info(
+                    "%s request by %s at %s unsuccessful",
+                    method,
+                    api_session[1],
+                    uri + resourceurl,
+                    extra=fields,
+                )
+                raise
+            sleep(2**attempt)
+            continue
+        elapsed = perf_counter() - start
+        recordrequest(
+            method, resourceurl, response.status_code, len(response.content), elapsed
+        )
+        if response.status_code in retrycodes and attempt < retries:
+            sleep(2**attempt)
+            continue
+        break
+    fields["status"] = response.status_code
+    fields["bytes"] = len(response.content)
+    fields["elapsed_ms"] = round(elapsed * 1000, 1)
+    if response.status_code in [200, 201, 204]:
+        outcome = "successful"
+    elif response.status_code not in [200, 201, 204]:
+        outcome = "unsuccessful"
+    logging.info(
+        "%s request by %s at %s " + outcome,
+        method,
+        api_session[1],
+        uri + resourceurl,
+        extra=fields,
+    )
+    return response
+
+
+def connectcluster(manager, iplist, port, timeout):
+    """This function establishes the one cluster session that every node
+    reuses, trying the nodes in order until one answers"""
+    for ip in iplist:
+        uri = "https://" + str(ip) + ":" + str(port)
+        print("\n\nAttempting session to " + uri + " ...\n")
+        try:
+            if getnodesession(manager, uri, timeout) is not None:
+                print("Session to " + uri + " established.\n")
+                return
+        except requests.exceptions.RequestException as err:
+            logging.info("Creation of API session at " + uri + " unsuccessful: " + str(err))
+    print(
+        "\nSession to the cluster not established. Please check your password,"
+        " user name, or IPs and try again.\n"
+    )
+    sys.exit()
 
 
 def getiplist(ipinput):
@@ -72,57 +579,598 @@ def getiplist(ipinput):
     return result
 
 
-def getfileid(api_session, uri, ip, filename):
-    """This function gets a list of open files"""
-    print("\nGathering related openfiles on " + uri + "...\n")
+def compilematcher(patterns, mode):
+    """This function compiles one or more filename patterns into a single
+    regular expression so every open file is checked against all of them in
+    one pass. mode is substring, glob (matched against the whole file path)
+    or regex."""
+    parts = []
+    for pattern in patterns:
+        if mode == "substring":
+            parts.append(re.escape(pattern))
+        elif mode == "glob":
+            parts.append("^" + fnmatch.translate(pattern))
+        elif mode == "regex":
+            parts.append(pattern)
+    return re.compile("|".join("(?:" + part + ")" for part in parts))
+
+
+def getfileid(api_session, uri, ip, matcher, deadline=None, limit=1000, quiet=False):
+    """This function gets the open files matching a compiled matcher, one page
+    at a time so only matches are kept in memory. Raises Timeout once the
+    perf_counter deadline passes, however many pages are left."""
+    if not quiet:
+        print("\nGathering related openfiles on " + uri + "...\n")
     opfuri = "/platform/1/protocols/smb/openfiles"
     fileslist = []
-    opfinfo = api_session[0].get(uri + opfuri, verify=False)
-    if opfinfo.status_code == 200 or opfinfo.status_code == 201:
-        logging.info("GET request by " + api_session[1] + " at " + uri + opfuri + " successful")
-        opfinfo = json.loads(opfinfo.content.decode(encoding="UTF-8"))
-        for item in opfinfo["openfiles"]:
-            if filename in item.get("file"):
-                item["node_ip"] = ip
-                fileslist.append(item)
-    elif opfinfo.status_code != 200 or opfinfo.status_code != 201:
-        logging.info("GET request by " + api_session[1] + " at " + uri + opfuri + " unsuccessful")
-        print(
-            "\nIssue encountered with listing openfiles on "
-            + uri
-            + " Please try again.\n"
+    params = {"limit": limit}
+    while params:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - perf_counter()
+            if timeout <= 0:
+                raise requests.exceptions.Timeout(
+                    "Listing openfiles at " + uri + " ran past the node timeout"
+                )
+        # No retries, a slow node must not hold the scan past its timeout
+        opfinfo = papirequest(
+            api_session, "GET", uri, opfuri, retries=0, timeout=timeout, params=params
         )
-        exit()
+        if opfinfo.status_code == 200 or opfinfo.status_code == 201:
+            opfinfo = json.loads(opfinfo.content.decode(encoding="UTF-8"))
+            for item in opfinfo["openfiles"]:
+                if matcher.search(item.get("file")):
+                    item["node_ip"] = ip
+                    fileslist.append(item)
+            if opfinfo.get("resume"):
+                params = {"resume": opfinfo["resume"]}
+            else:
+                params = None
+        elif opfinfo.status_code == 401:
+            # The session expired, scannode logs in again
+            raise requests.exceptions.HTTPError(
+                "API session at " + uri + " rejected", response=opfinfo
+            )
+        elif opfinfo.status_code != 200 or opfinfo.status_code != 201:
+            if quiet:
+                return None
+            print(
+                "\nIssue encountered with listing openfiles on "
+                + uri
+                + " Please try again.\n"
+            )
+            return None
     return fileslist
 
 
+def scannode(manager, ip, port, matcher, timeout, quiet=False):
+    """This function gets the matching open files of a single node, logging
+    in again once if the node rejects its session, returns None if the node
+    fails or does not answer within timeout"""
+    uri = "https://" + str(ip) + ":" + str(port)
+    # One deadline covers the login and every page of the node
+    deadline = perf_counter() + timeout
+    for attempt in range(2):
+        try:
+            api_session = getnodesession(manager, uri, timeout)
+            if api_session is None:
+                if not quiet:
+                    print("\nSession to " + uri + " not established. Skipping node.\n")
+                return None
+            return getfileid(api_session, uri, ip, matcher, deadline, quiet=quiet)
+        except requests.exceptions.HTTPError as err:
+            logging.warning(str(err) + ", logging in again")
+            dropnodesession(manager, uri)
+        except requests.exceptions.RequestException as err:
+            logging.info("Scan of openfiles at " + uri + " unsuccessful: " + str(err))
+            if not quiet:
+                print("\nNode " + str(ip) + " did not respond in time. Skipping node.\n")
+            return None
+    if not quiet:
+        print("\nSession to " + uri + " rejected. Skipping node.\n")
+    return None
+
+
+def scannodesbynode(manager, iplist, port, matcher, workers, timeout, quiet=False):
+    """This function scans all nodes concurrently with a bounded thread pool,
+    returns the matching open files of each node IP, or None for a node
+    that failed"""
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(scannode, manager, ip, port, matcher, timeout, quiet): ip
+            for ip in iplist
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def scannodes(manager, iplist, port, matcher, workers, timeout, quiet=False):
+    """This function scans all nodes concurrently with a bounded thread pool,
+    returns the merged list of matching open files in node order"""
+    results = scannodesbynode(manager, iplist, port, matcher, workers, timeout, quiet)
+    listoffiles = []
+    for ip in iplist:
+        if results.get(ip) is not None:
+            listoffiles.extend(results[ip])
+    return listoffiles
+
+
 def breaklock(closelocksession, uri, fileid):
     """This function breaks a lock by file ID"""
     closeuri = "/platform/1/protocols/smb/openfiles/" + fileid
-    response = closelocksession[0].delete(uri + closeuri, verify=False)
+    response = papirequest(closelocksession, "DELETE", uri, closeuri)
     if response.status_code == 204:
-        logging.info("DELETE request by " + closelocksession[1] + " at " + uri + closeuri + " successful")
         print("\nThe file associated with ID " + fileid + " has been closed.\n")
-        exit()
+        return True
     elif response.status_code != 204:
-        logging.info("DELETE request by " + closelocksession[1] + " at " + uri + closeuri + " unsuccessful")
         print("\nIssue encountered closing the file. Please try again.\n")
-    return None
+    return False
+
+
+def tablestring(rows, columns=None):
+    """This function formats a list of dicts as a right aligned plain text
+    table, so the locksmith does not need to import pandas. The columns
+    default to every key found in the rows, in order of appearance."""
+    if columns is None:
+        columns = list(dict.fromkeys(key for row in rows for key in row))
+    cells = [columns] + [[str(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    return "\n".join(
+        " ".join(cell[i].rjust(widths[i]) for i in range(len(columns)))
+        for cell in cells
+    )
+
+
+def closefile(api_session, uri, fileid, timeout=None):
+    """This function closes one open file by ID without retrying, returns
+    None on success or an error message"""
+    closeuri = "/platform/1/protocols/smb/openfiles/" + str(fileid)
+    try:
+        response = papirequest(
+            api_session, "DELETE", uri, closeuri, retries=0, timeout=timeout
+        )
+    except requests.exceptions.RequestException as err:
+        return str(err)
+    if response.status_code == 204:
+        return None
+    elif response.status_code != 204:
+        try:
+            message = response.json()["errors"][0]["message"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            message = response.reason
+        return str(response.status_code) + ": " + str(message)
+
+
+def closenode(manager, uri, files, workers, timeout):
+    """This function closes a node's open files concurrently over the node's
+    warm session, returns a list of (file, error) pairs"""
+    try:
+        api_session = getnodesession(manager, uri, timeout)
+    except requests.exceptions.RequestException as err:
+        return [(file, str(err)) for file in files]
+    if api_session is None:
+        return [(file, "Session to " + uri + " not established") for file in files]
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    if not isinstance(api_session[0].get_adapter(uri), DaemonAdapter):
+        api_session[0].mount("https://", adapter)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = executor.map(
+            lambda file: closefile(api_session, uri, file["id"], timeout), files
+        )
+        return list(zip(files, errors))
+
+
+def closefiles(manager, port, files, workers, timeout):
+    """This function groups open files by node IP and closes every group at the
+    same time, workers requests at a time per node, returns the number of
+    failures after printing an aggregate report"""
+    bynode = {}
+    for file in files:
+        bynode.setdefault(str(file["node_ip"]), []).append(file)
+    print(
+        "\nClosing "
+        + str(len(files))
+        + " open files on "
+        + str(len(bynode))
+        + " nodes with "
+        + str(workers)
+        + " workers per node...\n"
+    )
+    results = []
+    with ThreadPoolExecutor(max_workers=len(bynode)) as executor:
+        futures = [
+            executor.submit(
+                closenode,
+                manager,
+                "https://" + ip + ":" + str(port),
+                nodefiles,
+                workers,
+                timeout,
+            )
+            for ip, nodefiles in bynode.items()
+        ]
+        for future in futures:
+            results.extend(future.result())
+    summary = {ip: {"node_ip": ip, "closed": 0, "failed": 0} for ip in bynode}
+    for file, error in results:
+        summary[str(file["node_ip"])]["closed" if error is None else "failed"] += 1
+    print(tablestring(list(summary.values())))
+    failures = [
+        {
+            "node_ip": file["node_ip"],
+            "id": file["id"],
+            "file": file.get("file"),
+            "error": error,
+        }
+        for file, error in results
+        if error is not None
+    ]
+    print(
+        "\nClosed "
+        + str(len(results) - len(failures))
+        + " of "
+        + str(len(results))
+        + " open files.\n"
+    )
+    if failures:
+        print("The following open files could not be closed:\n")
+        print(tablestring(failures))
+        print()
+    return len(failures)
+
+
+def selectfiles(listoffiles, selection):
+    """This function picks open files from a comma separated list of IDs, each
+    optionally written as <node ip>/<id> to choose between nodes that reuse
+    an ID. Returns the chosen files and the entries that matched nothing or
+    more than one node."""
+    chosen = []
+    rejected = []
+    for entry in selection.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        nodeip, _, fileid = entry.rpartition("/")
+        matches = [
+            file
+            for file in listoffiles
+            if str(file["id"]) == fileid
+            and (not nodeip or str(file["node_ip"]) == nodeip)
+        ]
+        if len(matches) == 1:
+            chosen.append(matches[0])
+        elif len(matches) != 1:
+            rejected.append(entry)
+    return chosen, rejected
+
+
+def buildindex(files):
+    """This function indexes open files by lower case path component, user and
+    node IP, returns the index"""
+    index = {
+        "files": files,
+        "component": {},
+        "user": {},
+        "node": {},
+        "built": datetime.datetime.now(),
+    }
+    for position, item in enumerate(files):
+        for component in re.split(r"[\\/]", item.get("file") or ""):
+            if component:
+                index["component"].setdefault(component.lower(), set()).add(position)
+        index["user"].setdefault(str(item.get("user")).lower(), set()).add(position)
+        index["node"].setdefault(str(item.get("node_ip")), set()).add(position)
+    return index
+
+
+def queryindex(index, field, value):
+    """This function answers a query from the open file index. field is
+    component, user or node for an exact lookup, or match for a substring
+    search of the whole path. Returns the matching open files."""
+    if field == "match":
+        value = value.lower()
+        return [item for item in index["files"] if value in (item.get("file") or "").lower()]
+    if field != "node":
+        value = value.lower()
+    positions = index[field].get(value, set())
+    return [index["files"][position] for position in sorted(positions)]
+
+
+def rescannodes(state, manager, iplist, port, workers, timeout, quiet=False):
+    """This function rescans every node and swaps in a freshly built index. A
+    node that fails keeps its open files from the previous index until a
+    rescan succeeds. Returns the open files indexed."""
+    matchall = compilematcher([""], "substring")
+    results = scannodesbynode(manager, iplist, port, matchall, workers, timeout, quiet)
+    with state["lock"]:
+        previous = state["index"]
+    files = []
+    for ip in iplist:
+        if results.get(ip) is not None:
+            files.extend(results[ip])
+        elif results.get(ip) is None:
+            kept = queryindex(previous, "node", str(ip))
+            logging.warning(
+                "Rescan of openfiles at "
+                + str(ip)
+                + " failed, keeping its "
+                + str(len(kept))
+                + " open files from the last scan that reached it"
+            )
+            files.extend(kept)
+    with state["lock"]:
+        state["index"] = buildindex(files)
+    logging.info("Open file index refreshed with " + str(len(files)) + " open files")
+    return files
+
+
+def refreshindex(state, manager, iplist, port, workers, timeout, interval):
+    """This function rescans every node every interval seconds in the
+    background until the session stops"""
+    while not state["stop"].wait(interval):
+        rescannodes(state, manager, iplist, port, workers, timeout, quiet=True)
+
+
+def interactivesession(manager, iplist, port, workers, timeout, interval):
+    """This function scans the cluster once, then answers repeated queries
+    from an in-memory index that is refreshed in the background"""
+    matchall = compilematcher([""], "substring")
+    files = scannodes(manager, iplist, port, matchall, workers, timeout)
+    state = {"index": buildindex(files), "lock": threading.Lock(), "stop": threading.Event()}
+    refresher = threading.Thread(
+        target=refreshindex,
+        args=(state, manager, iplist, port, workers, timeout, interval),
+        daemon=True,
+    )
+    refresher.start()
+    print(
+        "\nIndexed "
+        + str(len(files))
+        + " open files. Refreshing every "
+        + str(interval)
+        + " seconds.\n"
+    )
+    commands = (
+        "Commands:  file <name>  user <name>  node <ip>  match <text>\n"
+        + "           close <id> [node ip]  refresh  quit\n"
+    )
+    print(commands)
+    while True:
+        words = input("locksmith> ").split(maxsplit=1)
+        with state["lock"]:
+            index = state["index"]
+        if not words:
+            continue
+        command = words[0]
+        argument = words[1].strip() if len(words) > 1 else ""
+        if command == "quit":
+            state["stop"].set()
+            return
+        elif command == "refresh":
+            files = rescannodes(state, manager, iplist, port, workers, timeout)
+            print("\nIndexed " + str(len(files)) + " open files.\n")
+        elif command in ["file", "user", "node", "match"] and argument:
+            field = "component" if command == "file" else command
+            results = queryindex(index, field, argument)
+            if not results:
+                print("\nNo open files found.\n")
+            else:
+                print(tablestring(results))
+                print(
+                    "\n"
+                    + str(len(results))
+                    + " open files, index from "
+                    + index["built"].strftime("%H:%M:%S")
+                    + "\n"
+                )
+        elif command == "close" and argument:
+            closeid = argument.split()
+            matches = [
+                item
+                for item in index["files"]
+                if str(item["id"]) == closeid[0]
+                and (len(closeid) == 1 or str(item["node_ip"]) == closeid[1])
+            ]
+            if not matches:
+                print("\nYou have provided an ID that is not associated with an open file!\n")
+            elif len(matches) > 1:
+                print("\nID " + closeid[0] + " is open on several nodes. Add the node IP.\n")
+            else:
+                answer = input(
+                    "\nAre you absolutely sure that ID "
+                    + closeid[0]
+                    + " ("
+                    + str(matches[0].get("file"))
+                    + ") is what you would like to close? Enter 'y' or 'n'...\n"
+                )
+                if answer == "y":
+                    uri = "https://" + str(matches[0]["node_ip"]) + ":" + str(port)
+                    # A failed login or close must not end the interactive session
+                    api_session = trysession(uri, manager)
+                    closed = False
+                    if api_session is None:
+                        print("\nID " + closeid[0] + " was not closed.\n")
+                    elif api_session is not None:
+                        try:
+                            closed = breaklock(api_session, uri, closeid[0])
+                        except requests.exceptions.RequestException as err:
+                            logging.info(
+                                "Closing ID " + closeid[0] + " at " + uri + " unsuccessful: " + str(err)
+                            )
+                            print("\nIssue encountered closing the file. Please try again.\n")
+                    if closed:
+                        with state["lock"]:
+                            # The index may have been rebuilt since matches was taken
+                            closedkey = (str(matches[0]["node_ip"]), str(matches[0]["id"]))
+                            remaining = [
+                                item
+                                for item in state["index"]["files"]
+                                if (str(item["node_ip"]), str(item["id"])) != closedkey
+                            ]
+                            state["index"] = buildindex(remaining)
+        else:
+            print(commands)
+
+
+class JsonFormatter(logging.Formatter):
+    """This formatter writes each log record as a JSON line, with the method,
+    endpoint, status, bytes and elapsed_ms of PAPI requests when present"""
+
+    fields = ["method", "endpoint", "status", "bytes", "elapsed_ms"]
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class LockedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """This handler rotates a log shared by several processes. Every record is
+    written under an flock on <log>.lock, so only one process rolls the log
+    over, and a process that finds the log was rolled over by another one
+    reopens it before writing."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = open(self.baseFilename + ".lock", "a")
+
+    def reopenifrotated(self):
+        """This function reopens the log when it is no longer the file this
+        handler has open"""
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or not os.path.samestat(current, opened):
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            self.reopenifrotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lockfile.close()
+
+
+def setuplogging():
+    """This function queues log records to a background thread that writes
+    them to isi_tools.log as JSON lines, rotating it at 10 MB and keeping
+    five old logs, so logging never blocks a request"""
+    logqueue = queue.Queue()
+    handler = LockedRotatingFileHandler(
+        "isi_tools.log", maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(logqueue, handler)
+    listener.start()
+    # Write out whatever is still queued when the tool exits
+    atexit.register(listener.stop)
+    queuehandler = logging.handlers.QueueHandler(logqueue)
+    queuehandler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(handlers=[queuehandler], level=logging.INFO)
+    return listener
 
 
 def main():
     """This function is the main function that runs the Locksmith Tool"""
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     parser = argparse.ArgumentParser(description="File lock break tool")
-    parser.add_argument("filename", help="Enter a filename or substring of a filename ")
+    parser.add_argument(
+        "filename",
+        nargs="*",
+        help="Enter a filename or substring of a filename, or several separated by spaces",
+    )
+    parser.add_argument(
+        "-m",
+        "--match",
+        choices=["substring", "glob", "regex"],
+        default="substring",
+        help="How filenames are matched: substring (default), glob against the "
+        + "whole path (e.g. '*report*.xlsx') or regex",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=16,
+        help="Number of nodes to scan, or open files to close per node, at the same "
+        + "time (default 16)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=30,
+        help="Seconds a single node may take to list all its open files, across "
+        + "every page, before skipping it (default 30)",
+    )
+    parser.add_argument(
+        "-a",
+        "--all",
+        action="store_true",
+        help="Close every open file matching the filename after one confirmation",
+    )
+    parser.add_argument(
+        "-i",
+        "--interactive",
+        action="store_true",
+        help="Scan once, then look up open files by name, user or node from an "
+        + "in-memory index until you quit",
+    )
+    parser.add_argument(
+        "-r",
+        "--refresh",
+        type=int,
+        default=300,
+        help="Seconds between background rescans in interactive mode (default 300)",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write per endpoint API request counts, latency, sizes and errors to "
+        + "this Prometheus textfile (e.g. /var/lib/node_exporter/isi_tools.prom)",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print per endpoint API request counts, latency percentiles, sizes and "
+        + "error rates at the end of the run",
+    )
     args = parser.parse_args()
-    filename = args.filename
+    filename = ", ".join(args.filename)
+    try:
+        matcher = compilematcher(args.filename, args.match)
+    except re.error as err:
+        print("\nPlease enter a valid regular expression: " + str(err) + "\n")
+        sys.exit()
+    if args.workers < 1 or args.timeout < 1 or args.refresh < 1:
+        print("\nWorkers, timeout and refresh must be 1 or greater.\n")
+        sys.exit()
+    if not args.filename and not args.interactive:
+        print("\nPlease enter a filename, or use --interactive.\n")
+        sys.exit()
+    if args.all and args.interactive:
+        print("\n--all cannot be used with --interactive.\n")
+        sys.exit()
 
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        filename="isi_tools.log",
-        level=logging.INFO,
-    )
+    setuplogging()
+    atexit.register(reportmetrics, args.metrics, args.summary)
 
     printbanner()
     iplist = input(
@@ -133,18 +1181,15 @@ def main():
     iplist = getiplist(iplist)
     port = 8080
 
-    listoffiles = []
-    for ip in iplist:
-        uri = "https://" + str(ip) + ":" + str(port)
-        api_session = getsession(uri)
-        files = getfileid(api_session, uri, ip, filename)
-        if files is not None:
-            listoffiles.extend(files)
-        elif listoffiles is None:
-            break
-    pd.set_option("display.max_rows", None)
-    df = pd.DataFrame(listoffiles)
-    if df.empty:
+    manager = newsessionmanager()
+    connectcluster(manager, iplist, port, args.timeout)
+    if args.interactive:
+        interactivesession(
+            manager, iplist, port, args.workers, args.timeout, args.refresh
+        )
+        return
+    listoffiles = scannodes(manager, iplist, port, matcher, args.workers, args.timeout)
+    if not listoffiles:
         print("Cannot find an instance of " + filename + " open!\n")
         sys.exit()
     else:
@@ -152,10 +1197,40 @@ def main():
             "\nHere is a list of files similar to your filename across the node IPs you provided.\n"
         )
         print("Please take note of the ID you would like to close.\n")
-        print(df.to_string(index=False))
-        fileid = input(
-            "\n\nPlease provide the ID of the file you would like to close from the table above: \n"
-        )
+        print(tablestring(listoffiles))
+        if args.all:
+            fileid = "all"
+        elif not args.all:
+            fileid = input(
+                "\n\nPlease provide the ID of the file you would like to close from the table above,"
+                + " several IDs separated by commas (<node ip>/<id> where an ID repeats),"
+                + " or 'all': \n"
+            ).strip()
+        if fileid == "all" or "," in fileid or "/" in fileid:
+            if fileid == "all":
+                chosen, rejected = listoffiles, []
+            elif fileid != "all":
+                chosen, rejected = selectfiles(listoffiles, fileid)
+            if rejected:
+                print(
+                    "\nThese IDs match no open file or more than one node: "
+                    + ", ".join(rejected)
+                    + "\n"
+                )
+                sys.exit()
+            if not chosen:
+                print("\nNo IDs were provided. Please run the script again")
+                sys.exit()
+            answer = input(
+                "\nAre you absolutely sure that you would like to close "
+                + str(len(chosen))
+                + " open files? Enter 'y' or 'n'...\n"
+            )
+            if answer != "y":
+                print("\nYou have selected no. Please run the script again")
+                sys.exit()
+            failures = closefiles(manager, port, chosen, args.workers, args.timeout)
+            sys.exit(1 if failures else 0)
         answer = str(
             input(
                 "\nAre you absolutely sure that ID "
@@ -180,8 +1255,12 @@ def main():
                 if int(file["id"]) == int(fileid):
                     nodeip = str(file["node_ip"])
                     uri = "https://" + str(nodeip) + ":" + str(port)
-                    closelocksession = getsession(uri)
-                    breaklock(closelocksession, uri, fileid)
+                    closelocksession = trysession(uri, manager)
+                    if closelocksession is None:
+                        print("\nID " + fileid + " on " + nodeip + " was not closed.\n")
+                        continue
+                    if breaklock(closelocksession, uri, fileid):
+                        sys.exit()
         elif answer != "y" and answer != "n":
             print(
                 "\nYou input a character outside of allowed options. Please run the script again.\n"
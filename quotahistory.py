@@ -0,0 +1,245 @@
+import argparse
+import sys
+import os
+import datetime
+import ipaddress
+import json
+import numpy as np
+import pandas as pd
+
+# Unit label and power of 1024 for each unit of measurement
+UNITS = {"B": ("B", 0), "M": ("MB", 2), "G": ("GB", 3), "T": ("TB", 4)}
+# Usage fields kept for every quota in the quota history, in column order
+HISTORYFIELDS = ["fsphysical", "fslogical", "applogical"]
+# Usage field hard thresholds apply to in samples from before thresholds_on
+# was recorded, the default of quotareport.py's THRESHOLDFIELDS
+DEFAULTLIMITFIELD = "fslogical"
+
+
+def validateinput(ip, unit, days, top, within):
+    """This function checks for valid input"""
+    try:
+        ipaddress.ip_address(ip)
+    except ValueError:
+        print("\nPlease enter a valid IP address!\n")
+        sys.exit()
+    if unit not in UNITS:
+        print(
+            "\nPlease enter a valid unit of measurement: B for bytes, M for MB, G for GB, "
+            "or T for TB\n"
+        )
+        sys.exit()
+    if days < 1 or (top is not None and top < 1) or (within is not None and within < 1):
+        print("\nDays, top and within must be 1 or greater.\n")
+        sys.exit()
+
+
+def readhistory(ip, days):
+    """This function finds the quota history of a cluster, returns the quota
+    paths and the sample files of the last days, oldest first"""
+    directory = os.path.join("quota_history", str(ip))
+    pathsfile = os.path.join(directory, "paths.jsonl")
+    if not os.path.isfile(pathsfile):
+        print(
+            "\nNo quota history found for "
+            + str(ip)
+            + ". Run quotareport.py against it first.\n"
+        )
+        sys.exit()
+    with open(pathsfile, "r", encoding="utf-8") as f:
+        paths = [json.loads(line) for line in f if line.strip()]
+    since = datetime.datetime.now().timestamp() - days * 86400
+    samples = sorted(
+        (int(name[:-4]), os.path.join(directory, name))
+        for name in os.listdir(directory)
+        if name.endswith(".npz") and name[:-4].isdigit()
+    )
+    return paths, [sample for sample in samples if sample[0] >= since]
+
+
+def growth(paths, samples, field):
+    """This function fits a least squares line through every quota's usage
+    over the samples. Each sample is folded into per quota running sums with
+    np.bincount, so only one sample is in memory at a time. Growth is
+    reported for field, while days to full is projected from the usage the
+    quota's hard threshold applies to (its thresholds_on field). Returns a
+    dataframe of the quotas in the latest sample."""
+    n = len(paths)
+    column = HISTORYFIELDS.index(field)
+    start = samples[0][0]
+    count = np.zeros(n)
+    sumt = np.zeros(n)
+    sumtt = np.zeros(n)
+    sumy = np.zeros(n)
+    sumty = np.zeros(n)
+    sumly = np.zeros(n)
+    sumtly = np.zeros(n)
+    first = np.full(n, -1, dtype=np.int64)
+    last = np.full(n, -1, dtype=np.int64)
+    lastlimit = np.full(n, -1, dtype=np.int64)
+    hard = np.full(n, -1, dtype=np.int64)
+    seen = np.zeros(n, dtype=bool)
+    for epoch, samplepath in samples:
+        with np.load(samplepath) as sample:
+            ids = sample["ids"]
+            y = sample["usage"][:, column]
+            hardlimits = sample["hard"]
+            if "limitfield" in sample.files:
+                limitfield = sample["limitfield"]
+            elif "limitfield" not in sample.files:
+                limitfield = np.full(len(ids), HISTORYFIELDS.index(DEFAULTLIMITFIELD))
+            limity = sample["usage"][np.arange(len(ids)), limitfield]
+        day = (epoch - start) / 86400
+        count += np.bincount(ids, minlength=n)
+        sumt += day * np.bincount(ids, minlength=n)
+        sumtt += day * day * np.bincount(ids, minlength=n)
+        sumy += np.bincount(ids, weights=y, minlength=n)
+        sumty += day * np.bincount(ids, weights=y, minlength=n)
+        sumly += np.bincount(ids, weights=limity, minlength=n)
+        sumtly += day * np.bincount(ids, weights=limity, minlength=n)
+        unseen = first[ids] < 0
+        first[ids[unseen]] = y[unseen]
+        last[ids] = y
+        lastlimit[ids] = limity
+        hard[ids] = hardlimits
+        seen[:] = False
+        seen[ids] = True
+    denominator = count * sumtt - sumt * sumt
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(
+            denominator > 0, (count * sumty - sumt * sumy) / denominator, np.nan
+        )
+        limitslope = np.where(
+            denominator > 0, (count * sumtly - sumt * sumly) / denominator, np.nan
+        )
+        daystofull = np.where(
+            (hard >= 0) & (limitslope > 0),
+            np.maximum(hard - lastlimit, 0) / limitslope,
+            np.nan,
+        )
+    daystofull = np.where((hard >= 0) & (lastlimit >= hard), 0, daystofull)
+    current = np.flatnonzero(seen)
+    return pd.DataFrame(
+        {
+            "path": np.asarray(paths, dtype=object)[current],
+            "samples": count[current].astype(np.int64),
+            "first": first[current],
+            "last": last[current],
+            "change": last[current] - first[current],
+            "per_day": slope[current],
+            "hard": hard[current],
+            "days_to_full": daystofull[current],
+        }
+    )
+
+
+def formatgrowth(df, unit):
+    """This function scales the byte columns of a growth report to the user
+    defined measurement unit and labels them"""
+    label, power = UNITS[unit]
+    df = df.copy()
+    for column in ["first", "last", "change", "per_day", "hard"]:
+        if unit != "B":
+            scaled = np.round(df[column] / 1024**power, 2)
+            if column == "hard":
+                scaled = scaled.where(df[column] >= 0)
+            df[column] = scaled
+        elif column == "hard":
+            df[column] = df[column].where(df[column] >= 0)
+    df["days_to_full"] = np.round(df["days_to_full"], 1)
+    return df.rename(
+        columns={
+            column: column + "(" + label + ")"
+            for column in ["first", "last", "change", "per_day", "hard"]
+        }
+    )
+
+
+def main():
+    """This function is the main function that runs quotahistory"""
+    parser = argparse.ArgumentParser(
+        description="Analyze quota growth from the history kept by quotareport.py"
+    )
+    parser.add_argument("ip", help="Enter the IP address quotareport.py was run against")
+    parser.add_argument(
+        "-d",
+        "--days",
+        type=int,
+        default=30,
+        help="Number of days of history to analyze (default 30)",
+    )
+    parser.add_argument(
+        "-b",
+        "--by",
+        choices=HISTORYFIELDS,
+        default="fslogical",
+        help="Usage field to analyze (default fslogical)",
+    )
+    parser.add_argument(
+        "-t",
+        "--top",
+        type=int,
+        help="Only show the top number of fastest growing quotas",
+    )
+    parser.add_argument(
+        "-w",
+        "--within",
+        type=int,
+        help="Only show quotas projected to reach their hard threshold within "
+        + "this many days, soonest first",
+    )
+    parser.add_argument(
+        "-u",
+        "--unit",
+        default="G",
+        help="Enter a B for bytes, M for MB, G for GB (default), or T for TB",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputcsv",
+        action="store_true",
+        help="Also write the report to quota_growth_<date>.csv",
+    )
+    args = parser.parse_args()
+    validateinput(args.ip, args.unit, args.days, args.top, args.within)
+
+    paths, samples = readhistory(args.ip, args.days)
+    if len(samples) < 2:
+        print(
+            "\nAt least two quota report runs in the last "
+            + str(args.days)
+            + " days are needed to measure growth.\n"
+        )
+        sys.exit()
+    df = growth(paths, samples, args.by)
+
+    if args.within is not None:
+        df = df[df["days_to_full"] <= args.within].sort_values("days_to_full")
+    elif args.within is None:
+        df = df.sort_values("per_day", ascending=False)
+    if args.top is not None:
+        df = df.head(args.top)
+
+    pd.set_option("display.max_rows", None)
+    df = formatgrowth(df, args.unit)
+    print(
+        "\n"
+        + args.by
+        + " growth over "
+        + str(len(samples))
+        + " samples since "
+        + str(datetime.datetime.fromtimestamp(samples[0][0]))
+        + ":\n\n"
+    )
+    if df.empty:
+        print("No quotas to report.\n")
+    else:
+        print(df.to_string(index=False) + "\n")
+    if args.outputcsv:
+        csvpath = "quota_growth_" + str(datetime.date.today()) + ".csv"
+        df.to_csv(csvpath, encoding="utf-8", index=False)
+        print("Report written to " + os.getcwd() + "/" + csvpath + "\n")
+
+
+if __name__ == "__main__":
+    main()
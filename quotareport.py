@@ -1,20 +1,50 @@
+from time import sleep, perf_counter
 from getpass import getpass
+import heapq
 import argparse
+from collections import deque
 import logging
+import logging.handlers
+import queue
+import atexit
 import base64
+import fcntl
 import sys
 import os
+import io
+import socket
 import datetime
+import threading
 import ipaddress
 import json
+import math
 import requests
 import urllib3
+import numpy as np
 import pandas as pd
 
+# Unix socket of daemon.py, which holds warm cluster sessions when running
+DAEMONSOCKET = os.environ.get("ISI_TOOLS_SOCKET", "isi_tools.sock")
+# Upper bounds in seconds of the PAPI request latency histogram buckets
+LATENCYBUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Per endpoint request metrics, keyed by method and endpoint
+METRICS = {}
+METRICSLOCK = threading.Lock()
+# Unit label and power of 1024 for each unit of measurement
+UNITS = {"B": ("B", 0), "M": ("MB", 2), "G": ("GB", 3), "T": ("TB", 4)}
+# Usage fields kept for every quota in the quota history, in column order
+HISTORYFIELDS = ["fsphysical", "fslogical", "applogical"]
+# Usage field a quota's thresholds_on setting compares the hard threshold with
+THRESHOLDFIELDS = {
+    "physicalsize": "fsphysical",
+    "fslogicalsize": "fslogical",
+    "applogicalsize": "applogical",
+}
 
-def validateinput(ip, unit, csv):
+
+def validateinput(ip, unit, csv, limit=None):
     """This function checks for valid input"""
-    units = ["M", "G", "T"]
+    units = list(UNITS)
     csvlst =["y","n"]
     try:
         ipaddress.ip_address(ip)
@@ -22,9 +52,10 @@ def validateinput(ip, unit, csv):
         print("\nPlease enter a valid IP address!\n")
         sys.exit()
 
-    if unit not in units:
+    if any(item not in units for item in unit.split(",")):
         print(
-            "\nPlease enter a valid unit of measurement: M for MB, G for GB, or T for TB\n"
+            "\nPlease enter a valid unit of measurement: B for bytes, M for MB, G for GB, "
+            "or T for TB, or several separated by commas (e.g. G,T)\n"
         )
         sys.exit()
     if csv not in csvlst:
@@ -32,11 +63,181 @@ def validateinput(ip, unit, csv):
             "\nPlease enter a valid response of 'y' or 'n' to output a csv.\n"
         )
         sys.exit()
+    if limit is not None and limit < 1:
+        print("\nPlease enter a page size (limit) of 1 or greater.\n")
+        sys.exit()
     
 
 
+def readsessioncache():
+    """This function reads the session cache shared by all isi_tools, returns
+    a dict of cached sessions keyed by cluster uri"""
+    cache = "session_cache.json"
+    if os.path.isfile(cache):
+        try:
+            with open(cache, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    return {}
+
+
+def writesessioncache(sessions):
+    """This function atomically writes the session cache, readable only by
+    the current user"""
+    cache = "session_cache.json"
+    tmpcache = cache + "." + str(os.getpid())
+    fd = os.open(tmpcache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(sessions, f, indent=4)
+    os.replace(tmpcache, cache)
+
+
+def getcachedsession(uri):
+    """This function reuses a cached session for uri if it has not expired and
+    the cluster still accepts it, returns session or None"""
+    entry = readsessioncache().get(uri)
+    now = datetime.datetime.now().timestamp()
+    if entry is None or entry["expires"] <= now:
+        return None
+    api_session = requests.Session()
+    api_session.cookies.set("isisessid", entry["isisessid"])
+    api_session.cookies.set("isicsrf", entry["isicsrf"])
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = entry["isicsrf"]
+    start = perf_counter()
+    response = api_session.get(uri + "/session/1/session", verify=False)
+    recordrequest(
+        "GET",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code != 200:
+        logging.info("Cached API session of " + entry["username"] + " at " + uri + " rejected")
+        return None
+    logging.info("Cached API session reused by " + entry["username"] + " at " + uri)
+    print("\nReusing session to " + uri + ".\n")
+    entry["expires"] = min(now + entry["timeout_inactive"], entry["expires_absolute"])
+    sessions = readsessioncache()
+    sessions[uri] = entry
+    writesessioncache(sessions)
+    return api_session, entry["username"]
+
+
+def cachesession(uri, api_session, user, response):
+    """This function stores the isisessid/isicsrf cookies of a new session with
+    their expiry so later runs can reuse them"""
+    timeouts = json.loads(response.content.decode(encoding="UTF-8") or "{}")
+    now = datetime.datetime.now().timestamp()
+    inactive = timeouts.get("timeout_inactive", 900)
+    absolute = now + timeouts.get("timeout_absolute", 14400)
+    sessions = readsessioncache()
+    sessions[uri] = {
+        "username": user,
+        "isisessid": api_session.cookies.get("isisessid"),
+        "isicsrf": api_session.cookies.get("isicsrf"),
+        "timeout_inactive": inactive,
+        "expires_absolute": absolute,
+        "expires": min(now + inactive, absolute),
+    }
+    writesessioncache(sessions)
+
+
+def daemoncall(socketpath, header, body=b"", timeout=None):
+    """This function sends one request to daemon.py over its Unix socket,
+    returns the reply header and body"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socketpath)
+        header = dict(header, length=len(body))
+        client.sendall(json.dumps(header).encode("utf-8") + b"\n" + body)
+        with client.makefile("rb") as f:
+            try:
+                reply = json.loads(f.readline())
+                length = reply["length"]
+            except (ValueError, KeyError) as err:
+                raise requests.exceptions.ConnectionError(
+                    "daemon.py sent no valid reply: " + str(err)
+                )
+            return reply, f.read(length)
+    finally:
+        client.close()
+
+
+class DaemonAdapter(requests.adapters.BaseAdapter):
+    """This adapter hands the requests of a session to daemon.py, which sends
+    them to the cluster over its own warm session"""
+
+    def __init__(self, socketpath):
+        super().__init__()
+        self.socketpath = socketpath
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        header = {
+            "method": request.method,
+            "url": request.url,
+            "content_type": request.headers.get("Content-Type"),
+            "timeout": timeout,
+        }
+        if isinstance(timeout, tuple):
+            timeout = None if None in timeout else sum(timeout)
+        try:
+            reply, content = daemoncall(self.socketpath, header, body, timeout)
+        except socket.timeout as err:
+            raise requests.exceptions.Timeout(err, request=request)
+        except OSError as err:
+            raise requests.exceptions.ConnectionError(err, request=request)
+        if reply.get("error") == "timeout":
+            raise requests.exceptions.Timeout(reply["message"], request=request)
+        elif reply.get("error") is not None:
+            raise requests.exceptions.ConnectionError(reply["message"], request=request)
+        response = requests.models.Response()
+        response.status_code = reply["status"]
+        response.reason = reply["reason"]
+        if reply.get("content_type"):
+            response.headers["Content-Type"] = reply["content_type"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def getdaemonsession(uri, timeout=60):
+    """This function returns a session whose requests go through daemon.py
+    when it is running, otherwise None"""
+    if not os.path.exists(DAEMONSOCKET):
+        return None
+    try:
+        reply, _ = daemoncall(DAEMONSOCKET, {"method": "SESSION", "url": uri}, b"", timeout)
+    except (OSError, ValueError):
+        return None
+    if reply.get("status") != 200:
+        return None
+    api_session = requests.Session()
+    api_session.mount("https://", DaemonAdapter(DAEMONSOCKET))
+    print("\nUsing the daemon session to " + uri + ".\n")
+    return api_session, reply["user"]
+
+
 def getsession(uri):
     """This function gets a session and sets headers, returns session"""
+    api_session = getdaemonsession(uri)
+    if api_session is not None:
+        return api_session
+    cached = getcachedsession(uri)
+    if cached is not None:
+        return cached
+
     creds = "creds.json"
     if os.path.isfile(creds):
         with open(creds, "r", encoding="utf-8") as f:
@@ -52,9 +253,17 @@ def getsession(uri):
     headers = {"Content-Type": "application/json"}
     data = json.dumps({"username": user, "password": p, "services": ["platform"]})
     api_session = requests.Session()
+    start = perf_counter()
     response = api_session.post(
         uri + "/session/1/session", data=data, headers=headers, verify=False
     )
+    recordrequest(
+        "POST",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
     if response.status_code == 200 or response.status_code == 201:
         print("Session to " + uri + " established.\n")
         logging.info("API session created successfully by " + user + " at " + uri)
@@ -68,60 +277,399 @@ def getsession(uri):
         sys.exit()
     api_session.headers["referer"] = uri
     api_session.headers["X-CSRF-Token"] = api_session.cookies.get("isicsrf")
+    cachesession(uri, api_session, user, response)
     return api_session, user
 
 
+def endpointname(resourceurl):
+    """This function reduces a resource URL to its endpoint by replacing each
+    part after the API version that holds a digit, such as a snapshot,
+    lock or ChangeList ID, with {id}"""
+    parts = resourceurl.split("?")[0].strip("/").split("/")
+    return "/" + "/".join(
+        "{id}" if index > 1 and any(c.isdigit() for c in part) else part
+        for index, part in enumerate(parts)
+    )
+
+
+def recordrequest(method, resourceurl, status, nbytes, elapsed):
+    """This function adds one API request to the per endpoint metrics. status
+    is None when no response came back, elapsed is in seconds."""
+    key = (method, endpointname(resourceurl))
+    with METRICSLOCK:
+        if key not in METRICS:
+            METRICS[key] = {
+                "count": 0,
+                "errors": 0,
+                "bytes": 0,
+                "seconds": 0.0,
+                "buckets": [0] * len(LATENCYBUCKETS),
+                "latencies": deque(maxlen=10000),
+                "statuses": {},
+            }
+        entry = METRICS[key]
+        entry["count"] += 1
+        entry["bytes"] += nbytes
+        entry["seconds"] += elapsed
+        entry["latencies"].append(elapsed)
+        for index, bound in enumerate(LATENCYBUCKETS):
+            if elapsed <= bound:
+                entry["buckets"][index] += 1
+        if status is None or status >= 400:
+            entry["errors"] += 1
+        status = str(status) if status is not None else "none"
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def percentile(values, fraction):
+    """This function returns the nearest rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def metricsummary():
+    """This function summarizes the metrics of every endpoint, returns a list
+    of rows slowest p95 first"""
+    rows = []
+    with METRICSLOCK:
+        for (method, endpoint), entry in METRICS.items():
+            latencies = sorted(entry["latencies"])
+            rows.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "error_rate": round(entry["errors"] / entry["count"], 3),
+                    "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+                    "bytes": entry["bytes"],
+                }
+            )
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+
+def printmetrics():
+    """This function prints the per endpoint API request summary"""
+    rows = metricsummary()
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [columns] + [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    print("\nAPI requests by endpoint:\n")
+    for cell in cells:
+        print(" ".join(cell[i].rjust(widths[i]) for i in range(len(columns))))
+    print()
+
+
+def writemetrics(metricspath):
+    """This function atomically writes the metrics as a Prometheus textfile,
+    for the node_exporter textfile collector to pick up"""
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    families = {
+        "requests_total": ("counter", "PAPI requests by response status."),
+        "request_duration_seconds": ("histogram", "PAPI request latency."),
+        "request_latency_seconds": ("summary", "PAPI request latency quantiles."),
+        "response_bytes_total": ("counter", "PAPI response payload bytes."),
+        "request_errors_total": ("counter", "PAPI requests that failed or got a 4xx/5xx."),
+    }
+    samples = {family: [] for family in families}
+
+    def sample(family, suffix, labels, value):
+        samples[family].append(
+            "isi_tools_papi_" + family + suffix + "{" + labels + "} " + str(value)
+        )
+
+    with METRICSLOCK:
+        for (method, endpoint), entry in sorted(METRICS.items()):
+            labels = 'tool="' + tool + '",method="' + method + '",endpoint="' + endpoint + '"'
+            for status, count in sorted(entry["statuses"].items()):
+                sample("requests_total", "", labels + ',status="' + status + '"', count)
+            duration = "request_duration_seconds"
+            for bound, count in zip(LATENCYBUCKETS, entry["buckets"]):
+                sample(duration, "_bucket", labels + ',le="' + str(bound) + '"', count)
+            sample(duration, "_bucket", labels + ',le="+Inf"', entry["count"])
+            sample(duration, "_sum", labels, round(entry["seconds"], 6))
+            sample(duration, "_count", labels, entry["count"])
+            latencies = sorted(entry["latencies"])
+            for fraction in [0.5, 0.95, 0.99]:
+                quantile = round(percentile(latencies, fraction), 6)
+                sample(
+                    "request_latency_seconds",
+                    "",
+                    labels + ',quantile="' + str(fraction) + '"',
+                    quantile,
+                )
+            sample("request_latency_seconds", "_sum", labels, round(entry["seconds"], 6))
+            sample("request_latency_seconds", "_count", labels, entry["count"])
+            sample("response_bytes_total", "", labels, entry["bytes"])
+            sample("request_errors_total", "", labels, entry["errors"])
+    lines = []
+    for family, (kind, description) in families.items():
+        lines.append("# HELP isi_tools_papi_" + family + " " + description)
+        lines.append("# TYPE isi_tools_papi_" + family + " " + kind)
+        lines.extend(samples[family])
+    tmppath = metricspath + "." + str(os.getpid())
+    with open(tmppath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmppath, metricspath)
+
+
+def reportmetrics(metricspath, summary):
+    """This function prints and writes the metrics at the end of a run"""
+    if summary:
+        printmetrics()
+    if metricspath:
+        writemetrics(metricspath)
+
+
+def papirequest(api_session, method, uri, resourceurl, retries=3, **kwargs):
+    """This function sends a PAPI request over the session, which carries the
+    CSRF headers, retries transient failures and logs the outcome, returns
+    the response"""
+    # Only retry a POST when the cluster refused it before doing any work
+    if method == "POST":
+        retrycodes = [429, 503]
+    else:
+        retrycodes = [429, 500, 502, 503, 504]
+    fields = {"method": method, "endpoint": resourceurl}
+    for attempt in range(retries + 1):
+        # Every attempt is timed and recorded on its own, so backoff sleeps are
+        # not counted as latency and retried failures are counted as errors
+        start = perf_counter()
+        try:
+            response = api_session[0].request(
+                method, uri + resourceurl, verify=False, **kwargs
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            elapsed = perf_counter() - start
+            recordrequest(method, resourceurl, None, 0, elapsed)
+            if method == "POST" or attempt == retries:
+                fields["elapsed_ms"] = round(elapsed * 1000, 1)
+                logging.info(
+                    "%s request by %s at %s unsuccessful",
+                    method,
+                    api_session[1],
+                    uri + resourceurl,
+                    extra=fields,
+                )
+                raise
+            sleep(2**attempt)
+            continue
+        elapsed = perf_counter() - start
+        recordrequest(
+            method, resourceurl, response.status_code, len(response.content), elapsed
+        )
+        if response.status_code in retrycodes and attempt < retries:
+            sleep(2**attempt)
+            continue
+        break
+    fields["status"] = response.status_code
+    fields["bytes"] = len(response.content)
+    fields["elapsed_ms"] = round(elapsed * 1000, 1)
+    if response.status_code in [200, 201, 204]:
+        outcome = "successful"
+    elif response.status_code not in [200, 201, 204]:
+        outcome = "unsuccessful"
+    logging.info(
+        "%s request by %s at %s " + outcome,
+        method,
+        api_session[1],
+        uri + resourceurl,
+        extra=fields,
+    )
+    return response
+
+
+def getpages(api_session, uri, resourceurl, key, limit, **kwargs):
+    """This function yields the items of a PAPI collection one page at a
+    time, following the resume token until the cluster reports no more
+    pages. It prints an error and raises HTTPError if a page cannot be
+    fetched, so callers never mistake a truncated listing for a full one."""
+    params = dict(kwargs, limit=limit)
+    while params:
+        result = papirequest(api_session, "GET", uri, resourceurl, params=params)
+        if result.status_code == 200 or result.status_code == 201:
+            result = json.loads(result.content.decode(encoding="UTF-8"))
+            yield result[key]
+            if result.get("resume"):
+                params = {"resume": result["resume"]}
+            else:
+                params = None
+        elif result.status_code != 200 or result.status_code != 201:
+            print(
+                "\nIssue encountered with retrieving "
+                + key
+                + " at "
+                + uri
+                + resourceurl
+                + " Please try again.\n"
+            )
+            raise requests.exceptions.HTTPError(
+                "Retrieving " + key + " at " + uri + resourceurl + " failed",
+                response=result,
+            )
+
+
+def formatquotas(quotas, unit):
+    """This function builds a dataframe from a list of quotas with user defined
+    measurement unit. Only the fields in the report are read, straight into
+    an int64 array, and all units in a comma separated unit (e.g. "G,T" or
+    "B" for exact bytes) are scaled in a single vectorized operation."""
+    units = unit.split(",")
+    fields = ["fsphysical", "fslogical", "applogical"]
+    labels = ["FSphysical", "FSlogical", "APPphysical"]
+    usage = np.fromiter(
+        (quota["usage"].get(field, 0) for quota in quotas for field in fields),
+        dtype=np.int64,
+        count=len(quotas) * len(fields),
+    ).reshape(len(quotas), len(fields))
+    divisors = np.array([1024 ** UNITS[item][1] for item in units], dtype=np.float64)
+    scaled = np.round(usage[:, :, np.newaxis] / divisors, 2)
+
+    columns = {
+        "path": [quota["path"] for quota in quotas],
+        "description": [quota.get("description") for quota in quotas],
+    }
+    for u, item in enumerate(units):
+        for f, label in enumerate(labels):
+            column = label + "(" + UNITS[item][0] + ")"
+            if item == "B":
+                columns[column] = usage[:, f]
+            else:
+                columns[column] = scaled[:, f, u]
+    return pd.DataFrame(columns)
+
+
+def quotakey(quota):
+    """This function names a quota in the quota history. Directory quotas are
+    named by path, user and group quotas also by type and persona."""
+    if quota.get("type", "directory") == "directory":
+        return quota["path"]
+    persona = quota.get("persona") or {}
+    owner = persona.get("name") or persona.get("id") or ""
+    return quota["path"] + " [" + quota["type"] + ":" + str(owner) + "]"
+
+
+def openhistory(ip):
+    """This function opens the quota history of a cluster. The history is a
+    directory holding paths.jsonl, which numbers every quota ever seen, and
+    one <epoch>.npz sample per quota report run. Returns the history."""
+    directory = os.path.join("quota_history", str(ip))
+    os.makedirs(directory, exist_ok=True)
+    paths = readhistorypaths(directory)
+    return {
+        "directory": directory,
+        "index": {path: number for number, path in enumerate(paths)},
+        "known": len(paths),
+        "new": [],
+        "samples": [],
+    }
+
+
+def readhistorypaths(directory):
+    """This function reads the numbered quota paths of a quota history,
+    returns them in number order"""
+    pathsfile = os.path.join(directory, "paths.jsonl")
+    if not os.path.isfile(pathsfile):
+        return []
+    with open(pathsfile, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def samplequotas(history, quotas):
+    """This function adds the usage, hard threshold and thresholds_on field of
+    a list of quotas to the sample of this run as arrays, numbering any new
+    quotas"""
+    ids = np.empty(len(quotas), dtype=np.int32)
+    for row, quota in enumerate(quotas):
+        key = quotakey(quota)
+        if key not in history["index"]:
+            history["index"][key] = len(history["index"])
+            history["new"].append(key)
+        ids[row] = history["index"][key]
+    usage = np.fromiter(
+        (quota["usage"].get(field, 0) for quota in quotas for field in HISTORYFIELDS),
+        dtype=np.int64,
+        count=len(quotas) * len(HISTORYFIELDS),
+    ).reshape(len(quotas), len(HISTORYFIELDS))
+    # -1 marks a quota without a hard threshold
+    hard = np.fromiter(
+        ((quota.get("thresholds") or {}).get("hard") or -1 for quota in quotas),
+        dtype=np.int64,
+        count=len(quotas),
+    )
+    # Column of usage that each quota's hard threshold applies to
+    limitfield = np.fromiter(
+        (
+            HISTORYFIELDS.index(THRESHOLDFIELDS.get(quota.get("thresholds_on"), "fslogical"))
+            for quota in quotas
+        ),
+        dtype=np.int8,
+        count=len(quotas),
+    )
+    history["samples"].append((ids, usage, hard, limitfield))
+
+
+def savehistory(history):
+    """This function appends the sample of this run to the quota history.
+    Another run may have numbered new quotas since this one opened the
+    history, so paths.jsonl is reread under a lock, this run's new quotas
+    are renumbered against it and it is rewritten atomically before the
+    sample that refers to them."""
+    if not history["samples"]:
+        return None
+    ids = np.concatenate([sample[0] for sample in history["samples"]])
+    with open(os.path.join(history["directory"], "paths.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        paths = readhistorypaths(history["directory"])
+        index = {path: number for number, path in enumerate(paths)}
+        renumber = np.arange(history["known"] + len(history["new"]), dtype=np.int32)
+        for number, path in enumerate(history["new"], start=history["known"]):
+            if path not in index:
+                index[path] = len(paths)
+                paths.append(path)
+            renumber[number] = index[path]
+        ids = renumber[ids]
+        if len(paths) > history["known"]:
+            pathsfile = os.path.join(history["directory"], "paths.jsonl")
+            tmppaths = pathsfile + "." + str(os.getpid())
+            with open(tmppaths, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(path) + "\n" for path in paths)
+            os.replace(tmppaths, pathsfile)
+        history["index"] = index
+        history["known"] = len(paths)
+        history["new"] = []
+        epoch = int(datetime.datetime.now().timestamp())
+        samplepath = os.path.join(history["directory"], str(epoch) + ".npz")
+        # Runs finishing within the same second each keep their own sample
+        while os.path.exists(samplepath):
+            epoch += 1
+            samplepath = os.path.join(history["directory"], str(epoch) + ".npz")
+        with open(samplepath + ".tmp", "wb") as f:
+            np.savez_compressed(
+                f,
+                epoch=np.int64(epoch),
+                ids=ids,
+                usage=np.concatenate([sample[1] for sample in history["samples"]]),
+                hard=np.concatenate([sample[2] for sample in history["samples"]]),
+                limitfield=np.concatenate([sample[3] for sample in history["samples"]]),
+            )
+        os.replace(samplepath + ".tmp", samplepath)
+    history["samples"] = []
+    logging.info("Quota history sample written to " + samplepath)
+    return samplepath
+
+
 def createquotareport(result, unit, csv):
     """This function creates a quota report with user defined measurement unit"""
-    df = pd.json_normalize(result["quotas"])
-    if df.empty:
+    if not result["quotas"]:
         print("There are no quotas!")
         return 0
     else:
         pd.set_option("display.max_rows", None)
-        df = pd.DataFrame(
-            df,
-            columns=[
-                "path",
-                "description",
-                "usage.fsphysical",
-                "usage.fslogical",
-                "usage.applogical",
-            ],
-        )
-        if unit == "M":
-            df["usage.fsphysical"] = round(((df["usage.fsphysical"]) / 1024 / 1024), 2)
-            df["usage.fslogical"] = round(((df["usage.fslogical"]) / 1024 / 1024), 2)
-            df["usage.applogical"] = round(((df["usage.applogical"]) / 1024 / 1024), 2)
-            df.columns.values[2] = "FSphysical(MB)"
-            df.columns.values[3] = "FSlogical(MB)"
-            df.columns.values[4] = "APPphysical(MB)"
-        elif unit == "G":
-            df["usage.fsphysical"] = round(
-                ((df["usage.fsphysical"]) / 1024 / 1024 / 1024), 2
-            )
-            df["usage.fslogical"] = round(
-                ((df["usage.fslogical"]) / 1024 / 1024 / 1024), 2
-            )
-            df["usage.applogical"] = round(
-                ((df["usage.applogical"]) / 1024 / 1024 / 1024), 2
-            )
-            df.columns.values[2] = "FSphysical(GB)"
-            df.columns.values[3] = "FSlogical(GB)"
-            df.columns.values[4] = "APPphysical(GB)"
-        elif unit == "T":
-            df["usage.fsphysical"] = round(
-                ((df["usage.fsphysical"]) / 1024 / 1024 / 1024 / 1024), 2
-            )
-            df["usage.fslogical"] = round(
-                ((df["usage.fslogical"]) / 1024 / 1024 / 1024 / 1024), 2
-            )
-            df["usage.applogical"] = round(
-                ((df["usage.applogical"]) / 1024 / 1024 / 1024 / 1024), 2
-            )
-            df.columns.values[2] = "FSphysical(TB)"
-            df.columns.values[3] = "FSlogical(TB)"
-            df.columns.values[4] = "APPphysical(TB)"
+        df = formatquotas(result["quotas"], unit)
 
         todaysdate = str(datetime.date.today())
         if csv == "y":
@@ -137,16 +685,144 @@ def createquotareport(result, unit, csv):
         return 0
 
 
-def getquotareport(api_session, uri, unit, csv):
-    """This function gets a quota report and passes it to createquotareport"""
+def createpagedquotareport(pages, unit, csv, history=None):
+    """This function creates a quota report one page of quotas at a time, so
+    only a single page is ever held in memory"""
+    todaysdate = str(datetime.date.today())
+    csvpath = "quota_report_" + todaysdate + ".csv"
+    count = 0
+    try:
+        for quotas in pages:
+            if not quotas:
+                continue
+            df = formatquotas(quotas, unit)
+            if history is not None:
+                samplequotas(history, quotas)
+            if count == 0:
+                print("\nList of Quotas:\n\n")
+            if csv == "y":
+                df.to_csv(
+                    csvpath,
+                    encoding="utf-8",
+                    index=False,
+                    mode="w" if count == 0 else "a",
+                    header=count == 0,
+                )
+            print(df.to_string(index=False))
+            count += len(df)
+    except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError):
+        # Keep a truncated csv from being mistaken for a full report
+        if csv == "y" and count > 0:
+            os.replace(csvpath, csvpath + ".partial")
+            print(
+                "\nStopped after "
+                + str(count)
+                + " quotas. The incomplete csv was moved to "
+                + os.getcwd()
+                + "/"
+                + csvpath
+                + ".partial"
+            )
+        raise
+    if count == 0:
+        print("There are no quotas!")
+        return 0
+    print("\n" + str(count) + " quotas reported.\n")
+    return count
+
+
+def quotarank(quota, by):
+    """This function returns the value a quota is ranked by in a top report,
+    or None for percent when the quota has no hard threshold"""
+    if by != "percent":
+        return quota["usage"].get(by, 0)
+    hard = (quota.get("thresholds") or {}).get("hard")
+    if not hard:
+        return None
+    field = THRESHOLDFIELDS.get(quota.get("thresholds_on"), "fslogical")
+    return round(quota["usage"].get(field, 0) * 100 / hard, 2)
+
+
+def createtopquotareport(pages, unit, csv, top, by, history=None):
+    """This function reports the top quotas by usage field or percent of hard
+    threshold. Pages are streamed through a heap of at most top quotas, so
+    only top quotas are kept whole. When a quota history is given, each page
+    is also sampled into small arrays and every path is numbered, which
+    costs a few hundred bytes per quota on the cluster."""
+    heap = []
+    count = 0
+    for quotas in pages:
+        if history is not None and quotas:
+            samplequotas(history, quotas)
+        for quota in quotas:
+            rank = quotarank(quota, by)
+            count += 1
+            if rank is None:
+                continue
+            # On equal rank the quota seen first is kept
+            item = (rank, -count, quota)
+            if len(heap) < top:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+    if not heap:
+        print("There are no quotas!")
+        return 0
+    ranked = sorted(heap, reverse=True)
+    df = formatquotas([item[2] for item in ranked], unit)
+    if by == "percent":
+        df["percent_of_hard"] = [item[0] for item in ranked]
+    if csv == "y":
+        csvpath = "quota_report_" + str(datetime.date.today()) + ".csv"
+        df.to_csv(csvpath, encoding="utf-8", index=False)
+    print(
+        "\nTop "
+        + str(len(ranked))
+        + " of "
+        + str(count)
+        + " Quotas by "
+        + by
+        + ":\n\n"
+    )
+    print(df.to_string(index=False) + "\n")
+    return len(ranked)
+
+
+def getquotareport(
+    api_session, uri, unit, csv, limit=None, history=None, top=None, by=None
+):
+    """This function gets a quota report and passes it to createquotareport,
+    pages through quotas when a limit is provided, or passes them to
+    createtopquotareport when top is provided. The quotas are also
+    appended to the quota history when one is given and every page was
+    retrieved. Exits nonzero if a page cannot be retrieved or the connection
+    is lost."""
+    if top is not None or limit is not None:
+        pages = getpages(
+            api_session, uri, "/platform/15/quota/quotas", "quotas", limit or 1000
+        )
+        try:
+            if top is not None:
+                count = createtopquotareport(pages, unit, csv, top, by, history)
+            elif top is None:
+                count = createpagedquotareport(pages, unit, csv, history)
+        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as err:
+            # A truncated sample would look like every later quota was deleted
+            logging.info("Quota report of " + uri + " incomplete: " + str(err))
+            print("\nThe quota report is incomplete, the quota history was not updated.\n")
+            sys.exit(1)
+        if history is not None:
+            savehistory(history)
+        return count
     resourceurl = "/platform/15/quota/quotas"
-    result = api_session[0].get(uri + resourceurl, verify=False)
+    result = papirequest(api_session, "GET", uri, resourceurl)
     if result.status_code == 200 or result.status_code == 201:
         result = json.loads(result.content.decode(encoding="UTF-8"))
-        logging.info("GET request by " + api_session[1] + " at " + uri + resourceurl + " successful")
         createquotareport(result, unit, csv)
+        if history is not None and result["quotas"]:
+            samplequotas(history, result["quotas"])
+            savehistory(history)
     elif result.status_code != 200 or result.status_code != 201:
-        logging.info("GET request  by " + api_session[1] + " at " + uri + resourceurl + " unsuccessful")
         print(
             "\nIssue encountered with retrieving quotas at "
             + uri
@@ -155,18 +831,135 @@ def getquotareport(api_session, uri, unit, csv):
         return 0
 
 
+class JsonFormatter(logging.Formatter):
+    """This formatter writes each log record as a JSON line, with the method,
+    endpoint, status, bytes and elapsed_ms of PAPI requests when present"""
+
+    fields = ["method", "endpoint", "status", "bytes", "elapsed_ms"]
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class LockedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """This handler rotates a log shared by several processes. Every record is
+    written under an flock on <log>.lock, so only one process rolls the log
+    over, and a process that finds the log was rolled over by another one
+    reopens it before writing."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = open(self.baseFilename + ".lock", "a")
+
+    def reopenifrotated(self):
+        """This function reopens the log when it is no longer the file this
+        handler has open"""
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or not os.path.samestat(current, opened):
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            self.reopenifrotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lockfile.close()
+
+
+def setuplogging():
+    """This function queues log records to a background thread that writes
+    them to isi_tools.log as JSON lines, rotating it at 10 MB and keeping
+    five old logs, so logging never blocks a request"""
+    logqueue = queue.Queue()
+    handler = LockedRotatingFileHandler(
+        "isi_tools.log", maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(logqueue, handler)
+    listener.start()
+    # Write out whatever is still queued when the tool exits
+    atexit.register(listener.stop)
+    queuehandler = logging.handlers.QueueHandler(logqueue)
+    queuehandler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(handlers=[queuehandler], level=logging.INFO)
+    return listener
+
+
 def main():
     """This function is the main function that runs the isi_quotareport"""
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     parser = argparse.ArgumentParser(description="Generate a Quota Report")
     parser.add_argument("ip", help="Enter a valid IP address")
-    parser.add_argument("unit", help="Enter an M for MB, G for GB, or T for TB")
+    parser.add_argument(
+        "unit",
+        help="Enter a B for bytes, M for MB, G for GB, or T for TB. "
+        + "Separate several with commas to report them side by side, e.g. G,T",
+    )
     parser.add_argument(
         "-o",
         "--outputcsv",
         help="Type 'y' for yes, and 'n' for no to output a csv",
     )
+    parser.add_argument(
+        "-l",
+        "--limit",
+        type=int,
+        help="Retrieve quotas in pages of this size (e.g. 1000) to keep memory bounded",
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        help="Only report the top number of quotas, ranked by --by. Memory then "
+        + "grows with the number of quotas only for the quota history, a few "
+        + "hundred bytes each; with '-k n' only the top quotas are held in memory",
+    )
+    parser.add_argument(
+        "-b",
+        "--by",
+        choices=["fsphysical", "fslogical", "applogical", "percent"],
+        default="fsphysical",
+        help="Rank the top quotas by usage field or percent of hard threshold "
+        + "(default fsphysical)",
+    )
+    parser.add_argument(
+        "-k",
+        "--keephistory",
+        help="Type 'y' for yes (default), and 'n' for no to append this run to the "
+        + "quota history in quota_history/<ip>, read by quotahistory.py",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write per endpoint API request counts, latency, sizes and errors to "
+        + "this Prometheus textfile (e.g. /var/lib/node_exporter/isi_tools.prom)",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print per endpoint API request counts, latency percentiles, sizes and "
+        + "error rates at the end of the run",
+    )
     args = parser.parse_args()
     ip = args.ip
     unit = args.unit
@@ -176,20 +969,29 @@ def main():
     elif args.outputcsv is None:
         csv = 'n'
 
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        filename="isi_tools.log",
-        level=logging.INFO,
-    )
+    setuplogging()
+    atexit.register(reportmetrics, args.metrics, args.summary)
 
-    validateinput(ip, unit, csv)
+    validateinput(ip, unit, csv, args.limit)
+    if args.top is not None and args.top < 1:
+        print("\nPlease enter a top number of quotas of 1 or greater.\n")
+        sys.exit()
+    if args.keephistory not in [None, "y", "n"]:
+        print("\nPlease enter a valid response of 'y' or 'n' to keep the quota history.\n")
+        sys.exit()
 
 
     port = 8080
     uri = "https://" + str(ip) + ":" + str(port)
 
+    history = None
+    if args.keephistory != "n":
+        history = openhistory(ip)
+
     api_session = getsession(uri)
-    getquotareport(api_session, uri, unit, csv)
+    getquotareport(
+        api_session, uri, unit, csv, args.limit, history, args.top, args.by
+    )
 
 
 if __name__ == "__main__":
@@ -1,15 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, perf_counter
 from getpass import getpass
 import argparse
+from collections import deque
 import logging
+import logging.handlers
+import fcntl
+import queue
+import atexit
 import sys
 import base64
 import os
+import io
+import socket
 import datetime
+import threading
 import ipaddress
+import csv
 import json
+import math
 import requests
 import urllib3
 
+# Unix socket of daemon.py, which holds warm cluster sessions when running
+DAEMONSOCKET = os.environ.get("ISI_TOOLS_SOCKET", "isi_tools.sock")
+# Upper bounds in seconds of the PAPI request latency histogram buckets
+LATENCYBUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Per endpoint request metrics, keyed by method and endpoint
+METRICS = {}
+METRICSLOCK = threading.Lock()
+
 
 def validateinput(ip):
     """This function checks for valid input"""
@@ -37,8 +57,175 @@ def datetoepoch(timestamp):
         return expirydate
 
 
+def readsessioncache():
+    """This function reads the session cache shared by all isi_tools, returns
+    a dict of cached sessions keyed by cluster uri"""
+    cache = "session_cache.json"
+    if os.path.isfile(cache):
+        try:
+            with open(cache, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    return {}
+
+
+def writesessioncache(sessions):
+    """This function atomically writes the session cache, readable only by
+    the current user"""
+    cache = "session_cache.json"
+    tmpcache = cache + "." + str(os.getpid())
+    fd = os.open(tmpcache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(sessions, f, indent=4)
+    os.replace(tmpcache, cache)
+
+
+def getcachedsession(uri):
+    """This function reuses a cached session for uri if it has not expired and
+    the cluster still accepts it, returns session or None"""
+    entry = readsessioncache().get(uri)
+    now = datetime.datetime.now().timestamp()
+    if entry is None or entry["expires"] <= now:
+        return None
+    api_session = requests.Session()
+    api_session.cookies.set("isisessid", entry["isisessid"])
+    api_session.cookies.set("isicsrf", entry["isicsrf"])
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = entry["isicsrf"]
+    start = perf_counter()
+    response = api_session.get(uri + "/session/1/session", verify=False)
+    recordrequest(
+        "GET",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code != 200:
+        logging.info("Cached API session of " + entry["username"] + " at " + uri + " rejected")
+        return None
+    logging.info("Cached API session reused by " + entry["username"] + " at " + uri)
+    print("\nReusing session to " + uri + ".\n")
+    entry["expires"] = min(now + entry["timeout_inactive"], entry["expires_absolute"])
+    sessions = readsessioncache()
+    sessions[uri] = entry
+    writesessioncache(sessions)
+    return api_session, entry["username"]
+
+
+def cachesession(uri, api_session, user, response):
+    """This function stores the isisessid/isicsrf cookies of a new session with
+    their expiry so later runs can reuse them"""
+    timeouts = json.loads(response.content.decode(encoding="UTF-8") or "{}")
+    now = datetime.datetime.now().timestamp()
+    inactive = timeouts.get("timeout_inactive", 900)
+    absolute = now + timeouts.get("timeout_absolute", 14400)
+    sessions = readsessioncache()
+    sessions[uri] = {
+        "username": user,
+        "isisessid": api_session.cookies.get("isisessid"),
+        "isicsrf": api_session.cookies.get("isicsrf"),
+        "timeout_inactive": inactive,
+        "expires_absolute": absolute,
+        "expires": min(now + inactive, absolute),
+    }
+    writesessioncache(sessions)
+
+
+def daemoncall(socketpath, header, body=b"", timeout=None):
+    """This function sends one request to daemon.py over its Unix socket,
+    returns the reply header and body"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socketpath)
+        header = dict(header, length=len(body))
+        client.sendall(json.dumps(header).encode("utf-8") + b"\n" + body)
+        with client.makefile("rb") as f:
+            try:
+                reply = json.loads(f.readline())
+                length = reply["length"]
+            except (ValueError, KeyError) as err:
+                raise requests.exceptions.ConnectionError(
+                    "daemon.py sent no valid reply: " + str(err)
+                )
+            return reply, f.read(length)
+    finally:
+        client.close()
+
+
+class DaemonAdapter(requests.adapters.BaseAdapter):
+    """This adapter hands the requests of a session to daemon.py, which sends
+    them to the cluster over its own warm session"""
+
+    def __init__(self, socketpath):
+        super().__init__()
+        self.socketpath = socketpath
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        header = {
+            "method": request.method,
+            "url": request.url,
+            "content_type": request.headers.get("Content-Type"),
+            "timeout": timeout,
+        }
+        if isinstance(timeout, tuple):
+            timeout = None if None in timeout else sum(timeout)
+        try:
+            reply, content = daemoncall(self.socketpath, header, body, timeout)
+        except socket.timeout as err:
+            raise requests.exceptions.Timeout(err, request=request)
+        except OSError as err:
+            raise requests.exceptions.ConnectionError(err, request=request)
+        if reply.get("error") == "timeout":
+            raise requests.exceptions.Timeout(reply["message"], request=request)
+        elif reply.get("error") is not None:
+            raise requests.exceptions.ConnectionError(reply["message"], request=request)
+        response = requests.models.Response()
+        response.status_code = reply["status"]
+        response.reason = reply["reason"]
+        if reply.get("content_type"):
+            response.headers["Content-Type"] = reply["content_type"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def getdaemonsession(uri, timeout=60):
+    """This function returns a session whose requests go through daemon.py
+    when it is running, otherwise None"""
+    if not os.path.exists(DAEMONSOCKET):
+        return None
+    try:
+        reply, _ = daemoncall(DAEMONSOCKET, {"method": "SESSION", "url": uri}, b"", timeout)
+    except (OSError, ValueError):
+        return None
+    if reply.get("status") != 200:
+        return None
+    api_session = requests.Session()
+    api_session.mount("https://", DaemonAdapter(DAEMONSOCKET))
+    print("\nUsing the daemon session to " + uri + ".\n")
+    return api_session, reply["user"]
+
+
 def getsession(uri):
     """This function gets a session and sets headers, returns session"""
+    api_session = getdaemonsession(uri)
+    if api_session is not None:
+        return api_session
+    cached = getcachedsession(uri)
+    if cached is not None:
+        return cached
+
     creds = "creds.json"
     if os.path.isfile(creds):
         with open(creds, "r", encoding="utf-8") as f:
@@ -54,9 +241,17 @@ def getsession(uri):
     headers = {"Content-Type": "application/json"}
     data = json.dumps({"username": user, "password": p, "services": ["platform"]})
     api_session = requests.Session()
+    start = perf_counter()
     response = api_session.post(
         uri + "/session/1/session", data=data, headers=headers, verify=False
     )
+    recordrequest(
+        "POST",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
     if response.status_code == 200 or response.status_code == 201:
         print("Session to " + uri + " established.\n")
         logging.info("API session created successfully by " + user + " at " + uri)
@@ -70,33 +265,425 @@ def getsession(uri):
         sys.exit()
     api_session.headers["referer"] = uri
     api_session.headers["X-CSRF-Token"] = api_session.cookies.get("isicsrf")
+    cachesession(uri, api_session, user, response)
     return api_session, user
 
-def createsnapshot(api_session, uri, path, name, snapexpires):
-    """This function will create a snapshot on path/expiration provided"""
-    resourceurl = "/platform/1/snapshot/snapshots"
-    if name == 0 and snapexpires == 0:
-        data = json.dumps({"path": path})
-    elif snapexpires == 0 and name != 0:
-        data = json.dumps({"path": path, "name": name})
-    elif snapexpires != 0 and name == 0:
-        data = json.dumps({"path": path, "snapexpires": snapexpires})
+
+def endpointname(resourceurl):
+    """This function reduces a resource URL to its endpoint by replacing each
+    part after the API version that holds a digit, such as a snapshot,
+    lock or ChangeList ID, with {id}"""
+    parts = resourceurl.split("?")[0].strip("/").split("/")
+    return "/" + "/".join(
+        "{id}" if index > 1 and any(c.isdigit() for c in part) else part
+        for index, part in enumerate(parts)
+    )
+
+
+def recordrequest(method, resourceurl, status, nbytes, elapsed):
+    """This function adds one API request to the per endpoint metrics. status
+    is None when no response came back, elapsed is in seconds."""
+    key = (method, endpointname(resourceurl))
+    with METRICSLOCK:
+        if key not in METRICS:
+            METRICS[key] = {
+                "count": 0,
+                "errors": 0,
+                "bytes": 0,
+                "seconds": 0.0,
+                "buckets": [0] * len(LATENCYBUCKETS),
+                "latencies": deque(maxlen=10000),
+                "statuses": {},
+            }
+        entry = METRICS[key]
+        entry["count"] += 1
+        entry["bytes"] += nbytes
+        entry["seconds"] += elapsed
+        entry["latencies"].append(elapsed)
+        for index, bound in enumerate(LATENCYBUCKETS):
+            if elapsed <= bound:
+                entry["buckets"][index] += 1
+        if status is None or status >= 400:
+            entry["errors"] += 1
+        status = str(status) if status is not None else "none"
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def percentile(values, fraction):
+    """This function returns the nearest rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def metricsummary():
+    """This function summarizes the metrics of every endpoint, returns a list
+    of rows slowest p95 first"""
+    rows = []
+    with METRICSLOCK:
+        for (method, endpoint), entry in METRICS.items():
+            latencies = sorted(entry["latencies"])
+            rows.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "error_rate": round(entry["errors"] / entry["count"], 3),
+                    "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+                    "bytes": entry["bytes"],
+                }
+            )
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+
+def printmetrics():
+    """This function prints the per endpoint API request summary"""
+    rows = metricsummary()
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [columns] + [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    print("\nAPI requests by endpoint:\n")
+    for cell in cells:
+        print(" ".join(cell[i].rjust(widths[i]) for i in range(len(columns))))
+    print()
+
+
+def writemetrics(metricspath):
+    """This function atomically writes the metrics as a Prometheus textfile,
+    for the node_exporter textfile collector to pick up"""
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    families = {
+        "requests_total": ("counter", "PAPI requests by response status."),
+        "request_duration_seconds": ("histogram", "PAPI request latency."),
+        "request_latency_seconds": ("summary", "PAPI request latency quantiles."),
+        "response_bytes_total": ("counter", "PAPI response payload bytes."),
+        "request_errors_total": ("counter", "PAPI requests that failed or got a 4xx/5xx."),
+    }
+    samples = {family: [] for family in families}
+
+    def sample(family, suffix, labels, value):
+        samples[family].append(
+            "isi_tools_papi_" + family + suffix + "{" + labels + "} " + str(value)
+        )
+
+    with METRICSLOCK:
+        for (method, endpoint), entry in sorted(METRICS.items()):
+            labels = 'tool="' + tool + '",method="' + method + '",endpoint="' + endpoint + '"'
+            for status, count in sorted(entry["statuses"].items()):
+                sample("requests_total", "", labels + ',status="' + status + '"', count)
+            duration = "request_duration_seconds"
+            for bound, count in zip(LATENCYBUCKETS, entry["buckets"]):
+                sample(duration, "_bucket", labels + ',le="' + str(bound) + '"', count)
+            sample(duration, "_bucket", labels + ',le="+Inf"', entry["count"])
+            sample(duration, "_sum", labels, round(entry["seconds"], 6))
+            sample(duration, "_count", labels, entry["count"])
+            latencies = sorted(entry["latencies"])
+            for fraction in [0.5, 0.95, 0.99]:
+                quantile = round(percentile(latencies, fraction), 6)
+                sample(
+                    "request_latency_seconds",
+                    "",
+                    labels + ',quantile="' + str(fraction) + '"',
+                    quantile,
+                )
+            sample("request_latency_seconds", "_sum", labels, round(entry["seconds"], 6))
+            sample("request_latency_seconds", "_count", labels, entry["count"])
+            sample("response_bytes_total", "", labels, entry["bytes"])
+            sample("request_errors_total", "", labels, entry["errors"])
+    lines = []
+    for family, (kind, description) in families.items():
+        lines.append("# HELP isi_tools_papi_" + family + " " + description)
+        lines.append("# TYPE isi_tools_papi_" + family + " " + kind)
+        lines.extend(samples[family])
+    tmppath = metricspath + "." + str(os.getpid())
+    with open(tmppath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmppath, metricspath)
+
+
+def reportmetrics(metricspath, summary):
+    """This function prints and writes the metrics at the end of a run"""
+    if summary:
+        printmetrics()
+    if metricspath:
+        writemetrics(metricspath)
+
+
+def papirequest(api_session, method, uri, resourceurl, retries=3, **kwargs):
+    """This function sends a PAPI request over the session, which carries the
+    CSRF headers, retries transient failures and logs the outcome, returns
+    the response"""
+    # Only retry a POST when the cluster refused it before doing any work
+    if method == "POST":
+        retrycodes = [429, 503]
     else:
-        data = json.dumps({"path": path, "expires": snapexpires, "name": name})
-    response = api_session[0].post(uri + resourceurl, data=data, verify=False)
+        retrycodes = [429, 500, 502, 503, 504]
+    fields = {"method": method, "endpoint": resourceurl}
+    for attempt in range(retries + 1):
+        # Every attempt is timed and recorded on its own, so backoff sleeps are
+        # not counted as latency and retried failures are counted as errors
+        start = perf_counter()
+        try:
+            response = api_session[0].request(
+                method, uri + resourceurl, verify=False, **kwargs
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            elapsed = perf_counter() - start
+            recordrequest(method, resourceurl, None, 0, elapsed)
+            if method == "POST" or attempt == retries:
+                fields["elapsed_ms"] = round(elapsed * 1000, 1)
+                logging.info(
+                    "%s request by %s at %s unsuccessful",
+                    method,
+                    api_session[1],
+                    uri + resourceurl,
+                    extra=fields,
+                )
+                raise
+            sleep(2**attempt)
+            continue
+        elapsed = perf_counter() - start
+        recordrequest(
+            method, resourceurl, response.status_code, len(response.content), elapsed
+        )
+        if response.status_code in retrycodes and attempt < retries:
+            sleep(2**attempt)
+            continue
+        break
+    fields["status"] = response.status_code
+    fields["bytes"] = len(response.content)
+    fields["elapsed_ms"] = round(elapsed * 1000, 1)
+    if response.status_code in [200, 201, 204]:
+        outcome = "successful"
+    elif response.status_code not in [200, 201, 204]:
+        outcome = "unsuccessful"
+    logging.info(
+        "%s request by %s at %s " + outcome,
+        method,
+        api_session[1],
+        uri + resourceurl,
+        extra=fields,
+    )
+    return response
+
+
+def postsnapshot(api_session, uri, path, name, snapexpires):
+    """This function posts a snapshot of path, returns the snapshot ID and
+    None, or None and the error encountered"""
+    resourceurl = "/platform/1/snapshot/snapshots"
+    data = {"path": path}
+    if name != 0:
+        data["name"] = name
+    if snapexpires != 0:
+        data["expires"] = snapexpires
+    try:
+        response = papirequest(
+            api_session, "POST", uri, resourceurl, data=json.dumps(data)
+        )
+    except requests.exceptions.RequestException as err:
+        return None, str(err)
     if response.status_code == 200 or response.status_code == 201:
-        logging.info("POST request by " + api_session[1] + " at "  + uri + resourceurl + " successful")
         response = json.loads(response.content.decode(encoding="UTF-8"))
-        snapid = response["id"]
+        return response["id"], None
+    elif response.status_code != 200 or response.status_code != 201:
+        try:
+            message = response.json()["errors"][0]["message"]
+        except (ValueError, KeyError, IndexError):
+            message = response.reason
+        return None, "HTTP " + str(response.status_code) + ": " + str(message)
+
+
+def createsnapshot(api_session, uri, path, name, snapexpires):
+    """This function will create a snapshot on path/expiration provided"""
+    snapid, error = postsnapshot(api_session, uri, path, name, snapexpires)
+    if snapid is not None:
         print(
                     "\nSnapshot ID " + str(snapid) + " created!\n"
                 )
         return snapid
-    elif response.status_code != 200 or response.status_code != 201:
-        logging.info("POST request by " + api_session[1] + " at "  + uri + resourceurl + " unsuccessful")
+    elif snapid is None:
         print("\nSnapshot creation encountered an issue. Try again!")
         sys.exit()
 
+
+def readmanifest(manifest):
+    """This function reads a manifest of snapshots to create, one per line as
+    path[,name[,YYYY-MM-DD-HH-MM-SS expiry]], from a file or '-' for stdin.
+    The output maps each path to one snapshot ID, so only the first line of
+    a repeated path is kept, with a warning. Lines with an invalid or past
+    expiry are skipped with a warning too. Returns a list of (path, name,
+    snapexpires)."""
+    if manifest == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(manifest, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    snapshots = []
+    seen = set()
+    for number, row in enumerate(csv.reader(lines), start=1):
+        if not row or not row[0].strip() or row[0].strip().startswith("#"):
+            continue
+        path = row[0].strip()
+        if path in seen:
+            print(
+                "Skipping line "
+                + str(number)
+                + " of the manifest, "
+                + path
+                + " is already listed."
+            )
+            continue
+        name = 0
+        snapexpires = 0
+        if len(row) > 1 and row[1].strip():
+            name = row[1].strip()
+        if len(row) > 2 and row[2].strip():
+            expiry = row[2].strip()
+            try:
+                snapexpires = int(
+                    datetime.datetime.strptime(expiry, "%Y-%m-%d-%H-%M-%S").timestamp()
+                )
+            except ValueError:
+                print(
+                    "Skipping line "
+                    + str(number)
+                    + " of the manifest, "
+                    + expiry
+                    + " is not a YYYY-MM-DD-HH-MM-SS date."
+                )
+                continue
+            if snapexpires < int(datetime.datetime.now().timestamp()):
+                print(
+                    "Skipping line "
+                    + str(number)
+                    + " of the manifest, "
+                    + expiry
+                    + " has already passed."
+                )
+                continue
+        seen.add(path)
+        snapshots.append((path, name, snapexpires))
+    return snapshots
+
+
+def createsnapshots(api_session, uri, snapshots, workers, output):
+    """This function creates the snapshots of a manifest concurrently over one
+    session, writes a json mapping of path to snapshot ID (null on failure)
+    to output, returns the number of failures"""
+    print(
+        "\nCreating "
+        + str(len(snapshots))
+        + " snapshots with "
+        + str(workers)
+        + " workers...\n"
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    if not isinstance(api_session[0].get_adapter(uri), DaemonAdapter):
+        api_session[0].mount("https://", adapter)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(
+                lambda snapshot: postsnapshot(api_session, uri, *snapshot), snapshots
+            )
+        )
+    mapping = {}
+    failed = 0
+    for snapshot, (snapid, error) in zip(snapshots, results):
+        mapping[snapshot[0]] = snapid
+        if snapid is None:
+            failed += 1
+            print("Snapshot of " + snapshot[0] + " failed: " + error)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(mapping, f, indent=4)
+    print(
+        "\n"
+        + str(len(snapshots) - failed)
+        + " snapshots created, "
+        + str(failed)
+        + " failed. Snapshot IDs written to "
+        + output
+        + "\n"
+    )
+    return failed
+
+
+class JsonFormatter(logging.Formatter):
+    """This formatter writes each log record as a JSON line, with the method,
+    endpoint, status, bytes and elapsed_ms of PAPI requests when present"""
+
+    fields = ["method", "endpoint", "status", "bytes", "elapsed_ms"]
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class LockedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """This handler rotates a log shared by several processes. Every record is
+    written under an flock on <log>.lock, so only one process rolls the log
+    over, and a process that finds the log was rolled over by another one
+    reopens it before writing."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = open(self.baseFilename + ".lock", "a")
+
+    def reopenifrotated(self):
+        """This function reopens the log when it is no longer the file this
+        handler has open"""
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or not os.path.samestat(current, opened):
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            self.reopenifrotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lockfile.close()
+
+
+def setuplogging():
+    """This function queues log records to a background thread that writes
+    them to isi_tools.log as JSON lines, rotating it at 10 MB and keeping
+    five old logs, so logging never blocks a request"""
+    logqueue = queue.Queue()
+    handler = LockedRotatingFileHandler(
+        "isi_tools.log", maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(logqueue, handler)
+    listener.start()
+    # Write out whatever is still queued when the tool exits
+    atexit.register(listener.stop)
+    queuehandler = logging.handlers.QueueHandler(logqueue)
+    queuehandler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(handlers=[queuehandler], level=logging.INFO)
+    return listener
+
+
 def main():
     """This function is the main function that runs the snapandlock"""
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -104,6 +691,7 @@ def main():
     parser.add_argument("ip", help="Enter a valid IP address")
     parser.add_argument(
         "path",
+        nargs="?",
         help="Enter a path to take a snapshot "
         + "Example: /ifs/data/path",
     )
@@ -117,18 +705,48 @@ def main():
         "--snapexpires",
         help="Type a date in YYYY-MM-DD-HH-MM-SS format (24h) to expire snapshot",
     )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="Create a snapshot for every line of this file ('-' for stdin), "
+        + "one path[,name[,YYYY-MM-DD-HH-MM-SS]] per line",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of snapshots to create at the same time with --manifest (default 8)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="File to write the json mapping of path to snapshot ID with --manifest "
+        + "(default snapshot_ids_<date>.json)",
+    )
 
+    parser.add_argument(
+        "--metrics",
+        help="Write per endpoint API request counts, latency, sizes and errors to "
+        + "this Prometheus textfile (e.g. /var/lib/node_exporter/isi_tools.prom)",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print per endpoint API request counts, latency percentiles, sizes and "
+        + "error rates at the end of the run",
+    )
     args = parser.parse_args()
 
     ip = args.ip
     path = args.path
+    if (path is None) == (args.manifest is None):
+        print("\nPlease enter either a path or a --manifest, not both.\n")
+        sys.exit()
 
 
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        filename="isi_tools.log",
-        level=logging.INFO,
-    )
+    setuplogging()
+    atexit.register(reportmetrics, args.metrics, args.summary)
 
     validateinput(ip)
 
@@ -145,6 +763,19 @@ def main():
     port = 8080
     uri = "https://" + str(ip) + ":" + str(port)
 
+    if args.manifest is not None:
+        if args.workers < 1:
+            print("\nPlease enter a number of workers of 1 or greater.\n")
+            sys.exit()
+        snapshots = readmanifest(args.manifest)
+        output = args.output
+        if output is None:
+            output = "snapshot_ids_" + str(datetime.date.today()) + ".json"
+        api_session = getsession(uri)
+        if createsnapshots(api_session, uri, snapshots, args.workers, output):
+            sys.exit(1)
+        return
+
     api_session = getsession(uri)
 
     createsnapshot(api_session, uri, path, name, snapexpires)
@@ -0,0 +1,741 @@
+from time import sleep, perf_counter
+from getpass import getpass
+import argparse
+from collections import deque
+import logging
+import logging.handlers
+import fcntl
+import queue
+import atexit
+import sys
+import base64
+import os
+import io
+import socket
+import datetime
+import threading
+import ipaddress
+import json
+import math
+import sqlite3
+import requests
+import urllib3
+
+# Unix socket of daemon.py, which holds warm cluster sessions when running
+DAEMONSOCKET = os.environ.get("ISI_TOOLS_SOCKET", "isi_tools.sock")
+# Upper bounds in seconds of the PAPI request latency histogram buckets
+LATENCYBUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Per endpoint request metrics, keyed by method and endpoint
+METRICS = {}
+METRICSLOCK = threading.Lock()
+
+
+def validateinput(ip):
+    """This function checks for valid input"""
+    try:
+        ipaddress.ip_address(ip)
+    except ValueError:
+        print("\nPlease enter a valid IP address!\n")
+        sys.exit()
+
+
+def readsessioncache():
+    """This function reads the session cache shared by all isi_tools, returns
+    a dict of cached sessions keyed by cluster uri"""
+    cache = "session_cache.json"
+    if os.path.isfile(cache):
+        try:
+            with open(cache, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    return {}
+
+
+def writesessioncache(sessions):
+    """This function atomically writes the session cache, readable only by
+    the current user"""
+    cache = "session_cache.json"
+    tmpcache = cache + "." + str(os.getpid())
+    fd = os.open(tmpcache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(sessions, f, indent=4)
+    os.replace(tmpcache, cache)
+
+
+def getcachedsession(uri):
+    """This function reuses a cached session for uri if it has not expired and
+    the cluster still accepts it, returns session or None"""
+    entry = readsessioncache().get(uri)
+    now = datetime.datetime.now().timestamp()
+    if entry is None or entry["expires"] <= now:
+        return None
+    api_session = requests.Session()
+    api_session.cookies.set("isisessid", entry["isisessid"])
+    api_session.cookies.set("isicsrf", entry["isicsrf"])
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = entry["isicsrf"]
+    start = perf_counter()
+    response = api_session.get(uri + "/session/1/session", verify=False)
+    recordrequest(
+        "GET",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code != 200:
+        logging.info("Cached API session of " + entry["username"] + " at " + uri + " rejected")
+        return None
+    logging.info("Cached API session reused by " + entry["username"] + " at " + uri)
+    print("\nReusing session to " + uri + ".\n")
+    entry["expires"] = min(now + entry["timeout_inactive"], entry["expires_absolute"])
+    sessions = readsessioncache()
+    sessions[uri] = entry
+    writesessioncache(sessions)
+    return api_session, entry["username"]
+
+
+def cachesession(uri, api_session, user, response):
+    """This function stores the isisessid/isicsrf cookies of a new session with
+    their expiry so later runs can reuse them"""
+    timeouts = json.loads(response.content.decode(encoding="UTF-8") or "{}")
+    now = datetime.datetime.now().timestamp()
+    inactive = timeouts.get("timeout_inactive", 900)
+    absolute = now + timeouts.get("timeout_absolute", 14400)
+    sessions = readsessioncache()
+    sessions[uri] = {
+        "username": user,
+        "isisessid": api_session.cookies.get("isisessid"),
+        "isicsrf": api_session.cookies.get("isicsrf"),
+        "timeout_inactive": inactive,
+        "expires_absolute": absolute,
+        "expires": min(now + inactive, absolute),
+    }
+    writesessioncache(sessions)
+
+
+def daemoncall(socketpath, header, body=b"", timeout=None):
+    """This function sends one request to daemon.py over its Unix socket,
+    returns the reply header and body"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socketpath)
+        header = dict(header, length=len(body))
+        client.sendall(json.dumps(header).encode("utf-8") + b"\n" + body)
+        with client.makefile("rb") as f:
+            try:
+                reply = json.loads(f.readline())
+                length = reply["length"]
+            except (ValueError, KeyError) as err:
+                raise requests.exceptions.ConnectionError(
+                    "daemon.py sent no valid reply: " + str(err)
+                )
+            return reply, f.read(length)
+    finally:
+        client.close()
+
+
+class DaemonAdapter(requests.adapters.BaseAdapter):
+    """This adapter hands the requests of a session to daemon.py, which sends
+    them to the cluster over its own warm session"""
+
+    def __init__(self, socketpath):
+        super().__init__()
+        self.socketpath = socketpath
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        header = {
+            "method": request.method,
+            "url": request.url,
+            "content_type": request.headers.get("Content-Type"),
+            "timeout": timeout,
+        }
+        if isinstance(timeout, tuple):
+            timeout = None if None in timeout else sum(timeout)
+        try:
+            reply, content = daemoncall(self.socketpath, header, body, timeout)
+        except socket.timeout as err:
+            raise requests.exceptions.Timeout(err, request=request)
+        except OSError as err:
+            raise requests.exceptions.ConnectionError(err, request=request)
+        if reply.get("error") == "timeout":
+            raise requests.exceptions.Timeout(reply["message"], request=request)
+        elif reply.get("error") is not None:
+            raise requests.exceptions.ConnectionError(reply["message"], request=request)
+        response = requests.models.Response()
+        response.status_code = reply["status"]
+        response.reason = reply["reason"]
+        if reply.get("content_type"):
+            response.headers["Content-Type"] = reply["content_type"]
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def getdaemonsession(uri, timeout=60):
+    """This function returns a session whose requests go through daemon.py
+    when it is running, otherwise None"""
+    if not os.path.exists(DAEMONSOCKET):
+        return None
+    try:
+        reply, _ = daemoncall(DAEMONSOCKET, {"method": "SESSION", "url": uri}, b"", timeout)
+    except (OSError, ValueError):
+        return None
+    if reply.get("status") != 200:
+        return None
+    api_session = requests.Session()
+    api_session.mount("https://", DaemonAdapter(DAEMONSOCKET))
+    print("\nUsing the daemon session to " + uri + ".\n")
+    return api_session, reply["user"]
+
+
+def getsession(uri):
+    """This function gets a session and sets headers, returns session"""
+    api_session = getdaemonsession(uri)
+    if api_session is not None:
+        return api_session
+    cached = getcachedsession(uri)
+    if cached is not None:
+        return cached
+
+    creds = "creds.json"
+    if os.path.isfile(creds):
+        with open(creds, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            user = data["username"]
+            p = base64.b64decode(data["password"]).decode("utf-8")
+    elif os.path.isfile(creds) is False:
+        user = input("Please provide your user name? \n")
+        print("\nPlease provide the password for your user account...\n")
+        p = getpass()
+
+    print("\n\nAttempting session to " + uri + " ...\n")
+    headers = {"Content-Type": "application/json"}
+    data = json.dumps({"username": user, "password": p, "services": ["platform"]})
+    api_session = requests.Session()
+    start = perf_counter()
+    response = api_session.post(
+        uri + "/session/1/session", data=data, headers=headers, verify=False
+    )
+    recordrequest(
+        "POST",
+        "/session/1/session",
+        response.status_code,
+        len(response.content),
+        perf_counter() - start,
+    )
+    if response.status_code == 200 or response.status_code == 201:
+        print("Session to " + uri + " established.\n")
+        logging.info("API session created successfully by " + user + " at " + uri)
+    elif response.status_code != 200 or response.status_code != 201:
+        print(
+            "\nSession to "
+            + uri
+            + " not established. Please check your password, user name, or IP and try again.\n"
+        )
+        logging.info("Creation of API session by " + user + " at " + uri + " unsuccessful")
+        sys.exit()
+    api_session.headers["referer"] = uri
+    api_session.headers["X-CSRF-Token"] = api_session.cookies.get("isicsrf")
+    cachesession(uri, api_session, user, response)
+    return api_session, user
+
+
+def endpointname(resourceurl):
+    """This function reduces a resource URL to its endpoint by replacing each
+    part after the API version that holds a digit, such as a snapshot,
+    lock or ChangeList ID, with {id}"""
+    parts = resourceurl.split("?")[0].strip("/").split("/")
+    return "/" + "/".join(
+        "{id}" if index > 1 and any(c.isdigit() for c in part) else part
+        for index, part in enumerate(parts)
+    )
+
+
+def recordrequest(method, resourceurl, status, nbytes, elapsed):
+    """This function adds one API request to the per endpoint metrics. status
+    is None when no response came back, elapsed is in seconds."""
+    key = (method, endpointname(resourceurl))
+    with METRICSLOCK:
+        if key not in METRICS:
+            METRICS[key] = {
+                "count": 0,
+                "errors": 0,
+                "bytes": 0,
+                "seconds": 0.0,
+                "buckets": [0] * len(LATENCYBUCKETS),
+                "latencies": deque(maxlen=10000),
+                "statuses": {},
+            }
+        entry = METRICS[key]
+        entry["count"] += 1
+        entry["bytes"] += nbytes
+        entry["seconds"] += elapsed
+        entry["latencies"].append(elapsed)
+        for index, bound in enumerate(LATENCYBUCKETS):
+            if elapsed <= bound:
+                entry["buckets"][index] += 1
+        if status is None or status >= 400:
+            entry["errors"] += 1
+        status = str(status) if status is not None else "none"
+        entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+
+
+def percentile(values, fraction):
+    """This function returns the nearest rank percentile of sorted values"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def metricsummary():
+    """This function summarizes the metrics of every endpoint, returns a list
+    of rows slowest p95 first"""
+    rows = []
+    with METRICSLOCK:
+        for (method, endpoint), entry in METRICS.items():
+            latencies = sorted(entry["latencies"])
+            rows.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": entry["count"],
+                    "errors": entry["errors"],
+                    "error_rate": round(entry["errors"] / entry["count"], 3),
+                    "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+                    "bytes": entry["bytes"],
+                }
+            )
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+
+def printmetrics():
+    """This function prints the per endpoint API request summary"""
+    rows = metricsummary()
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [columns] + [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(len(cell[i]) for cell in cells) for i in range(len(columns))]
+    print("\nAPI requests by endpoint:\n")
+    for cell in cells:
+        print(" ".join(cell[i].rjust(widths[i]) for i in range(len(columns))))
+    print()
+
+
+def writemetrics(metricspath):
+    """This function atomically writes the metrics as a Prometheus textfile,
+    for the node_exporter textfile collector to pick up"""
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    families = {
+        "requests_total": ("counter", "PAPI requests by response status."),
+        "request_duration_seconds": ("histogram", "PAPI request latency."),
+        "request_latency_seconds": ("summary", "PAPI request latency quantiles."),
+        "response_bytes_total": ("counter", "PAPI response payload bytes."),
+        "request_errors_total": ("counter", "PAPI requests that failed or got a 4xx/5xx."),
+    }
+    samples = {family: [] for family in families}
+
+    def sample(family, suffix, labels, value):
+        samples[family].append(
+            "isi_tools_papi_" + family + suffix + "{" + labels + "} " + str(value)
+        )
+
+    with METRICSLOCK:
+        for (method, endpoint), entry in sorted(METRICS.items()):
+            labels = 'tool="' + tool + '",method="' + method + '",endpoint="' + endpoint + '"'
+            for status, count in sorted(entry["statuses"].items()):
+                sample("requests_total", "", labels + ',status="' + status + '"', count)
+            duration = "request_duration_seconds"
+            for bound, count in zip(LATENCYBUCKETS, entry["buckets"]):
+                sample(duration, "_bucket", labels + ',le="' + str(bound) + '"', count)
+            sample(duration, "_bucket", labels + ',le="+Inf"', entry["count"])
+            sample(duration, "_sum", labels, round(entry["seconds"], 6))
+            sample(duration, "_count", labels, entry["count"])
+            latencies = sorted(entry["latencies"])
+            for fraction in [0.5, 0.95, 0.99]:
+                quantile = round(percentile(latencies, fraction), 6)
+                sample(
+                    "request_latency_seconds",
+                    "",
+                    labels + ',quantile="' + str(fraction) + '"',
+                    quantile,
+                )
+            sample("request_latency_seconds", "_sum", labels, round(entry["seconds"], 6))
+            sample("request_latency_seconds", "_count", labels, entry["count"])
+            sample("response_bytes_total", "", labels, entry["bytes"])
+            sample("request_errors_total", "", labels, entry["errors"])
+    lines = []
+    for family, (kind, description) in families.items():
+        lines.append("# HELP isi_tools_papi_" + family + " " + description)
+        lines.append("# TYPE isi_tools_papi_" + family + " " + kind)
+        lines.extend(samples[family])
+    tmppath = metricspath + "." + str(os.getpid())
+    with open(tmppath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmppath, metricspath)
+
+
+def reportmetrics(metricspath, summary):
+    """This function prints and writes the metrics at the end of a run"""
+    if summary:
+        printmetrics()
+    if metricspath:
+        writemetrics(metricspath)
+
+
+def papirequest(api_session, method, uri, resourceurl, retries=3, **kwargs):
+    """This function sends a PAPI request over the session, which carries the
+    CSRF headers, retries transient failures and logs the outcome, returns
+    the response"""
+    # Only retry a POST when the cluster refused it before doing any work
+    if method == "POST":
+        retrycodes = [429, 503]
+    else:
+        retrycodes = [429, 500, 502, 503, 504]
+    fields = {"method": method, "endpoint": resourceurl}
+    for attempt in range(retries + 1):
+        # Every attempt is timed and recorded on its own, so backoff sleeps are
+        # not counted as latency and retried failures are counted as errors
+        start = perf_counter()
+        try:
+            response = api_session[0].request(
+                method, uri + resourceurl, verify=False, **kwargs
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            elapsed = perf_counter() - start
+            recordrequest(method, resourceurl, None, 0, elapsed)
+            if method == "POST" or attempt == retries:
+                fields["elapsed_ms"] = round(elapsed * 1000, 1)
+                logging.info(
+                    "%s request by %s at %s unsuccessful",
+                    method,
+                    api_session[1],
+                    uri + resourceurl,
+                    extra=fields,
+                )
+                raise
+            sleep(2**attempt)
+            continue
+        elapsed = perf_counter() - start
+        recordrequest(
+            method, resourceurl, response.status_code, len(response.content), elapsed
+        )
+        if response.status_code in retrycodes and attempt < retries:
+            sleep(2**attempt)
+            continue
+        break
+    fields["status"] = response.status_code
+    fields["bytes"] = len(response.content)
+    fields["elapsed_ms"] = round(elapsed * 1000, 1)
+    if response.status_code in [200, 201, 204]:
+        outcome = "successful"
+    elif response.status_code not in [200, 201, 204]:
+        outcome = "unsuccessful"
+    logging.info(
+        "%s request by %s at %s " + outcome,
+        method,
+        api_session[1],
+        uri + resourceurl,
+        extra=fields,
+    )
+    return response
+
+
+def openinventory():
+    """This function opens the local snapshot inventory shared by all
+    isi_tools, creating it and its indexes if needed, returns connection"""
+    conn = sqlite3.connect("snapshot_inventory.db")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            cluster TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            name TEXT,
+            path TEXT,
+            size INTEGER,
+            has_locks INTEGER,
+            created INTEGER,
+            expires INTEGER,
+            PRIMARY KEY (cluster, id)
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_name ON snapshots (cluster, name);
+        CREATE INDEX IF NOT EXISTS snapshots_path ON snapshots (cluster, path);
+        CREATE INDEX IF NOT EXISTS snapshots_has_locks ON snapshots (cluster, has_locks);
+        CREATE TABLE IF NOT EXISTS inventory (
+            cluster TEXT PRIMARY KEY,
+            reconciled REAL
+        );
+        """
+    )
+    return conn
+
+
+def refreshinventory(api_session, uri, reconcileafter=3600):
+    """This function brings the local snapshot inventory of uri up to date.
+    Normally only snapshots newer than the highest known ID are fetched,
+    newest first. When the inventory is empty or was last reconciled more
+    than reconcileafter seconds ago, the full list is fetched instead so
+    deleted snapshots are dropped and sizes and locks are refreshed.
+    Returns the number of snapshots fetched, or None on failure."""
+    resourceurl = "/platform/1/snapshot/snapshots"
+    conn = openinventory()
+    try:
+        maxid = conn.execute(
+            "SELECT MAX(id) FROM snapshots WHERE cluster = ?", (uri,)
+        ).fetchone()[0]
+        reconciled = conn.execute(
+            "SELECT reconciled FROM inventory WHERE cluster = ?", (uri,)
+        ).fetchone()
+        now = datetime.datetime.now().timestamp()
+        full = reconciled is None or now - reconciled[0] >= reconcileafter
+        if full:
+            params = {"limit": 1000}
+        else:
+            params = {"limit": 1000, "sort": "id", "dir": "DESC"}
+        fetched = 0
+        seen = []
+        while params:
+            result = papirequest(api_session, "GET", uri, resourceurl, params=params)
+            if result.status_code != 200 and result.status_code != 201:
+                print(
+                    "\nIssue encountered with retrieving snapshots at "
+                    + uri
+                    + " Please try again.\n"
+                )
+                return None
+            result = json.loads(result.content.decode(encoding="UTF-8"))
+            snapshots = result["snapshots"]
+            if not full and maxid is not None:
+                snapshots = [snap for snap in snapshots if snap["id"] > maxid]
+            conn.executemany(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        uri,
+                        snap["id"],
+                        snap.get("name"),
+                        snap.get("path"),
+                        snap.get("size"),
+                        int(bool(snap.get("has_locks"))),
+                        snap.get("created"),
+                        snap.get("expires"),
+                    )
+                    for snap in snapshots
+                ],
+            )
+            fetched += len(snapshots)
+            seen.extend((snap["id"],) for snap in snapshots)
+            if result.get("resume") and len(snapshots) == len(result["snapshots"]):
+                params = {"resume": result["resume"]}
+            else:
+                params = None
+        if full:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (id INTEGER PRIMARY KEY)")
+            conn.execute("DELETE FROM seen")
+            conn.executemany("INSERT INTO seen VALUES (?)", seen)
+            conn.execute(
+                "DELETE FROM snapshots WHERE cluster = ? AND id NOT IN (SELECT id FROM seen)",
+                (uri,),
+            )
+            conn.execute("INSERT OR REPLACE INTO inventory VALUES (?, ?)", (uri, now))
+        conn.commit()
+        logging.info("Snapshot inventory of " + uri + " refreshed with " + str(fetched) + " snapshots")
+        return fetched
+    finally:
+        conn.close()
+
+
+def querysnapshots(uri, snapid=None, name=None, path=None, haslocks=None):
+    """This function looks up snapshots of uri in the local inventory. name
+    and path accept glob patterns (e.g. /ifs/data/*). Returns a list of
+    snapshots ordered by ID."""
+    clauses = ["cluster = ?"]
+    params = [uri]
+    if snapid is not None:
+        clauses.append("id = ?")
+        params.append(snapid)
+    if name is not None:
+        clauses.append("name GLOB ?")
+        params.append(name)
+    if path is not None:
+        clauses.append("path GLOB ?")
+        params.append(path)
+    if haslocks is not None:
+        clauses.append("has_locks = ?")
+        params.append(int(haslocks))
+    conn = openinventory()
+    try:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            "SELECT id, name, path, size, has_locks, created, expires FROM snapshots"
+            " WHERE " + " AND ".join(clauses) + " ORDER BY id",
+            params,
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(row, has_locks=bool(row["has_locks"])) for row in rows]
+
+
+def printsnapshots(snapshots):
+    """This function prints snapshots as a plain text table"""
+    columns = ["id", "name", "path", "size", "has_locks"]
+    rows = [columns] + [[str(snap[column]) for column in columns] for snap in snapshots]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(row[i].ljust(widths[i]) for i in range(len(columns))).rstrip())
+
+
+class JsonFormatter(logging.Formatter):
+    """This formatter writes each log record as a JSON line, with the method,
+    endpoint, status, bytes and elapsed_ms of PAPI requests when present"""
+
+    fields = ["method", "endpoint", "status", "bytes", "elapsed_ms"]
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class LockedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """This handler rotates a log shared by several processes. Every record is
+    written under an flock on <log>.lock, so only one process rolls the log
+    over, and a process that finds the log was rolled over by another one
+    reopens it before writing."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lockfile = open(self.baseFilename + ".lock", "a")
+
+    def reopenifrotated(self):
+        """This function reopens the log when it is no longer the file this
+        handler has open"""
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            current = None
+        opened = os.fstat(self.stream.fileno())
+        if current is None or not os.path.samestat(current, opened):
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            self.reopenifrotated()
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lockfile.close()
+
+
+def setuplogging():
+    """This function queues log records to a background thread that writes
+    them to isi_tools.log as JSON lines, rotating it at 10 MB and keeping
+    five old logs, so logging never blocks a request"""
+    logqueue = queue.Queue()
+    handler = LockedRotatingFileHandler(
+        "isi_tools.log", maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(logqueue, handler)
+    listener.start()
+    # Write out whatever is still queued when the tool exits
+    atexit.register(listener.stop)
+    queuehandler = logging.handlers.QueueHandler(logqueue)
+    queuehandler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(handlers=[queuehandler], level=logging.INFO)
+    return listener
+
+
+def main():
+    """This function is the main function that runs the snapinventory"""
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    parser = argparse.ArgumentParser(
+        description="Look up snapshots in the local snapshot inventory"
+    )
+    parser.add_argument("ip", help="Enter a valid IP address")
+    parser.add_argument("-i", "--id", type=int, help="Snapshot ID to look up")
+    parser.add_argument(
+        "-n", "--name", help="Snapshot name or glob pattern, e.g. 'nightly_*'"
+    )
+    parser.add_argument(
+        "-p", "--path", help="Snapshot path or glob pattern, e.g. '/ifs/data/*'"
+    )
+    parser.add_argument(
+        "-l",
+        "--locked",
+        help="Type 'y' for only locked snapshots, 'n' for only unlocked snapshots",
+    )
+    parser.add_argument(
+        "-r",
+        "--refresh",
+        help="Type 'n' to answer from the inventory without contacting the cluster, "
+        + "'full' to refetch every snapshot (default: fetch new snapshots only)",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write per endpoint API request counts, latency, sizes and errors to "
+        + "this Prometheus textfile (e.g. /var/lib/node_exporter/isi_tools.prom)",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print per endpoint API request counts, latency percentiles, sizes and "
+        + "error rates at the end of the run",
+    )
+    args = parser.parse_args()
+
+    ip = args.ip
+
+    setuplogging()
+    atexit.register(reportmetrics, args.metrics, args.summary)
+
+    validateinput(ip)
+    if args.locked not in [None, "y", "n"] or args.refresh not in [None, "n", "full"]:
+        print("\nPlease enter 'y' or 'n' for --locked and 'n' or 'full' for --refresh.\n")
+        sys.exit()
+
+    port = 8080
+    uri = "https://" + str(ip) + ":" + str(port)
+
+    if args.refresh != "n":
+        api_session = getsession(uri)
+        reconcileafter = 0 if args.refresh == "full" else 3600
+        if refreshinventory(api_session, uri, reconcileafter) is None:
+            sys.exit(1)
+
+    haslocks = None
+    if args.locked is not None:
+        haslocks = args.locked == "y"
+    snapshots = querysnapshots(uri, args.id, args.name, args.path, haslocks)
+    if not snapshots:
+        print("\nNo matching snapshots in the inventory!\n")
+        return
+    printsnapshots(snapshots)
+
+
+if __name__ == "__main__":
+    main()